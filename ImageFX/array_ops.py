@@ -0,0 +1,297 @@
+"""
+Array-based (OpenCV/numpy) versions of the ImageFX distortions.
+
+Every function works on a contiguous uint8 (H, W, 3) array and updates it in
+place where OpenCV allows it, so a whole distortion chain can run on a single
+buffer without converting to PIL and back. Parameter ranges are chosen by the
+caller, the functions mirror what the PIL operations in preprocess.py do.
+"""
+
+import random
+
+import cv2
+import numpy as np
+
+from noise_bank import default_bank
+from tiling import strips, filter_strips, warp_perspective_strips
+
+# ITU-R 601-2 luma weights, the same ones PIL uses for its "L" conversion
+LUMA_WEIGHTS_RGB = (0.299, 0.587, 0.114)
+
+# Kernel of PIL's ImageFilter.SMOOTH, the degenerate image of ImageEnhance.Sharpness
+SMOOTH_KERNEL = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13
+
+def luma_weights(channel_order='RGB'):
+    """Return the luma weights in the channel order of the array."""
+    return LUMA_WEIGHTS_RGB if channel_order == 'RGB' else LUMA_WEIGHTS_RGB[::-1]
+
+def to_gray(img, channel_order='RGB'):
+    """Convert an RGB or BGR array to grayscale."""
+    code = cv2.COLOR_RGB2GRAY if channel_order == 'RGB' else cv2.COLOR_BGR2GRAY
+    return cv2.cvtColor(img, code)
+
+def _blend_region(img, box, draw, color, alpha):
+    """
+    Blend a solid color into img where draw() marks a mask.
+
+    Only the bounding box of the shape is touched. draw receives the mask of the
+    clipped box and the (x, y) offset of the box in the image.
+    """
+    height, width = img.shape[:2]
+    x0, y0 = max(int(box[0]), 0), max(int(box[1]), 0)
+    x1, y1 = min(int(box[2]), width), min(int(box[3]), height)
+    if x1 <= x0 or y1 <= y0:
+        return
+
+    roi = img[y0:y1, x0:x1]
+    mask = np.zeros(roi.shape[:2], dtype=np.uint8)
+    draw(mask, np.array([x0, y0]))
+
+    # Same as drawing with an RGBA fill on PIL's ImageDraw: dst * (1 - a) + color * a
+    blended = cv2.addWeighted(roi, 1 - alpha, np.full_like(roi, color), alpha, 0)
+    np.copyto(roi, blended, where=mask.astype(bool)[:, :, np.newaxis])
+
+def add_random_shapes_array(img, num_shapes=5, opacity_range=(0.1, 0.3)):
+    """Add random translucent geometric shapes to an array, like add_random_shapes."""
+    height, width = img.shape[:2]
+
+    shape_types = ['rectangle', 'circle', 'polygon', 'line']
+
+    for _ in range(num_shapes):
+        # Pick a random shape type
+        shape_type = random.choice(shape_types)
+
+        # Choose a random color with transparency
+        color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+        opacity = random.uniform(*opacity_range)
+        alpha = int(opacity * 255) / 255.0
+
+        if shape_type == 'rectangle':
+            x1 = random.randint(0, width)
+            y1 = random.randint(0, height)
+            x2 = random.randint(x1, min(x1 + width//2, width))
+            y2 = random.randint(y1, min(y1 + height//2, height))
+            _blend_region(
+                img, (x1, y1, x2 + 1, y2 + 1),
+                lambda mask, offset: cv2.rectangle(
+                    mask, tuple(int(v) for v in (x1, y1) - offset),
+                    tuple(int(v) for v in (x2, y2) - offset), 255, -1
+                ),
+                color, alpha
+            )
+
+        elif shape_type == 'circle':
+            center_x = random.randint(0, width)
+            center_y = random.randint(0, height)
+            radius = random.randint(10, min(width, height) // 6)
+            _blend_region(
+                img, (center_x - radius, center_y - radius, center_x + radius + 1, center_y + radius + 1),
+                lambda mask, offset: cv2.circle(
+                    mask, tuple(int(v) for v in (center_x, center_y) - offset), radius, 255, -1
+                ),
+                color, alpha
+            )
+
+        elif shape_type == 'polygon':
+            # Random polygon (3-6 sides)
+            num_points = random.randint(3, 6)
+            center_x = random.randint(0, width)
+            center_y = random.randint(0, height)
+            max_radius = min(width, height) // 8
+
+            points = []
+            for i in range(num_points):
+                angle = np.radians(i * (360 / num_points))
+                radius = random.randint(max_radius // 2, max_radius)
+                points.append((center_x + int(radius * np.cos(angle)),
+                               center_y + int(radius * np.sin(angle))))
+            points = np.array(points, dtype=np.int32)
+
+            x0, y0 = points.min(axis=0)
+            x1, y1 = points.max(axis=0) + 1
+            _blend_region(
+                img, (x0, y0, x1, y1),
+                lambda mask, offset: cv2.fillPoly(mask, [(points - offset).astype(np.int32)], 255),
+                color, alpha
+            )
+
+        elif shape_type == 'line':
+            x1 = random.randint(0, width)
+            y1 = random.randint(0, height)
+            x2 = random.randint(0, width)
+            y2 = random.randint(0, height)
+            line_width = random.randint(1, 5)
+            _blend_region(
+                img,
+                (min(x1, x2) - line_width, min(y1, y2) - line_width,
+                 max(x1, x2) + line_width + 1, max(y1, y2) + line_width + 1),
+                lambda mask, offset: cv2.line(
+                    mask, tuple(int(v) for v in (x1, y1) - offset),
+                    tuple(int(v) for v in (x2, y2) - offset), 255, line_width
+                ),
+                color, alpha
+            )
+
+    return img
+
+def add_background_noise_array(img, intensity=0.03, channel_order='RGB', strip_rows=None):
+    """Add subtle gaussian background noise, weaker on dark (text) pixels."""
+    for strip in strips(img, strip_rows):
+        noise = default_bank().field(strip.shape, intensity * 255)
+
+        if strip.ndim == 3:
+            # Areas with lower values (darker) get less noise
+            gray = to_gray(strip, channel_order)
+            noise *= (0.5 + gray.astype(np.float32) * (0.5 / 255.0))[:, :, np.newaxis]
+
+        # Saturating add straight into the image buffer
+        cv2.add(strip, noise, dst=strip, dtype=cv2.CV_8U)
+    return img
+
+def gaussian_blur(img, radius, strip_rows=None):
+    """Gaussian blur with PIL's radius (standard deviation) semantics."""
+    if strip_rows:
+        # OpenCV sizes the kernel of 8-bit images to +-3 sigma
+        halo = int(np.ceil(3 * radius)) + 1
+        return filter_strips(img, lambda block: gaussian_blur(block, radius), halo, strip_rows)
+    return cv2.GaussianBlur(img, (0, 0), radius, dst=img)
+
+def box_blur(img, radius, strip_rows=None):
+    """Box blur over a (2 * radius + 1) square, like PIL's BoxBlur."""
+    if strip_rows:
+        return filter_strips(img, lambda block: box_blur(block, radius), radius, strip_rows)
+    size = 2 * radius + 1
+    return cv2.blur(img, (size, size), dst=img)
+
+def adjust_sharpness(img, factor, strip_rows=None):
+    """Blend with a smoothed copy in one filter pass, like ImageEnhance.Sharpness."""
+    if strip_rows:
+        return filter_strips(img, lambda block: adjust_sharpness(block, factor), 1, strip_rows)
+    identity = np.zeros((3, 3), dtype=np.float32)
+    identity[1, 1] = 1
+    kernel = factor * identity + (1 - factor) * SMOOTH_KERNEL
+    return cv2.filter2D(img, -1, kernel, dst=img, borderType=cv2.BORDER_REPLICATE)
+
+def saturation_matrix(factor, channel_order='RGB'):
+    """3x3 color matrix that blends each pixel with its gray value."""
+    gray_rows = np.tile(np.array(luma_weights(channel_order), dtype=np.float32), (3, 1))
+    return factor * np.eye(3, dtype=np.float32) + (1 - factor) * gray_rows
+
+class PhotometricStage:
+    """
+    Collects per-pixel color operations and applies them in a single pass.
+    
+    Brightness, contrast, channel offsets and saturation are all affine in the
+    pixel value, so any sequence of them composes into one 3x4 color matrix.
+    When no saturation change is involved the matrix is diagonal and is applied
+    as a per-channel lookup table with cv2.LUT, otherwise as one cv2.transform.
+    Intermediate clipping between the individual operations is not reproduced.
+    """
+
+    def __init__(self, channel_order='RGB'):
+        self.channel_order = channel_order
+        self.reset()
+
+    def reset(self):
+        """Drop all pending operations."""
+        self.linear = np.eye(3)
+        self.offset = np.zeros(3)
+        self._base_means = None
+
+    @property
+    def pending(self):
+        """Whether there are operations that have not been applied yet."""
+        return not (np.array_equal(self.linear, np.eye(3)) and not self.offset.any())
+
+    def _compose(self, linear, offset):
+        # new(x) = L2 (L1 x + t1) + t2
+        self.linear = linear @ self.linear
+        self.offset = linear @ self.offset + offset
+
+    def brightness(self, factor):
+        """Queue a brightness change (ImageEnhance.Brightness)."""
+        self._compose(np.eye(3) * factor, np.zeros(3))
+
+    def contrast(self, img, factor):
+        """Queue a contrast change (ImageEnhance.Contrast) around the current mean gray level."""
+        if self._base_means is None:
+            self._base_means = np.array(cv2.mean(img)[:3])
+        means = self.linear @ self._base_means + self.offset
+        mean = int(np.dot(luma_weights(self.channel_order), means) + 0.5)
+        self._compose(np.eye(3) * factor, np.full(3, mean * (1 - factor)))
+
+    def shift(self, offsets):
+        """Queue per-channel offsets, given in RGB order like the PIL path records them."""
+        offsets = np.array(offsets, dtype=np.float64)
+        if self.channel_order == 'BGR':
+            offsets = offsets[::-1]
+        self._compose(np.eye(3), offsets)
+
+    def saturation(self, factor):
+        """Queue a saturation change (ImageEnhance.Color)."""
+        self._compose(saturation_matrix(factor, self.channel_order).astype(np.float64), np.zeros(3))
+
+    def apply(self, img, strip_rows=None):
+        """Apply all pending operations to img in place and reset the stage."""
+        if not self.pending:
+            return img
+
+        if np.count_nonzero(self.linear - np.diag(np.diag(self.linear))) == 0:
+            # Point operations per channel: one 256-entry table per channel
+            values = np.arange(256, dtype=np.float64)
+            table = np.diag(self.linear)[:, np.newaxis] * values + self.offset[:, np.newaxis]
+            table = np.clip(np.rint(table), 0, 255).astype(np.uint8)
+            table = np.ascontiguousarray(table.T.reshape(256, 1, 3))
+            for strip in strips(img, strip_rows):
+                cv2.LUT(strip, table, dst=strip)
+        else:
+            matrix = np.hstack([self.linear, self.offset[:, np.newaxis]]).astype(np.float32)
+            for strip in strips(img, strip_rows):
+                cv2.transform(strip, matrix, dst=strip)
+
+        self.reset()
+        return img
+
+def darken_polygon(img, points, intensity, strip_rows=None):
+    """Multiply the pixels inside a polygon by intensity."""
+    points = np.array(points, dtype=np.int32)
+    x0, y0 = points.min(axis=0)
+    x1, y1 = points.max(axis=0) + 1
+
+    # The mask is rasterized once for the whole bounding box: filling the polygon
+    # again per strip rounds its edges differently from the full-frame mask
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    cv2.fillPoly(mask, [points - np.array([x0, y0], dtype=np.int32)], 255)
+    mask = mask.astype(bool)[:, :, np.newaxis]
+
+    # Only the bounding box is touched, strip by strip in tiled mode
+    step = strip_rows or (y1 - y0)
+    for top in range(y0, y1, step):
+        bottom = min(y1, top + step)
+        roi = img[top:bottom, x0:x1]
+        darkened = cv2.convertScaleAbs(roi, alpha=intensity)
+        np.copyto(roi, darkened, where=mask[top - y0:bottom - y0])
+    return img
+
+def jpeg_roundtrip(img, quality, strip_rows=None):
+    """Simulate JPEG compression artifacts at the given quality."""
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+    if strip_rows:
+        # Strips are MCU aligned, each one is compressed on its own and written back
+        for strip in strips(img, strip_rows):
+            result, encimg = cv2.imencode('.jpg', strip, encode_param)
+            strip[...] = cv2.imdecode(encimg, cv2.IMREAD_COLOR)
+        return img
+    result, encimg = cv2.imencode('.jpg', img, encode_param)
+    return cv2.imdecode(encimg, cv2.IMREAD_COLOR)
+
+def warp_with_matrix(img, matrix, strip_rows=None):
+    """Warp with a 3x3 homography onto a white canvas of the same size."""
+    if strip_rows:
+        return warp_perspective_strips(img, matrix, strip_rows)
+    height, width = img.shape[:2]
+    return cv2.warpPerspective(
+        img, matrix, (width, height),
+        flags=cv2.INTER_CUBIC,
+        borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255)
+    )
@@ -0,0 +1,80 @@
+"""
+Batched versions of the ImageFX array operations for stacks of same-size images.
+
+A batch is a contiguous uint8 (N, H, W, C) array. Operations that combine the
+image with a per-pixel field (background, gaussian and speckle noise, shadow
+attenuation) fill the fields of all samples with their own parameters and then
+run a single call on the batch viewed as one tall (N * H, W, C) image. Operations
+with a per-sample table or kernel (LUTs, color matrices, JPEG) run one OpenCV
+call per sample, which measured faster than any numpy gather over the batch.
+Every function updates the batch in place.
+"""
+
+import cv2
+import numpy as np
+
+from array_ops import to_gray
+from noise_bank import default_bank
+
+def _tall(batch):
+    """View an (N, H, W, C) batch as one (N * H, W, C) image."""
+    n, height, width = batch.shape[:3]
+    return batch.reshape((n * height, width) + batch.shape[3:])
+
+def _noise_fields(batch, sigmas):
+    """float32 gaussian noise shaped like the batch, with its own sigma per sample."""
+    bank = default_bank()
+    noise = np.empty(batch.shape, dtype=np.float32)
+    for field, sigma in zip(noise, sigmas):
+        bank.field(field.shape, sigma, out=field)
+    return noise
+
+def add_background_noise_batch(batch, intensities, channel_order='RGB'):
+    """add_background_noise_array for every sample, with one intensity per sample."""
+    tall = _tall(batch)
+    noise = _noise_fields(batch, [intensity * 255 for intensity in intensities])
+
+    if batch.ndim == 4:
+        # Areas with lower values (darker) get less noise
+        gray = to_gray(tall, channel_order).reshape(batch.shape[:3])
+        noise *= (0.5 + gray.astype(np.float32) * (0.5 / 255.0))[..., np.newaxis]
+
+    cv2.add(tall, noise.reshape(tall.shape), dst=tall, dtype=cv2.CV_8U)
+    return batch
+
+def gaussian_noise_batch(batch, sigmas):
+    """The 'gaussian' noise distortion for every sample, including its uint8 wrap-around."""
+    tall = _tall(batch)
+    noise = _noise_fields(batch, sigmas)
+    cv2.add(tall, noise.astype(np.int8).view(np.uint8).reshape(tall.shape), dst=tall)
+    return batch
+
+def speckle_noise_batch(batch, sigmas):
+    """The 'speckle' noise distortion for every sample."""
+    tall = _tall(batch)
+    gain = _noise_fields(batch, sigmas)
+    gain += 1
+    cv2.multiply(tall, gain.reshape(tall.shape), dst=tall, dtype=cv2.CV_8U)
+    return batch
+
+def attenuate_batch(batch, attenuations):
+    """Multiply every sample by its (H, W) attenuation map, truncating like add_complex_shadows."""
+    attenuations = np.asarray(attenuations, dtype=np.float32)
+    if batch.ndim == 4:
+        attenuations = attenuations[..., np.newaxis]
+    np.multiply(batch, attenuations, out=batch, casting='unsafe')
+    return batch
+
+def photometric_batch(batch, stages):
+    """Apply the pending operations of one PhotometricStage per sample."""
+    for sample, stage in zip(batch, stages):
+        if stage is not None:
+            stage.apply(sample)
+    return batch
+
+def jpeg_roundtrip_batch(batch, qualities):
+    """JPEG round trip of every sample at its own quality."""
+    for sample, quality in zip(batch, qualities):
+        ok, encoded = cv2.imencode('.jpg', sample, [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])
+        sample[...] = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+    return batch
@@ -0,0 +1,141 @@
+"""
+On-the-fly ImageFX augmentation for training loops, without writing files.
+
+AugmentedDataset reads a Label.txt style index and yields (image, annotations)
+pairs that went through the same distortion chain as preprocess.py. Images are
+decoded and augmented lazily in a pool of worker processes, with a bounded
+number of images prefetched ahead of the consumer.
+
+Example:
+    dataset = AugmentedDataset('train_data', workers=8, shuffle=True)
+    for epoch in range(epochs):
+        for image, annotations in dataset:
+            ...
+"""
+
+import os
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import cv2
+
+import noise_bank
+import overlay_bank
+from label_io import iter_label_entries
+from preprocess import _init_worker, _load_image, _augment_decoded
+
+def _augment_entry(image_path, annotations, options):
+    """
+    Decode and augment one index entry in a worker.
+
+    Returns:
+        tuple: (image array, annotations), or None if the image could not be read
+    """
+    options = dict(options)
+    channel_order = options.pop('channel_order', 'BGR')
+    target_long_side = options.pop('target_long_side', None)
+
+    image, annotations = _load_image(image_path, annotations, target_long_side)
+    if image is None:
+        return None
+
+    image, annotations = _augment_decoded(image, annotations, **options)
+    if channel_order == 'RGB':
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return image, annotations
+
+class AugmentedDataset:
+    """
+    Iterable of freshly augmented (image, annotations) pairs.
+
+    Args:
+        data_dir: Directory with the images and the annotations file
+        annotations_file: Name of the Label.txt style index in data_dir
+        distortion_prob: Probability of augmenting an image at all
+        workers: Number of worker processes or threads (CPU count if None)
+        prefetch: Maximum number of images decoded ahead of the consumer
+            (2 per worker if None)
+        executor: 'process' for worker processes, 'thread' for threads
+        shuffle: Visit the entries in a new random order on every iteration
+        seed: Seed of the shuffle order
+        channel_order: 'BGR' (OpenCV) or 'RGB' order of the yielded arrays
+        shadow_scale, backend, use_overlay_bank, target_long_side, memory_budget_mb:
+            Augmentation options, see process_images_with_annotations
+
+    Iterating yields (uint8 array, annotations) in index (or shuffled) order.
+    Transformed "points" are numpy arrays. Unreadable images are skipped with a
+    warning. dataset[i] augments entry i in the calling process.
+    """
+
+    def __init__(self, data_dir, annotations_file='Label.txt', distortion_prob=0.5, workers=None,
+                 prefetch=None, executor='process', shuffle=False, seed=None, channel_order='BGR',
+                 shadow_scale=1.0, backend='cv2', use_overlay_bank=False, target_long_side=None,
+                 memory_budget_mb=None):
+        self.data_dir = data_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.prefetch = prefetch or self.workers * 2
+        self.executor = executor
+        self.shuffle = shuffle
+        self._random = random.Random(seed)
+
+        self.options = {
+            'distortion_prob': distortion_prob,
+            'shadow_scale': shadow_scale,
+            'backend': backend,
+            'use_overlay_bank': use_overlay_bank,
+            'memory_budget_mb': memory_budget_mb,
+            'target_long_side': target_long_side,
+            'channel_order': channel_order,
+        }
+
+        # Only the index is held in memory, images are decoded when they are needed
+        self.entries = []
+        seen = set()
+        for image_path, annotations in iter_label_entries(os.path.join(data_dir, annotations_file)):
+            path = os.path.join(data_dir, os.path.basename(image_path))
+            if path not in seen and os.path.exists(path):
+                seen.add(path)
+                self.entries.append((path, annotations))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        path, annotations = self.entries[index]
+        return _augment_entry(path, annotations, self.options)
+
+    def _make_pool(self):
+        if self.executor == 'process':
+            return ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_worker,
+                initargs=(False, noise_bank.options(), overlay_bank.options())
+            )
+        return ThreadPoolExecutor(max_workers=self.workers)
+
+    def __iter__(self):
+        order = list(range(len(self.entries)))
+        if self.shuffle:
+            self._random.shuffle(order)
+
+        with self._make_pool() as pool:
+            pending = deque()
+            indices = iter(order)
+            try:
+                while True:
+                    # Keep up to prefetch images in flight ahead of the consumer
+                    for index in indices:
+                        path, annotations = self.entries[index]
+                        pending.append(pool.submit(_augment_entry, path, annotations, self.options))
+                        if len(pending) >= self.prefetch:
+                            break
+
+                    if not pending:
+                        return
+                    result = pending.popleft().result()
+                    if result is not None:
+                        yield result
+            finally:
+                # The consumer may stop early, drop whatever was prefetched
+                for future in pending:
+                    future.cancel()
@@ -0,0 +1,77 @@
+"""
+Append-only journal of completed images, used to resume interrupted ImageFX runs.
+
+Every line records one finished output image as tab separated fields, in the
+spirit of Label.txt: output file name, task key of its source image, output
+label path and the annotations JSON.
+"""
+
+import hashlib
+import json
+import os
+
+from label_io import annotations_to_json
+
+JOURNAL_FILE = 'augment_journal.tsv'
+
+def task_key(image_file, annotations, params):
+    """
+    Hash the input of one image together with the run parameters.
+
+    The input image is identified by its size and modification time rather than
+    its bytes, so computing keys for a large dataset needs no extra reads.
+    """
+    stat = os.stat(image_file)
+    payload = json.dumps(
+        [stat.st_size, stat.st_mtime_ns, annotations, params],
+        sort_keys=True, default=str
+    )
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+class RunJournal:
+    """
+    Journal of the images a run has finished, stored in its output directory.
+
+    Loading keeps the last record per image; a partially written last line left
+    by a crash is ignored. Records are flushed as soon as they are written.
+    """
+
+    def __init__(self, output_dir, filename=JOURNAL_FILE):
+        self.path = os.path.join(output_dir, filename)
+        self.records = {}
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    parts = line.rstrip('\n').split('\t', 3)
+                    if len(parts) == 4:
+                        image_name, key, label_path, annotations_json = parts
+                        self.records[image_name] = (key, label_path, annotations_json)
+
+        self._file = open(self.path, 'a')
+
+    def is_done(self, image_name, key, output_file):
+        """Whether output image_name was finished with the same key and still exists."""
+        record = self.records.get(image_name)
+        return record is not None and record[0] == key and os.path.exists(output_file)
+
+    def record(self, image_name, key, label_path, annotations):
+        """Append a finished output image to the journal."""
+        annotations_json = annotations_to_json(annotations or [])
+        self._file.write(f"{image_name}\t{key}\t{label_path}\t{annotations_json}\n")
+        self._file.flush()
+        self.records[image_name] = (key, label_path, annotations_json)
+
+    def completed(self, keys):
+        """
+        Yield (label_path, annotations_json) for every journaled image whose key
+        matches the one in keys (image name -> key) and that has annotations.
+        """
+        for image_name, (key, label_path, annotations_json) in self.records.items():
+            if keys.get(image_name) == key and annotations_json != '[]':
+                yield label_path, annotations_json
+
+    def close(self):
+        self._file.close()
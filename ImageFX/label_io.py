@@ -0,0 +1,92 @@
+"""
+Reading and writing PPOCRLabel style annotation files (Label.txt, Cache.cach, fileState.txt).
+"""
+
+import json
+import os
+
+import numpy as np
+
+def iter_label_lines(annotations_path):
+    """
+    Lazily yield (image_path, annotations JSON string) pairs from a Label.txt style file.
+
+    Lines without a tab separator are skipped.
+    """
+    with open(annotations_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if '\t' in line:
+                parts = line.split('\t', 1)
+                if len(parts) == 2:
+                    yield parts[0], parts[1]
+
+def iter_label_entries(annotations_path):
+    """
+    Lazily yield (image_path, annotations) pairs from a Label.txt style file.
+
+    Lines without a tab separator are skipped, the JSON of every line is only
+    parsed when the line is reached.
+    """
+    for image_path, annotations_json in iter_label_lines(annotations_path):
+        yield image_path, json.loads(annotations_json)
+
+def _json_default(value):
+    """Convert numpy values left in annotations to plain Python for json.dumps."""
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def annotations_to_json(annotations):
+    """Serialize annotations for a Label.txt line, converting point arrays to lists."""
+    return json.dumps(annotations, default=_json_default)
+
+class LabelWriter:
+    """
+    Writes Label.txt, Cache.cach and fileState.txt together, one record at a time.
+
+    Every record is appended to all three files as soon as it is written, and the
+    files are flushed every flush_every records, so an interrupted run keeps the
+    labels of everything that finished.
+    """
+
+    def __init__(self, output_dir, annotations_file='Label.txt', cache_file='Cache.cach',
+                 filestate_file='fileState.txt', flush_every=100, mode='w'):
+        self.label_path = os.path.join(output_dir, annotations_file)
+        self.cache_path = os.path.join(output_dir, cache_file)
+        self.filestate_path = os.path.join(output_dir, filestate_file)
+        self.flush_every = max(1, flush_every)
+        self.count = 0
+
+        self._label = open(self.label_path, mode)
+        self._cache = open(self.cache_path, mode)
+        self._filestate = open(self.filestate_path, mode)
+
+    def write(self, image_path, annotations):
+        """Append one image's annotations to all three files."""
+        self.write_json(image_path, annotations_to_json(annotations))
+
+    def write_json(self, image_path, annotations_json):
+        """Append one image's already serialized annotations to all three files."""
+        line = f"{image_path}\t{annotations_json}\n"
+        self._label.write(line)
+        self._cache.write(line)
+        self._filestate.write(f"{image_path}\t1\n")
+
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        for f in (self._label, self._cache, self._filestate):
+            f.flush()
+
+    def close(self):
+        for f in (self._label, self._cache, self._filestate):
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,134 @@
+"""
+Precomputed gaussian noise tiles for the ImageFX noise effects.
+
+Drawing a fresh np.random.normal field the size of every image dominates the
+cost of the background noise and the 'gaussian'/'speckle' noise distortions.
+A NoiseBank holds a few square tiles of unit gaussian noise, quantized to int8,
+that are generated once per process or memory-mapped from a .npy file shared by
+all workers. A noise field of any size is assembled from randomly chosen,
+flipped, negated and offset crops of the tiles. The values are independent per
+pixel, so the blocks of a field are statistically identical to a freshly drawn
+one.
+"""
+
+import os
+import random
+
+import numpy as np
+
+# int8 steps per standard deviation, values are clipped at +-127 / 16 (~7.9 sigma)
+QUANT = 16
+
+_config = {'tile_size': 512, 'num_tiles': 8, 'path': None}
+_bank = None
+
+class NoiseBank:
+    """A stack of (num_tiles, tile_size, tile_size, channels) int8 noise tiles."""
+
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.tile_size = tiles.shape[1]
+
+    @classmethod
+    def generate(cls, tile_size=512, num_tiles=8, channels=3, rng=np.random):
+        """Draw new unit gaussian tiles."""
+        tiles = np.empty((num_tiles, tile_size, tile_size, channels), dtype=np.int8)
+        for tile in tiles:
+            values = rng.standard_normal((tile_size, tile_size, channels)).astype(np.float32)
+            values *= QUANT
+            np.clip(np.rint(values, out=values), -127, 127, out=values)
+            tile[...] = values
+        return cls(tiles)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map tiles saved with save(), the pages are shared between processes."""
+        return cls(np.load(path, mmap_mode='r'))
+
+    def save(self, path):
+        """Write the tiles to a .npy file, atomically so concurrent readers never see a partial file."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(self.tiles))
+        os.replace(tmp_path, path)
+
+    def _oriented_tile(self):
+        """
+        A random tile, possibly upside down, and a random sign for its values.
+
+        Flipping rows keeps every row contiguous, and gaussian noise is symmetric,
+        so both variations cost nothing when the crop is scaled into the field.
+        """
+        tile = self.tiles[random.randrange(len(self.tiles))]
+        if random.random() < 0.5:
+            tile = tile[::-1]
+        return tile, random.choice((-1.0, 1.0))
+
+    def field(self, shape, sigma=1.0, out=None):
+        """
+        Assemble a float32 gaussian noise field.
+
+        Args:
+            shape: (height, width) or (height, width, channels) of the field
+            sigma: Standard deviation of the returned noise
+            out: float32 array of the given shape to fill instead of a new one
+
+        Returns:
+            numpy.ndarray: float32 array of the given shape
+        """
+        height, width = shape[:2]
+        channels = shape[2] if len(shape) == 3 else None
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        size = self.tile_size
+        scale = sigma / QUANT
+
+        # Every block of the field comes from its own tile, orientation and offset
+        for y in range(0, height, size):
+            for x in range(0, width, size):
+                block = out[y:y + size, x:x + size]
+                bh, bw = block.shape[:2]
+                oy = random.randint(0, size - bh)
+                ox = random.randint(0, size - bw)
+                tile, sign = self._oriented_tile()
+                crop = tile[oy:oy + bh, ox:ox + bw]
+                crop = crop[:, :, :channels] if channels is not None else crop[:, :, 0]
+                np.multiply(crop, sign * scale, out=block, dtype=np.float32)
+
+        return out
+
+    def int_field(self, shape, sigma=1.0):
+        """Like field() but truncated to int16, the same as np.random.normal(...).astype(np.int16)."""
+        return self.field(shape, sigma).astype(np.int16)
+
+def configure(tile_size=512, num_tiles=8, path=None):
+    """
+    Set up the noise bank of this process.
+
+    The bank is built lazily by default_bank(). With a path the tiles are loaded
+    memory-mapped from that .npy file, which is created first if it doesn't
+    exist. Calling configure again with the same settings keeps the current bank,
+    so workers forked from an initialised parent reuse its tiles.
+    """
+    global _bank
+    config = {'tile_size': tile_size, 'num_tiles': num_tiles, 'path': path}
+    if config != _config:
+        _config.update(config)
+        _bank = None
+
+def options():
+    """The current configure() arguments, to initialise worker processes with."""
+    return dict(_config)
+
+def default_bank():
+    """The noise bank of this process, built on first use."""
+    global _bank
+    if _bank is None:
+        path = _config['path']
+        if path is None:
+            _bank = NoiseBank.generate(_config['tile_size'], _config['num_tiles'])
+        else:
+            if not os.path.exists(path):
+                NoiseBank.generate(_config['tile_size'], _config['num_tiles']).save(path)
+            _bank = NoiseBank.load(path)
+    return _bank
@@ -0,0 +1,197 @@
+"""
+Pre-rendered background overlays for the ImageFX shapes and shadow effects.
+
+add_random_shapes and add_complex_shadows draw their overlays from scratch at
+full resolution for every image, although both are smooth, low-detail layers
+that look the same at any size. An OverlayBank renders a fixed number of shape
+layers and shadow masks once at a small canonical resolution. Per image a few of
+them are picked, randomly flipped, resized to the image and blended in a single
+pass. With refresh_every set, one bank entry is re-rendered after that many
+uses, so long runs slowly cycle through new overlays.
+"""
+
+import math
+import random
+import threading
+
+import cv2
+import numpy as np
+
+from array_ops import add_random_shapes_array
+from tiling import iter_strips, resize_rows
+
+# Image size the shadow parameters are sampled for before rendering at the canonical size
+SHADOW_REFERENCE_SIZE = 1024
+
+_config = {'size': 256, 'num_layers': 16, 'num_masks': 16, 'refresh_every': 0}
+_bank = None
+
+def _render_shape_layer(size, num_shapes, opacity_range):
+    """
+    Render random shapes as a canonical compositing layer.
+
+    Returns:
+        tuple: (weight, offset, box). weight and offset are (h, w, 3) uint8
+        arrays cropped to the shapes' bounding box (x0, y0, x1, y1) on the
+        size x size canvas. Compositing is image * weight / 255 + offset, where
+        offset holds the premultiplied shape colors.
+    """
+    state = random.getstate()
+    offset = add_random_shapes_array(np.zeros((size, size, 3), dtype=np.float32), num_shapes, opacity_range)
+    # Drawing the same shapes over white gives 255 * weight + offset
+    random.setstate(state)
+    white = add_random_shapes_array(np.full((size, size, 3), 255, dtype=np.float32), num_shapes, opacity_range)
+
+    weight = np.clip(np.rint(white - offset), 0, 255).astype(np.uint8)
+    offset = np.clip(np.rint(offset), 0, 255).astype(np.uint8)
+
+    covered = np.argwhere(weight[:, :, 0] < 255)
+    if len(covered) == 0:
+        return weight[:0, :0], offset[:0, :0], (0, 0, 0, 0)
+    y0, x0 = covered.min(axis=0)
+    y1, x1 = covered.max(axis=0) + 1
+    return weight[y0:y1, x0:x1], offset[y0:y1, x0:x1], (x0, y0, x1, y1)
+
+def _render_shadow_mask(size):
+    """Render one random shadow as a (size, size) float32 mask in [0, opacity]."""
+    # Imported here, preprocess imports this module at load time
+    from preprocess import sample_shadow_params, render_shadow_mask
+
+    reference = max(SHADOW_REFERENCE_SIZE, size)
+    params = sample_shadow_params(reference, reference)
+    mask = render_shadow_mask(params, reference, reference, scale=size / reference)
+    return cv2.resize(mask, (size, size), interpolation=cv2.INTER_AREA)
+
+def _random_flip(layer):
+    """Flip a canonical layer horizontally and/or vertically at random."""
+    flip = random.choice((None, 0, 1, -1))
+    return layer if flip is None else cv2.flip(layer, flip)
+
+class OverlayBank:
+    """
+    Pre-rendered shape layers and shadow masks.
+
+    Args:
+        size: Side length of the canonical overlays
+        num_layers: Number of shape layers, each with 2-6 shapes
+        num_masks: Number of single-shadow masks
+        refresh_every: Re-render one random entry after this many uses (0 = never)
+        opacity_range: Opacity range of the shapes
+    """
+
+    def __init__(self, size=256, num_layers=16, num_masks=16, refresh_every=0, opacity_range=(0.05, 0.2)):
+        self.size = size
+        self.refresh_every = refresh_every
+        self.opacity_range = opacity_range
+        self._lock = threading.Lock()
+        self._uses = 0
+
+        self.layers = [self._new_layer() for _ in range(num_layers)]
+        self.masks = [_render_shadow_mask(size) for _ in range(num_masks)]
+
+    def _new_layer(self):
+        return _render_shape_layer(self.size, random.randint(2, 6), self.opacity_range)
+
+    def _count_use(self):
+        """Replace one random entry every refresh_every uses."""
+        if not self.refresh_every:
+            return
+        with self._lock:
+            self._uses += 1
+            refresh = self._uses % self.refresh_every == 0
+        if refresh:
+            # Swapping a list item is atomic, other threads see the old or the new entry
+            if random.random() < 0.5:
+                self.layers[random.randrange(len(self.layers))] = self._new_layer()
+            else:
+                self.masks[random.randrange(len(self.masks))] = _render_shadow_mask(self.size)
+
+    def apply_shapes(self, img, strip_rows=None):
+        """
+        Composite a random shape layer onto a uint8 (H, W, 3) array in place.
+
+        With strip_rows the layer is resampled and blended strip by strip.
+        """
+        height, width = img.shape[:2]
+        weight, offset, (x0, y0, x1, y1) = random.choice(self.layers)
+        self._count_use()
+        if x1 <= x0 or y1 <= y0:
+            return img
+
+        # Flip the layer and mirror its bounding box on the canonical canvas
+        flip = random.choice((None, 0, 1, -1))
+        if flip is not None:
+            weight, offset = cv2.flip(weight, flip), cv2.flip(offset, flip)
+            if flip != 0:
+                x0, x1 = self.size - x1, self.size - x0
+            if flip != 1:
+                y0, y1 = self.size - y1, self.size - y0
+
+        # Only the region covered by shapes is resized and blended
+        sx, sy = width / self.size, height / self.size
+        left, top = int(x0 * sx), int(y0 * sy)
+        right, bottom = min(width, math.ceil(x1 * sx)), min(height, math.ceil(y1 * sy))
+        if right <= left or bottom <= top:
+            return img
+        roi = img[top:bottom, left:right]
+        size = (right - left, bottom - top)
+        if strip_rows:
+            for y0, y1 in iter_strips(size[1], strip_rows):
+                strip = roi[y0:y1]
+                cv2.multiply(strip, resize_rows(weight, size, y0, y1), dst=strip, scale=1 / 255)
+                cv2.add(strip, resize_rows(offset, size, y0, y1), dst=strip)
+            return img
+        cv2.multiply(roi, cv2.resize(weight, size, interpolation=cv2.INTER_LINEAR), dst=roi, scale=1 / 255)
+        cv2.add(roi, cv2.resize(offset, size, interpolation=cv2.INTER_LINEAR), dst=roi)
+        return img
+
+    def apply_shadows(self, img, num_shadows=3, strip_rows=None):
+        """
+        Darken a uint8 array in place with num_shadows random shadow masks.
+
+        With strip_rows the combined mask is resampled and applied strip by strip.
+        """
+        height, width = img.shape[:2]
+
+        # Combine all shadows at the canonical size, the image is touched only once
+        attenuation = np.ones((self.size, self.size), dtype=np.float32)
+        for _ in range(num_shadows):
+            attenuation *= 1 - _random_flip(random.choice(self.masks))
+            self._count_use()
+
+        attenuation = np.rint(attenuation * 255).astype(np.uint8)
+        if img.ndim == 3:
+            attenuation = cv2.merge([attenuation] * img.shape[2])
+        if strip_rows:
+            for y0, y1 in iter_strips(height, strip_rows):
+                strip = img[y0:y1]
+                cv2.multiply(strip, resize_rows(attenuation, (width, height), y0, y1), dst=strip, scale=1 / 255)
+            return img
+        attenuation = cv2.resize(attenuation, (width, height), interpolation=cv2.INTER_LINEAR)
+        cv2.multiply(img, attenuation, dst=img, scale=1 / 255)
+        return img
+
+def configure(size=256, num_layers=16, num_masks=16, refresh_every=0):
+    """
+    Set up the overlay bank of this process.
+
+    The bank is rendered lazily by default_bank(). Calling configure again with
+    the same settings keeps the current bank, so workers forked from an
+    initialised parent reuse its overlays.
+    """
+    global _bank
+    config = {'size': size, 'num_layers': num_layers, 'num_masks': num_masks, 'refresh_every': refresh_every}
+    if config != _config:
+        _config.update(config)
+        _bank = None
+
+def options():
+    """The current configure() arguments, to initialise worker processes with."""
+    return dict(_config)
+
+def default_bank():
+    """The overlay bank of this process, rendered on first use."""
+    global _bank
+    if _bank is None:
+        _bank = OverlayBank(**_config)
+    return _bank
@@ -0,0 +1,147 @@
+"""
+A threaded multi-stage pipeline with bounded queues between the stages.
+
+Every stage has its own pool of threads that take items from the stage's input
+queue, run the stage function and put the result on the next queue. The queues
+are bounded, so a slow stage (e.g. writing to network storage) makes the stages
+before it wait instead of piling up decoded images in memory. OpenCV releases
+the GIL for decoding, most image operations and encoding, so the stages overlap
+on threads.
+"""
+
+import queue
+import threading
+
+_DONE = object()
+
+class StagedPipeline:
+    """
+    Run items through a sequence of (name, function, num_threads) stages.
+
+    Args:
+        stages: List of (name, function, num_threads). Every function takes the
+            item produced by the previous stage and returns the item for the next.
+        queue_size: Capacity of the queue in front of every stage and of the
+            output queue
+
+    Iterate over run(items) to feed the items and receive the results of the
+    last stage in completion order. depths() reports how full every queue is.
+    """
+
+    def __init__(self, stages, queue_size=8):
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.queues = [queue.Queue(self.queue_size) for _ in range(len(stages) + 1)]
+        self.names = [name for name, _, _ in stages] + ['output']
+        self._stop = threading.Event()
+        self._error = None
+        self._threads = []
+        self._depth_totals = [0] * len(self.queues)
+        self._depth_max = [0] * len(self.queues)
+        self._samples = 0
+
+    def _put(self, q, item):
+        """Put unless the pipeline was stopped, waiting while the queue is full."""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _feed(self, items):
+        try:
+            for item in items:
+                if not self._put(self.queues[0], item):
+                    return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.stages[0][2]):
+                self._put(self.queues[0], _DONE)
+
+    def _work(self, index, function, remaining):
+        source, target = self.queues[index], self.queues[index + 1]
+        try:
+            while True:
+                item = self._get(source)
+                if item is _DONE:
+                    break
+                if not self._put(target, function(item)):
+                    break
+        except Exception as e:
+            self._fail(e)
+        finally:
+            # The last thread of a stage to finish passes the end on to the next stage
+            with remaining['lock']:
+                remaining['count'] -= 1
+                last = remaining['count'] == 0
+            if last:
+                next_threads = self.stages[index + 1][2] if index + 1 < len(self.stages) else 1
+                for _ in range(next_threads):
+                    self._put(target, _DONE)
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def depths(self):
+        """Current number of items waiting in front of every stage and in the output queue."""
+        return {name: q.qsize() for name, q in zip(self.names, self.queues)}
+
+    def depth_summary(self):
+        """Mean and maximum depth of every queue, sampled each time a result was taken."""
+        samples = max(self._samples, 1)
+        return {
+            name: (total / samples, peak)
+            for name, total, peak in zip(self.names, self._depth_totals, self._depth_max)
+        }
+
+    def _sample_depths(self):
+        self._samples += 1
+        for i, q in enumerate(self.queues):
+            depth = q.qsize()
+            self._depth_totals[i] += depth
+            self._depth_max[i] = max(self._depth_max[i], depth)
+
+    def run(self, items):
+        """Start all stages and yield the finished items as they come out of the last stage."""
+        self._threads = [threading.Thread(target=self._feed, args=(items,), daemon=True)]
+        for index, (name, function, num_threads) in enumerate(self.stages):
+            remaining = {'lock': threading.Lock(), 'count': num_threads}
+            self._threads += [
+                threading.Thread(target=self._work, args=(index, function, remaining),
+                                 name=f"{name}-{n}", daemon=True)
+                for n in range(num_threads)
+            ]
+        for thread in self._threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(self.queues[-1])
+                if item is _DONE:
+                    break
+                self._sample_depths()
+                yield item
+        finally:
+            self.close()
+
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """Stop all stage threads, also when the consumer gave up early."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
@@ -4,11 +4,34 @@ import os
 import random
 import json
 from PIL import Image, ImageEnhance, ImageFilter, ImageOps, ImageDraw
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+import itertools
 import argparse
 from tqdm import tqdm
 import copy
+import contextlib
 import math
+import time
+from array_ops import (
+    add_random_shapes_array, add_background_noise_array, gaussian_blur, box_blur,
+    adjust_sharpness, darken_polygon, jpeg_roundtrip, warp_with_matrix, PhotometricStage
+)
+from label_io import iter_label_lines, iter_label_entries, LabelWriter
+from journal import RunJournal, task_key
+import profiling
+from profiling import measure
+import noise_bank
+from noise_bank import default_bank
+import overlay_bank
+from pipeline import StagedPipeline
+from recipes import RecipeWriter
+from scheduler import CostRegistry, DistortionScheduler
+from tiling import strips, iter_strips, resize_rows, strip_rows_for_budget
+from batch_ops import (
+    add_background_noise_batch, gaussian_noise_batch, speckle_noise_batch, attenuate_batch,
+    photometric_batch, jpeg_roundtrip_batch
+)
 
 def add_random_shapes(image, num_shapes=5, opacity_range=(0.1, 0.3)):
     """Add random geometric shapes to the background of an image."""
@@ -89,7 +112,7 @@ def add_background_noise(image, intensity=0.03):
     
     # Generate noise (reduced intensity from 0.05 to 0.03 by default)
     # This creates more subtle noise patterns
-    noise = np.random.normal(0, intensity * 255, img_array.shape).astype(np.int16)
+    noise = default_bank().int_field(img_array.shape, intensity * 255)
     
     # For text-heavy images, we want to preserve text clarity
     # Apply a mask to reduce noise in darker areas (likely text)
@@ -113,243 +136,565 @@ def add_background_noise(image, intensity=0.03):
     return img_array
 
 
-def add_complex_shadows(image, num_shadows=3):
-    """Add multiple complex shadows with gradient edges."""
+def sample_shadow_params(height, width):
+    """Sample the parameters of a single shadow for add_complex_shadows."""
+    shadow_type = random.choice(['radial', 'linear', 'polygon'])
+    opacity = random.uniform(0.1, 0.4)  # Shadow strength
+    params = {'type': shadow_type, 'opacity': opacity}
+    
+    if shadow_type == 'radial':
+        params['center_x'] = random.randint(0, width)
+        params['center_y'] = random.randint(0, height)
+        params['max_radius'] = random.randint(width//6, width//2)
+    
+    elif shadow_type == 'linear':
+        direction = random.choice(['horizontal', 'vertical', 'diagonal'])
+        params['direction'] = direction
+        
+        if direction == 'horizontal':
+            params['start'] = random.randint(0, width)
+            params['extent'] = int(width * random.uniform(0.1, 0.5))
+        
+        elif direction == 'vertical':
+            params['start'] = random.randint(0, height)
+            params['extent'] = int(height * random.uniform(0.1, 0.5))
+        
+        else:  # diagonal
+            params['start_x'] = random.randint(0, width)
+            params['start_y'] = random.randint(0, height)
+            params['angle'] = random.uniform(0, 2 * math.pi)
+            params['extent'] = random.randint(width//4, width//2)
+    
+    else:  # polygon
+        num_points = random.randint(3, 8)
+        params['points'] = [(random.randint(0, width-1), random.randint(0, height-1))
+                            for _ in range(num_points)]
+    
+    return params
+
+def render_shadow_mask(params, height, width, scale=1.0, upsample=True):
+    """
+    Render a shadow mask from parameters produced by sample_shadow_params.
+    
+    Args:
+        params: Shadow parameter dictionary
+        height, width: Size of the image the mask is applied to
+        scale: Resolution factor for building the mask. Values below 1 build the
+            mask on a coarser grid and upsample it, which is much cheaper and
+            visually identical for these low-frequency gradients.
+        upsample: Resize the coarse mask to (height, width). With False the coarse
+            grid is returned, e.g. to be resampled strip by strip.
+    
+    Returns:
+        float32 array of shape (height, width) with values in [0, opacity]
+    """
+    scale = min(max(scale, 0.0), 1.0) or 1.0
+    mask_h = max(1, int(round(height * scale)))
+    mask_w = max(1, int(round(width * scale)))
+    opacity = params['opacity']
+    
+    # Full-resolution coordinates of the pixel centers of the (possibly coarser) grid
+    xs = ((np.arange(mask_w, dtype=np.float32) + 0.5) * (width / mask_w) - 0.5)
+    ys = ((np.arange(mask_h, dtype=np.float32) + 0.5) * (height / mask_h) - 0.5)
+    
+    if params['type'] == 'radial':
+        max_radius = max(params['max_radius'], 1)
+        dx2 = ((xs - params['center_x']) ** 2)[np.newaxis, :]
+        dy2 = ((ys - params['center_y']) ** 2)[:, np.newaxis]
+        distance = np.sqrt(dx2 + dy2)
+        mask = np.clip(1 - distance / max_radius, 0, 1) * opacity
+    
+    elif params['type'] == 'linear':
+        direction = params['direction']
+        extent = params['extent']
+        
+        if extent <= 0:
+            mask = np.zeros((mask_h, mask_w), dtype=np.float32)
+        elif direction == 'horizontal':
+            factor = np.clip(1 - np.abs(xs - params['start']) / extent, 0, 1) * opacity
+            mask = np.broadcast_to(factor[np.newaxis, :], (mask_h, mask_w))
+        elif direction == 'vertical':
+            factor = np.clip(1 - np.abs(ys - params['start']) / extent, 0, 1) * opacity
+            mask = np.broadcast_to(factor[:, np.newaxis], (mask_h, mask_w))
+        else:  # diagonal
+            # Distance from the line through (start_x, start_y) at the given angle
+            angle = params['angle']
+            x_term = ((xs - params['start_x']) * math.sin(angle))[np.newaxis, :]
+            y_term = ((ys - params['start_y']) * math.cos(angle))[:, np.newaxis]
+            distance = np.abs(x_term - y_term)
+            mask = np.clip(1 - distance / extent, 0, 1) * opacity
+        
+        mask = np.ascontiguousarray(mask)
+    
+    else:  # polygon
+        poly_mask = np.zeros((mask_h, mask_w), dtype=np.uint8)
+        points_array = np.array([params['points']], dtype=np.int32)
+        if (mask_h, mask_w) == (height, width):
+            cv2.fillPoly(poly_mask, points_array, 255)
+        else:
+            # Map vertices onto the coarse grid and rasterize them anti-aliased at subpixel precision
+            coarse = points_array.astype(np.float32)
+            coarse[..., 0] = (coarse[..., 0] + 0.5) * (mask_w / width) - 0.5
+            coarse[..., 1] = (coarse[..., 1] + 0.5) * (mask_h / height) - 0.5
+            cv2.fillPoly(poly_mask, np.round(coarse * 16).astype(np.int32), 255,
+                         lineType=cv2.LINE_AA, shift=4)
+        
+        # Add gradient edges, keeping the feather width constant in full-resolution pixels
+        ksize = max(3, int(round(51 * mask_w / width)) | 1)
+        sigma = 0.3 * ((51 - 1) * 0.5 - 1) + 0.8  # OpenCV's default sigma for a 51px kernel
+        poly_mask = cv2.GaussianBlur(poly_mask, (ksize, ksize), sigma * mask_w / width)
+        mask = poly_mask.astype(np.float32) * (opacity / 255.0)
+    
+    mask = mask.astype(np.float32, copy=False)
+    if upsample and mask.shape != (height, width):
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_LINEAR)
+    return mask
+
+def add_complex_shadows(image, num_shadows=3, mask_scale=1.0, inplace=False, strip_rows=None):
+    """
+    Add multiple complex shadows with gradient edges.
+    
+    Args:
+        image: PIL Image or numpy array
+        num_shadows: Number of shadows to add
+        mask_scale: Resolution factor for the shadow masks (see render_shadow_mask)
+        inplace: Darken a numpy input in place instead of a copy
+        strip_rows: Darken strips of this many rows at a time. The masks are then
+            built no larger than one strip and resampled per strip.
+    """
     # Convert to numpy array if needed
     if not isinstance(image, np.ndarray):
         img_array = np.array(image)
+    elif inplace:
+        img_array = image
     else:
         img_array = image.copy()
     
     height, width = img_array.shape[:2]
+    if strip_rows:
+        mask_scale = min(mask_scale, math.sqrt(strip_rows / height))
     
     for _ in range(num_shadows):
-        # Create a shadow mask
-        mask = np.zeros((height, width), dtype=np.float32)
-        
-        # Random shadow parameters
-        shadow_type = random.choice(['radial', 'linear', 'polygon'])
-        opacity = random.uniform(0.1, 0.4)  # Shadow strength
-        
-        if shadow_type == 'radial':
-            # Radial gradient shadow
-            center_x = random.randint(0, width)
-            center_y = random.randint(0, height)
-            max_radius = random.randint(width//6, width//2)
-            
-            y_indices, x_indices = np.ogrid[:height, :width]
-            distance = np.sqrt((x_indices - center_x)**2 + (y_indices - center_y)**2)
-            mask = np.clip(1 - (distance / max_radius), 0, 1) * opacity
+        params = sample_shadow_params(height, width)
+        mask = render_shadow_mask(params, height, width, scale=mask_scale, upsample=not strip_rows)
         
-        elif shadow_type == 'linear':
-            # Linear gradient shadow
-            direction = random.choice(['horizontal', 'vertical', 'diagonal'])
-            
-            if direction == 'horizontal':
-                start = random.randint(0, width)
-                width_factor = random.uniform(0.1, 0.5)
-                shadow_width = int(width * width_factor)
-                
-                for y in range(height):
-                    for x in range(width):
-                        # Distance from start point
-                        distance = abs(x - start)
-                        if distance < shadow_width:
-                            # Gradient factor
-                            factor = 1 - (distance / shadow_width)
-                            mask[y, x] = factor * opacity
-            
-            elif direction == 'vertical':
-                start = random.randint(0, height)
-                height_factor = random.uniform(0.1, 0.5)
-                shadow_height = int(height * height_factor)
-                
-                for y in range(height):
-                    # Distance from start point
-                    distance = abs(y - start)
-                    if distance < shadow_height:
-                        # Gradient factor
-                        factor = 1 - (distance / shadow_height)
-                        mask[y, :] = factor * opacity
-            
-            else:  # diagonal
-                start_x = random.randint(0, width)
-                start_y = random.randint(0, height)
-                angle = random.uniform(0, 2 * math.pi)
-                shadow_length = random.randint(width//4, width//2)
-                
-                for y in range(height):
-                    for x in range(width):
-                        # Distance from line
-                        dist = abs((x - start_x) * math.sin(angle) - (y - start_y) * math.cos(angle))
-                        if dist < shadow_length:
-                            # Gradient factor
-                            factor = 1 - (dist / shadow_length)
-                            mask[y, x] = factor * opacity
-        
-        else:  # polygon
-            # Random polygon shadow
-            num_points = random.randint(3, 8)
-            points = []
-            for _ in range(num_points):
-                x = random.randint(0, width-1)
-                y = random.randint(0, height-1)
-                points.append((x, y))
-            
-            # Create polygon mask
-            poly_mask = np.zeros((height, width), dtype=np.uint8)
-            points_array = np.array([points], dtype=np.int32)
-            cv2.fillPoly(poly_mask, points_array, 255)
+        for y0, y1 in iter_strips(height, strip_rows):
+            band = mask[y0:y1] if not strip_rows else resize_rows(mask, (width, height), y0, y1)
             
-            # Add gradient edges
-            poly_mask = cv2.GaussianBlur(poly_mask, (51, 51), 0)
-            mask += poly_mask / 255.0 * opacity
-        
-        # Apply shadow to image
-        for c in range(3):  # Apply to each color channel
-            img_array[:, :, c] = img_array[:, :, c] * (1 - mask)
+            # Apply shadow to image, truncating back to uint8 like the per-channel version did
+            attenuation = 1 - band
+            if img_array.ndim == 3:
+                attenuation = attenuation[:, :, np.newaxis]
+            strip = img_array[y0:y1]
+            np.multiply(strip, attenuation, out=strip, casting='unsafe')
     
     # Convert back to PIL if needed
     if isinstance(image, Image.Image):
         return Image.fromarray(img_array)
     return img_array
 
-def transform_coordinates(points, transformation, img_shape):
+def add_salt_pepper_noise(img_array, prob, per_channel=False, rng=np.random):
     """
-    Apply a transformation to bounding box coordinates.
+    Add salt-and-pepper noise by sampling only the positions that get flipped.
+    
+    Each pixel independently becomes black with probability prob and white with
+    probability prob, the same as drawing random.random() per pixel. Hit positions
+    are drawn as geometric gaps between consecutive hits, so the cost is
+    proportional to the number of flipped pixels rather than the image size.
     
     Args:
-        points: List of [x, y] coordinates
-        transformation: Dict containing transformation parameters
+        img_array: uint8 numpy array (H, W) or (H, W, C)
+        prob: Probability of a pixel turning black (and, separately, white)
+        per_channel: Flip individual channel values instead of whole pixels
+        rng: numpy random generator or the np.random module
+    
+    Returns:
+        numpy array with noise applied (in place when the input is contiguous)
+    """
+    img_array = np.ascontiguousarray(img_array)
+    if per_channel or img_array.ndim == 2:
+        values = img_array.reshape(-1)
+        black, white = 0, 255
+    else:
+        # One void item per pixel, so a hit writes all channels in a single store
+        channels = img_array.shape[-1]
+        values = img_array.reshape(-1, channels).view(np.dtype((np.void, channels))).reshape(-1)
+        black, white = bytes(channels), b'\xff' * channels
+    
+    total = values.shape[0]
+    hit_prob = min(2 * prob, 1.0)
+    if total == 0 or hit_prob <= 0:
+        return img_array
+    
+    # Draw gaps between hits until the positions run past the end of the image
+    batch = int(total * hit_prob + 4 * math.sqrt(total * hit_prob)) + 16
+    gaps, salt = _salt_pepper_hits(rng, hit_prob, batch)
+    positions = np.cumsum(gaps) - 1
+    while positions[-1] < total:
+        gaps, more_salt = _salt_pepper_hits(rng, hit_prob, batch)
+        positions = np.concatenate([positions, np.cumsum(gaps) + positions[-1]])
+        salt = np.concatenate([salt, more_salt])
+    count = np.searchsorted(positions, total)
+    
+    # Every hit is pepper or salt with equal probability
+    colors = np.array([black, white], dtype=values.dtype)
+    np.put(values, positions[:count], colors[salt[:count].view(np.uint8)])
+    
+    return img_array
+
+def _salt_pepper_hits(rng, prob, size):
+    """
+    Gaps between consecutive hits (geometric with parameter prob) and whether
+    each hit is salt. One uniform draw per hit decides both: its top bit picks
+    salt or pepper and the remaining bits are inverted into the gap, which is
+    several times faster than rng.geometric plus a second draw.
+    """
+    draws = rng.random(size)
+    salt = draws >= 0.5
+    if prob >= 1.0:
+        return np.ones(size, dtype=np.int64), salt
+    
+    # In place: log1p(-u) / log1p(-prob) with u = 2 * draw - salt
+    draws *= 2
+    draws -= salt
+    np.negative(draws, out=draws)
+    np.log1p(draws, out=draws)
+    draws *= 1 / math.log1p(-prob)
+    gaps = draws.astype(np.int64)
+    gaps += 1
+    return gaps, salt
+
+def sample_geometric_matrix(distortion, width, height):
+    """
+    Sample a geometric distortion and return it as a 3x3 homography.
+    
+    Args:
+        distortion: One of 'perspective', 'rotation', 'scale' or 'skew'
+        width, height: Image dimensions
+        
+    Returns:
+        3x3 float64 matrix mapping source pixel coordinates to distorted ones
+    """
+    if distortion == 'perspective':
+        # Define perspective transform parameters (reduced)
+        skew_factor = random.uniform(0.02, 0.1)
+        
+        # Generate random offsets for corners (within skew_factor bounds)
+        offsets = [
+            (random.uniform(-skew_factor, 0), random.uniform(-skew_factor, 0)),  # top-left
+            (random.uniform(0, skew_factor), random.uniform(-skew_factor, 0)),   # top-right
+            (random.uniform(0, skew_factor), random.uniform(0, skew_factor)),    # bottom-right
+            (random.uniform(-skew_factor, 0), random.uniform(0, skew_factor))    # bottom-left
+        ]
+        
+        # Calculate source points (original corners)
+        src_points = np.float32([
+            [0, 0], 
+            [width-1, 0], 
+            [width-1, height-1], 
+            [0, height-1]
+        ])
+        
+        # Calculate destination points (moved corners)
+        dst_points = np.float32([
+            [int(width * offsets[0][0]), int(height * offsets[0][1])],
+            [int(width * (1 + offsets[1][0])), int(height * offsets[1][1])],
+            [int(width * (1 + offsets[2][0])), int(height * (1 + offsets[2][1]))],
+            [int(width * offsets[3][0]), int(height * (1 + offsets[3][1]))]
+        ])
+        
+        return cv2.getPerspectiveTransform(src_points, dst_points)
+    
+    if distortion == 'rotation':
+        # Very slight rotation about the center, counter-clockwise like PIL's rotate
+        angle = random.uniform(-2, 2)
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    
+    elif distortion == 'scale':
+        # Very subtle scaling about the center
+        scale_factor = random.uniform(0.95, 1.05)
+        matrix = np.float64([
+            [scale_factor, 0, (1 - scale_factor) * width / 2],
+            [0, scale_factor, (1 - scale_factor) * height / 2]
+        ])
+    
+    elif distortion == 'skew':
+        # Random skew parameters (reduced range)
+        skew_type = random.choice(['horizontal', 'vertical', 'both'])
+        skew_x = 0
+        skew_y = 0
+        
+        if skew_type == 'horizontal' or skew_type == 'both':
+            skew_x = random.uniform(-0.1, 0.1)
+        if skew_type == 'vertical' or skew_type == 'both':
+            skew_y = random.uniform(-0.1, 0.1)
+        
+        # Horizontal skew followed by vertical skew
+        horizontal = np.float64([[1, skew_x, 0], [0, 1, 0], [0, 0, 1]])
+        vertical = np.float64([[1, 0, 0], [skew_y, 1, 0], [0, 0, 1]])
+        return vertical @ horizontal
+    
+    else:
+        raise ValueError(f"Unknown geometric distortion: {distortion}")
+    
+    return np.vstack([matrix, [0, 0, 1]])
+
+def annotation_points_array(annotations):
+    """
+    Stack the polygons of an image's annotations into one (N, K, 2) array.
+    
+    Polygons with fewer than K points are padded by repeating their last point,
+    which any of the supported transforms maps harmlessly.
+    
+    Args:
+        annotations: List of annotation dictionaries with "points"
+        
+    Returns:
+        tuple: (float64 array of shape (N, K, 2), list of polygon lengths,
+                list of indices of the polygons in annotations)
+    """
+    indices = [
+        i for i, anno in enumerate(annotations)
+        if isinstance(anno, dict) and len(anno.get('points', ())) > 0
+    ]
+    lengths = [len(annotations[i]['points']) for i in indices]
+    max_points = max(lengths, default=0)
+    
+    points = np.empty((len(indices), max_points, 2), dtype=np.float64)
+    for row, (index, length) in enumerate(zip(indices, lengths)):
+        points[row, :length] = annotations[index]['points']
+        points[row, length:] = points[row, length - 1]
+    
+    return points, lengths, indices
+
+def transform_coordinates_batch(points, transformation, img_shape):
+    """
+    Apply a transformation to all annotation polygons of an image at once.
+    
+    Args:
+        points: Array of shape (N, K, 2) with the polygon coordinates
+        transformation: Dict containing transformation parameters, either a composed
+            3x3 homography under 'matrix' or the individual distortion parameters
         img_shape: Original image shape (height, width)
         
     Returns:
-        List of transformed points
+        float64 array of the same shape with transformed, clamped coordinates
     """
     height, width = img_shape[:2]
-    transformed_points = copy.deepcopy(points)
+    points = np.array(points, dtype=np.float64)
+    if points.size == 0:
+        return points
+    flat = points.reshape(-1, 2)
+    center = np.array([width / 2, height / 2])
+    
+    if 'matrix' in transformation:
+        # Apply a composed 3x3 homography (see sample_geometric_matrix)
+        matrix = np.asarray(transformation['matrix'], dtype=np.float64)
+        flat = cv2.perspectiveTransform(flat.reshape(-1, 1, 2), matrix).reshape(-1, 2)
     
     if 'perspective' in transformation:
         # Apply perspective transformation
-        matrix = transformation['perspective']
-        for i, point in enumerate(points):
-            px, py = point
-            # Apply perspective matrix
-            new_x = (matrix[0][0] * px + matrix[0][1] * py + matrix[0][2]) / \
-                   (matrix[2][0] * px + matrix[2][1] * py + matrix[2][2])
-            new_y = (matrix[1][0] * px + matrix[1][1] * py + matrix[1][2]) / \
-                   (matrix[2][0] * px + matrix[2][1] * py + matrix[2][2])
-            transformed_points[i] = [new_x, new_y]
+        matrix = np.asarray(transformation['perspective'], dtype=np.float64)
+        flat = cv2.perspectiveTransform(flat.reshape(-1, 1, 2), matrix).reshape(-1, 2)
     
     if 'rotation' in transformation:
-        # Apply rotation
-        angle = transformation['rotation']
-        center_x, center_y = width / 2, height / 2
-        rad = math.radians(-angle)  # Negative because PIL and OpenCV use opposite rotation directions
+        # Apply rotation about the center
+        rad = math.radians(-transformation['rotation'])  # Negative because PIL and OpenCV use opposite rotation directions
         cos_val = math.cos(rad)
         sin_val = math.sin(rad)
-        
-        for i, point in enumerate(transformed_points):
-            px, py = point
-            # Translate to origin
-            px -= center_x
-            py -= center_y
-            # Rotate
-            new_x = px * cos_val - py * sin_val
-            new_y = px * sin_val + py * cos_val
-            # Translate back
-            new_x += center_x
-            new_y += center_y
-            transformed_points[i] = [new_x, new_y]
+        rotation = np.array([[cos_val, -sin_val], [sin_val, cos_val]])
+        flat = (flat - center) @ rotation.T + center
     
     if 'scale' in transformation:
-        # Apply scaling
-        scale = transformation['scale']
-        center_x, center_y = width / 2, height / 2
-        
-        for i, point in enumerate(transformed_points):
-            px, py = point
-            # Translate to origin
-            px -= center_x
-            py -= center_y
-            # Scale
-            px *= scale
-            py *= scale
-            # Translate back
-            px += center_x
-            py += center_y
-            transformed_points[i] = [px, py]
+        # Apply scaling about the center
+        flat = (flat - center) * transformation['scale'] + center
     
     if 'skew' in transformation:
         # Apply skew transform
         skew_x = transformation['skew'].get('x', 0)
         skew_y = transformation['skew'].get('y', 0)
-        
-        for i, point in enumerate(transformed_points):
-            px, py = point
-            # Apply skew
-            new_x = px + skew_x * py
-            new_y = py + skew_y * px
-            transformed_points[i] = [new_x, new_y]
+        flat = np.column_stack([
+            flat[:, 0] + skew_x * flat[:, 1],
+            flat[:, 1] + skew_y * flat[:, 0]
+        ])
     
     # Ensure coordinates are within image bounds
-    for i, point in enumerate(transformed_points):
-        px, py = point
-        transformed_points[i] = [
-            max(0, min(width - 1, px)),
-            max(0, min(height - 1, py))
-        ]
+    flat = np.column_stack([
+        np.clip(flat[:, 0], 0, width - 1),
+        np.clip(flat[:, 1], 0, height - 1)
+    ])
+    
+    return flat.reshape(points.shape)
+
+def transform_coordinates(points, transformation, img_shape):
+    """
+    Apply a transformation to bounding box coordinates.
     
-    return transformed_points
+    Args:
+        points: List of [x, y] coordinates
+        transformation: Dict containing transformation parameters
+        img_shape: Original image shape (height, width)
+        
+    Returns:
+        List of transformed points
+    """
+    points_array = np.array(points, dtype=np.float64).reshape(1, -1, 2)
+    return transform_coordinates_batch(points_array, transformation, img_shape)[0].tolist()
+
+ALL_DISTORTIONS = [
+    'noise', 'blur', 'lighting', 'compression', 'shadow', 
+    'color_shift', 'perspective', 'rotation', 'scale', 'skew',
+    'sharpness', 'saturation'
+]
+
+# Safe distortions that don't significantly affect coordinates
+SAFE_DISTORTIONS = [
+    'noise', 'blur', 'lighting', 'compression', 
+    'shadow', 'color_shift', 'sharpness', 'saturation'
+]
+
+# Geometric distortions that affect coordinates
+GEOMETRIC_DISTORTIONS = [
+    'perspective', 'rotation', 'scale', 'skew'
+]
+
+def select_distortions():
+    """Randomly select 1-2 distortions, heavily biased toward safe ones."""
+    num_distortions = random.randint(1, 2)
+    # Bias heavily toward safe distortions (90% chance for safe, 10% for geometric)
+    if random.random() < 0.9:
+        # Pick mostly safe distortions, maybe one geometric
+        num_safe = min(num_distortions, random.randint(num_distortions - 1, num_distortions))
+        num_geometric = num_distortions - num_safe
+        
+        distortions = random.sample(SAFE_DISTORTIONS, num_safe)
+        if num_geometric > 0:
+            distortions += random.sample(GEOMETRIC_DISTORTIONS, num_geometric)
+    else:
+        # Pick any distortions
+        distortions = random.sample(ALL_DISTORTIONS, num_distortions)
+    
+    return distortions
+
+def apply_noise_distortion(img_array, strip_rows=None):
+    """
+    Apply a randomly chosen noise type for the 'noise' distortion.
+    
+    With strip_rows the gaussian and speckle noise are added to the array in
+    place, strip by strip.
+    """
+    noise_type = random.choice(['gaussian', 'salt_pepper', 'speckle'])
+    
+    if noise_type == 'gaussian':
+        # Gaussian noise (reduced sigma)
+        sigma = random.uniform(3, 12)
+        # The noise is deliberately cast to uint8 before the saturating add, so negative
+        # values wrap around and whiten the pixel, as this distortion always did
+        if strip_rows:
+            for strip in strips(img_array, strip_rows):
+                noise = default_bank().field(strip.shape, sigma).astype(np.int8).view(np.uint8)
+                cv2.add(strip, noise, dst=strip)
+            return img_array
+        noise = default_bank().field(img_array.shape, sigma).astype(np.int8).view(np.uint8)
+        img_array = cv2.add(img_array, noise)
+    
+    elif noise_type == 'salt_pepper':
+        # Salt and pepper noise (reduced probability)
+        prob = random.uniform(0.005, 0.02)
+        img_array = add_salt_pepper_noise(img_array, prob)
+    
+    elif noise_type == 'speckle':
+        # Speckle noise (reduced intensity)
+        sigma = random.uniform(0.02, 0.1)
+        if strip_rows:
+            for strip in strips(img_array, strip_rows):
+                gain = default_bank().field(strip.shape, sigma)
+                gain += 1
+                cv2.multiply(strip, gain, dst=strip, dtype=cv2.CV_8U)
+            return img_array
+        gain = default_bank().field(img_array.shape, sigma)
+        gain += 1
+        img_array = cv2.multiply(img_array, gain, dtype=cv2.CV_8U)
+    
+    return img_array
+
+def sample_shadow_polygon(height, width):
+    """Sample the polygon and intensity of the light 'shadow' distortion."""
+    num_points = random.randint(3, 5)
+    
+    # Generate random polygon points
+    points = []
+    for _ in range(num_points):
+        x = random.randint(0, width-1)
+        y = random.randint(0, height-1)
+        points.append((x, y))
+    
+    # Very light shadow
+    shadow_intensity = random.uniform(0.75, 0.95)
+    
+    return points, shadow_intensity
+
+def _record(record, key, value):
+    """Store a sampled parameter in record, if the caller asked for one."""
+    if record is not None:
+        record[key] = value
+
+def _copy_annotations(annotations):
+    """Copy annotations so that replacing "points" never touches the originals."""
+    return [
+        dict(anno) if isinstance(anno, dict) else copy.deepcopy(anno) for anno in annotations or []
+    ]
+
+def _update_annotation_points(annotations, transformations, img_shape):
+    """Transform every polygon in one batch, points stay arrays until written out."""
+    if not transformations or not annotations:
+        return
+    
+    points, lengths, indices = annotation_points_array(annotations)
+    points = transform_coordinates_batch(points, transformations, img_shape)
+    for row, (index, length) in enumerate(zip(indices, lengths)):
+        annotations[index]['points'] = points[row, :length]
 
 def apply_distortions_with_tracking(image, annotations, distortions=None, 
-                                   add_shapes=True, add_noise=True, add_shadows=True):
+                                   add_shapes=True, add_noise=True, add_shadows=True,
+                                   shadow_scale=1.0, backend='pil', channel_order='RGB', overlays=None,
+                                   strip_rows=None, record=None):
     """
     Apply various distortions to an image and update coordinate annotations.
     
     Args:
-        image: PIL Image object
+        image: PIL Image object or numpy array
         annotations: List of annotation dictionaries with "points", "transcription", etc.
         distortions: List of distortions to apply, or None for random selection
         add_shapes: Whether to add random shapes to the background
         add_noise: Whether to add background noise
         add_shadows: Whether to add complex shadows
+        shadow_scale: Resolution factor for building shadow masks (1.0 = full resolution)
+        backend: 'pil' to run the chain on PIL Images, 'cv2' to run it on a single
+            uint8 numpy array with OpenCV (a numpy input is updated in place)
+        channel_order: 'RGB' or 'BGR', channel order of a numpy input for the cv2 backend
+        overlays: OverlayBank to take the background shapes and complex shadows
+            from instead of drawing them for this image
+        strip_rows: cv2 backend only, process the image in strips of this many rows
+            to bound the memory of the temporaries (None for full frames)
+        record: Dictionary that receives the sampled parameters (distortion list,
+            warp matrix, factors, JPEG quality, ...) for auditing
     
     Returns:
-        tuple: (PIL Image with distortions applied, updated annotations)
+        tuple: (distorted image, updated annotations). The image is a PIL Image for the
+        pil backend and a numpy array for the cv2 backend. Transformed "points" are
+        numpy arrays, use annotations_to_json when writing them out.
     """
-    all_distortions = [
-        'noise', 'blur', 'lighting', 'compression', 'shadow', 
-        'color_shift', 'perspective', 'rotation', 'scale', 'skew',
-        'sharpness', 'saturation'
-    ]
-    
-    # Safe distortions that don't significantly affect coordinates
-    safe_distortions = [
-        'noise', 'blur', 'lighting', 'compression', 
-        'shadow', 'color_shift', 'sharpness', 'saturation'
-    ]
-    
-    # Geometric distortions that affect coordinates
-    geometric_distortions = [
-        'perspective', 'rotation', 'scale', 'skew'
-    ]
-    
     # If no distortions specified, select 1-2 random ones 
     if distortions is None:
-        num_distortions = random.randint(1, 2)
-        # Bias heavily toward safe distortions (90% chance for safe, 10% for geometric)
-        if random.random() < 0.9:
-            # Pick mostly safe distortions, maybe one geometric
-            num_safe = min(num_distortions, random.randint(num_distortions - 1, num_distortions))
-            num_geometric = num_distortions - num_safe
-            
-            distortions = random.sample(safe_distortions, num_safe)
-            if num_geometric > 0:
-                distortions += random.sample(geometric_distortions, num_geometric)
-        else:
-            # Pick any distortions
-            distortions = random.sample(all_distortions, num_distortions)
+        distortions = select_distortions()
+    _record(record, 'distortions', list(distortions))
+    
+    if backend == 'cv2':
+        return _apply_distortions_array(
+            image, annotations, distortions, add_shapes, add_noise, add_shadows,
+            shadow_scale, channel_order, overlays, strip_rows, record
+        )
     
     # Convert CV2 image to PIL if needed
     if isinstance(image, np.ndarray):
@@ -362,323 +707,1030 @@ def apply_distortions_with_tracking(image, annotations, distortions=None,
     # Track transformations for coordinate updates
     transformations = {}
     
-    # Deep copy annotations to avoid modifying the original
-    updated_annotations = copy.deepcopy(annotations)
+    # Copy annotations to avoid modifying the original
+    updated_annotations = _copy_annotations(annotations)
+    
+    pixels = width * height
     
     # Add background variations first (these don't affect coordinates)
     if add_shapes and random.random() < 0.7:  # 70% chance to add shapes
-        # Add 2-6 random shapes with low opacity
-        num_shapes = random.randint(2, 6)
-        image = add_random_shapes(image, num_shapes, opacity_range=(0.05, 0.2))
+        with measure('shapes', pixels):
+            if overlays is not None:
+                image = Image.fromarray(overlays.apply_shapes(np.array(image)))
+            else:
+                # Add 2-6 random shapes with low opacity
+                num_shapes = random.randint(2, 6)
+                _record(record, 'shapes', num_shapes)
+                image = add_random_shapes(image, num_shapes, opacity_range=(0.05, 0.2))
     
     if add_noise and random.random() < 0.8:  # 80% chance to add noise
-        # Add subtle background noise
-        intensity = random.uniform(0.01, 0.05)
-        img_array = np.array(image)
-        img_array = add_background_noise(img_array, intensity)
-        image = Image.fromarray(img_array)
-    
-    if add_shadows and random.random() < 0.6:  # 60% chance to add shadows
-        # Add 1-3 complex shadows
-        num_shadows = random.randint(1, 3)
-        img_array = np.array(image)
-        img_array = add_complex_shadows(img_array, num_shadows)
-        image = Image.fromarray(img_array)
-    
-    # Apply selected distortions
-    for distortion in distortions:
-        if distortion == 'noise':
-            # Add random noise (gentle)
-            img_array = np.array(image)
-            noise_type = random.choice(['gaussian', 'salt_pepper', 'speckle'])
-            
-            if noise_type == 'gaussian':
-                # Gaussian noise (reduced sigma)
-                mean = 0
-                sigma = random.uniform(3, 12)
-                noise = np.random.normal(mean, sigma, img_array.shape).astype(np.uint8)
-                img_array = cv2.add(img_array, noise)
-            
-            elif noise_type == 'salt_pepper':
-                # Salt and pepper noise (reduced probability)
-                prob = random.uniform(0.005, 0.02)
-                thres = 1 - prob
-                for i in range(img_array.shape[0]):
-                    for j in range(img_array.shape[1]):
-                        rdn = random.random()
-                        if rdn < prob:
-                            img_array[i][j] = 0
-                        elif rdn > thres:
-                            img_array[i][j] = 255
-            
-            elif noise_type == 'speckle':
-                # Speckle noise (reduced intensity)
-                gauss = np.random.normal(0, random.uniform(0.02, 0.1), img_array.shape)
-                img_array = img_array + img_array * gauss
-                img_array = np.clip(img_array, 0, 255).astype(np.uint8)
-            
-            image = Image.fromarray(img_array)
-        
-        elif distortion == 'blur':
-            # Apply blur (gentle)
-            blur_type = random.choice(['gaussian', 'box'])
-            
-            if blur_type == 'gaussian':
-                # Gaussian blur (reduced radius)
-                radius = random.uniform(0.3, 1.5)
-                image = image.filter(ImageFilter.GaussianBlur(radius))
-            
-            elif blur_type == 'box':
-                # Box blur (smaller radius)
-                radius = random.randint(1, 2)
-                image = image.filter(ImageFilter.BoxBlur(radius))
-        
-        elif distortion == 'lighting':
-            # Adjust brightness and contrast (conservative)
-            brightness_factor = random.uniform(0.85, 1.15)
-            contrast_factor = random.uniform(0.85, 1.15)
-            
-            # Apply brightness adjustment
-            enhancer = ImageEnhance.Brightness(image)
-            image = enhancer.enhance(brightness_factor)
-            
-            # Apply contrast adjustment
-            enhancer = ImageEnhance.Contrast(image)
-            image = enhancer.enhance(contrast_factor)
-        
-        elif distortion == 'compression':
-            # Simulate JPEG compression artifacts (high quality)
-            quality = random.randint(50, 85)
+        with measure('background_noise', pixels):
+            # Add subtle background noise
+            intensity = random.uniform(0.01, 0.05)
+            _record(record, 'background_noise', intensity)
             img_array = np.array(image)
-            
-            # OpenCV compression
-            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
-            result, encimg = cv2.imencode('.jpg', img_array, encode_param)
-            img_array = cv2.imdecode(encimg, 1)
-            
+            img_array = add_background_noise(img_array, intensity)
             image = Image.fromarray(img_array)
-        
-        elif distortion == 'shadow':
-            # Add very light shadow to part of the image
-            img_array = np.array(image)
-            
-            # Create a random polygon for the shadow
-            height, width = img_array.shape[:2]
-            num_points = random.randint(3, 5)
-            
-            # Generate random polygon points
-            points = []
-            for _ in range(num_points):
-                x = random.randint(0, width-1)
-                y = random.randint(0, height-1)
-                points.append((x, y))
-            
-            # Create a mask from the polygon
-            mask = np.zeros((height, width), dtype=np.uint8)
-            points_array = np.array([points], dtype=np.int32)
-            cv2.fillPoly(mask, points_array, 255)
-            
-            # Apply shadow by reducing brightness (very light shadow)
-            shadow_intensity = random.uniform(0.75, 0.95)
-            
-            # Apply the shadow using the mask
-            img_array = img_array.astype(np.float32)
-            img_array[mask == 255] = img_array[mask == 255] * shadow_intensity
-            
-            img_array = np.clip(img_array, 0, 255).astype(np.uint8)
-            image = Image.fromarray(img_array)
-        
-        elif distortion == 'color_shift':
-            # Adjust color channels (small adjustments)
+    
+    if add_shadows and random.random() < 0.6:  # 60% chance to add shadows
+        with measure('complex_shadows', pixels):
+            # Add 1-3 complex shadows
+            num_shadows = random.randint(1, 3)
+            _record(record, 'complex_shadows', num_shadows)
             img_array = np.array(image)
-            
-            # If grayscale, convert to RGB
-            if len(img_array.shape) == 2:
-                img_array = cv2.cvtColor(img_array, cv2.COLOR_GRAY2RGB)
-            
-            # Random color offset for each channel (reduced range)
-            channels = cv2.split(img_array)
-            adjusted_channels = []
-            
-            for channel in channels:
-                offset = random.randint(-15, 15)
-                adjusted = channel.astype(np.int16) + offset
-                adjusted = np.clip(adjusted, 0, 255).astype(np.uint8)
-                adjusted_channels.append(adjusted)
-            
-            img_array = cv2.merge(adjusted_channels)
+            if overlays is not None:
+                overlays.apply_shadows(img_array, num_shadows)
+            else:
+                img_array = add_complex_shadows(img_array, num_shadows, mask_scale=shadow_scale)
             image = Image.fromarray(img_array)
-        
-        elif distortion == 'perspective':
-            # Apply perspective transformation (gentle)
-            img_array = np.array(image)
+    
+    # Geometric distortions are accumulated here and applied in a single warp
+    geometric_matrix = np.eye(3)
+    last_geometric = max(
+        (i for i, name in enumerate(distortions) if name in GEOMETRIC_DISTORTIONS), default=-1
+    )
+    
+    # Apply selected distortions
+    for index, distortion in enumerate(distortions):
+        with measure(distortion, pixels):
+            if distortion == 'noise':
+                # Add random noise (gentle)
+                img_array = apply_noise_distortion(np.array(image))
+                image = Image.fromarray(img_array)
             
-            # Define perspective transform parameters (reduced)
-            skew_factor = random.uniform(0.02, 0.1)
+            elif distortion == 'blur':
+                # Apply blur (gentle)
+                blur_type = random.choice(['gaussian', 'box'])
+                
+                if blur_type == 'gaussian':
+                    # Gaussian blur (reduced radius)
+                    radius = random.uniform(0.3, 1.5)
+                    _record(record, 'blur', (blur_type, radius))
+                    image = image.filter(ImageFilter.GaussianBlur(radius))
+                
+                elif blur_type == 'box':
+                    # Box blur (smaller radius)
+                    radius = random.randint(1, 2)
+                    _record(record, 'blur', (blur_type, radius))
+                    image = image.filter(ImageFilter.BoxBlur(radius))
             
-            # Generate random offsets for corners (within skew_factor bounds)
-            offsets = [
-                (random.uniform(-skew_factor, 0), random.uniform(-skew_factor, 0)),  # top-left
-                (random.uniform(0, skew_factor), random.uniform(-skew_factor, 0)),   # top-right
-                (random.uniform(0, skew_factor), random.uniform(0, skew_factor)),    # bottom-right
-                (random.uniform(-skew_factor, 0), random.uniform(0, skew_factor))    # bottom-left
-            ]
+            elif distortion == 'lighting':
+                # Adjust brightness and contrast (conservative)
+                brightness_factor = random.uniform(0.85, 1.15)
+                contrast_factor = random.uniform(0.85, 1.15)
+                _record(record, 'lighting', (brightness_factor, contrast_factor))
+                
+                # Apply brightness adjustment
+                enhancer = ImageEnhance.Brightness(image)
+                image = enhancer.enhance(brightness_factor)
+                
+                # Apply contrast adjustment
+                enhancer = ImageEnhance.Contrast(image)
+                image = enhancer.enhance(contrast_factor)
             
-            # Calculate source points (original corners)
-            src_points = np.float32([
-                [0, 0], 
-                [width-1, 0], 
-                [width-1, height-1], 
-                [0, height-1]
-            ])
+            elif distortion == 'compression':
+                # Simulate JPEG compression artifacts (high quality)
+                quality = random.randint(50, 85)
+                _record(record, 'compression', quality)
+                img_array = np.array(image)
+                
+                # OpenCV compression
+                encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+                result, encimg = cv2.imencode('.jpg', img_array, encode_param)
+                img_array = cv2.imdecode(encimg, 1)
+                
+                image = Image.fromarray(img_array)
             
-            # Calculate destination points (moved corners)
-            dst_points = np.float32([
-                [int(width * offsets[0][0]), int(height * offsets[0][1])],
-                [int(width * (1 + offsets[1][0])), int(height * offsets[1][1])],
-                [int(width * (1 + offsets[2][0])), int(height * (1 + offsets[2][1]))],
-                [int(width * offsets[3][0]), int(height * (1 + offsets[3][1]))]
-            ])
+            elif distortion == 'shadow':
+                # Add very light shadow to part of the image
+                img_array = np.array(image)
+                
+                # Create a random polygon for the shadow
+                points, shadow_intensity = sample_shadow_polygon(height, width)
+                _record(record, 'shadow', shadow_intensity)
+                
+                # Create a mask from the polygon
+                mask = np.zeros((height, width), dtype=np.uint8)
+                points_array = np.array([points], dtype=np.int32)
+                cv2.fillPoly(mask, points_array, 255)
+                
+                # Apply the shadow using the mask
+                img_array = img_array.astype(np.float32)
+                img_array[mask == 255] = img_array[mask == 255] * shadow_intensity
+                
+                img_array = np.clip(img_array, 0, 255).astype(np.uint8)
+                image = Image.fromarray(img_array)
             
-            # Calculate perspective transform matrix
-            transform_matrix = cv2.getPerspectiveTransform(src_points, dst_points)
+            elif distortion == 'color_shift':
+                # Adjust color channels (small adjustments)
+                img_array = np.array(image)
+                
+                # If grayscale, convert to RGB
+                if len(img_array.shape) == 2:
+                    img_array = cv2.cvtColor(img_array, cv2.COLOR_GRAY2RGB)
+                
+                # Random color offset for each channel (reduced range)
+                channels = cv2.split(img_array)
+                adjusted_channels = []
+                
+                offsets = []
+                for channel in channels:
+                    offset = random.randint(-15, 15)
+                    offsets.append(offset)
+                    adjusted = channel.astype(np.int16) + offset
+                    adjusted = np.clip(adjusted, 0, 255).astype(np.uint8)
+                    adjusted_channels.append(adjusted)
+                
+                _record(record, 'color_shift', offsets)
+                img_array = cv2.merge(adjusted_channels)
+                image = Image.fromarray(img_array)
             
-            # Apply perspective transform
-            img_array = cv2.warpPerspective(
-                img_array, transform_matrix, (width, height),
-                borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255)
-            )
+            elif distortion in GEOMETRIC_DISTORTIONS:
+                # Compose geometric distortions into one homography instead of resampling per step
+                geometric_matrix = sample_geometric_matrix(distortion, width, height) @ geometric_matrix
+                
+                # Warp once, at the position of the last geometric distortion in the chain
+                if index == last_geometric:
+                    img_array = warp_with_matrix(np.array(image), geometric_matrix)
+                    
+                    # Store transformation for coordinate updates
+                    transformations['matrix'] = geometric_matrix
+                    _record(record, 'matrix', geometric_matrix)
+                    
+                    image = Image.fromarray(img_array)
             
-            # Store transformation for coordinate updates
-            transformations['perspective'] = transform_matrix
+            elif distortion == 'sharpness':
+                # Adjust sharpness (conservative)
+                factor = random.uniform(0.8, 1.2)
+                _record(record, 'sharpness', factor)
+                enhancer = ImageEnhance.Sharpness(image)
+                image = enhancer.enhance(factor)
             
-            image = Image.fromarray(img_array)
+            elif distortion == 'saturation':
+                # Adjust color saturation (conservative)
+                factor = random.uniform(0.9, 1.1)
+                _record(record, 'saturation', factor)
+                enhancer = ImageEnhance.Color(image)
+                image = enhancer.enhance(factor)
+    
+    # Apply transformations to all annotation coordinates
+    _update_annotation_points(updated_annotations, transformations, img_shape)
+    
+    return image, updated_annotations
+
+def _apply_distortions_array(image, annotations, distortions, add_shapes, add_noise, add_shadows,
+                             shadow_scale, channel_order, overlays=None, strip_rows=None, record=None):
+    """
+    cv2 backend of apply_distortions_with_tracking.
+    
+    Keeps one contiguous uint8 array for the whole chain and draws the same random
+    parameters as the PIL path, so both produce the same distribution of outputs.
+    With strip_rows every operation that needs full-frame temporaries runs on
+    strips of that many rows (see tiling).
+    """
+    if isinstance(image, Image.Image):
+        img_array = np.array(image)
+        channel_order = 'RGB'
+    else:
+        img_array = np.ascontiguousarray(image)
+    
+    height, width = img_array.shape[:2]
+    img_shape = (height, width)
+    pixels = width * height
+    transformations = {}
+    updated_annotations = _copy_annotations(annotations)
+    
+    # Add background variations first (these don't affect coordinates)
+    if add_shapes and random.random() < 0.7:  # 70% chance to add shapes
+        with measure('shapes', pixels):
+            if overlays is not None:
+                overlays.apply_shapes(img_array, strip_rows)
+            else:
+                num_shapes = random.randint(2, 6)
+                _record(record, 'shapes', num_shapes)
+                add_random_shapes_array(img_array, num_shapes, opacity_range=(0.05, 0.2))
+    
+    if add_noise and random.random() < 0.8:  # 80% chance to add noise
+        with measure('background_noise', pixels):
+            intensity = random.uniform(0.01, 0.05)
+            _record(record, 'background_noise', intensity)
+            add_background_noise_array(img_array, intensity, channel_order, strip_rows)
+    
+    if add_shadows and random.random() < 0.6:  # 60% chance to add shadows
+        with measure('complex_shadows', pixels):
+            num_shadows = random.randint(1, 3)
+            _record(record, 'complex_shadows', num_shadows)
+            if overlays is not None:
+                overlays.apply_shadows(img_array, num_shadows, strip_rows)
+            else:
+                add_complex_shadows(img_array, num_shadows, mask_scale=shadow_scale, inplace=True,
+                                    strip_rows=strip_rows)
+    
+    # Geometric distortions are accumulated here and applied in a single warp
+    geometric_matrix = np.eye(3)
+    last_geometric = max(
+        (i for i, name in enumerate(distortions) if name in GEOMETRIC_DISTORTIONS), default=-1
+    )
+    
+    # Lighting, color shift and saturation are collected and applied in one pass
+    photometric = PhotometricStage(channel_order)
+    
+    for index, distortion in enumerate(distortions):
+        # Distortions that read or move pixels need the pending color operations applied first
+        if photometric.pending and (distortion in ('noise', 'blur', 'compression', 'shadow') or index == last_geometric):
+            with measure('photometric', pixels):
+                photometric.apply(img_array, strip_rows)
         
-        elif distortion == 'rotation':
-            # Apply very slight rotation
-            angle = random.uniform(-2, 2)
-            image = image.rotate(angle, resample=Image.BICUBIC, expand=False, fillcolor='white')
+        with measure(distortion, pixels):
+            if distortion == 'lighting':
+                brightness_factor = random.uniform(0.85, 1.15)
+                contrast_factor = random.uniform(0.85, 1.15)
+                _record(record, 'lighting', (brightness_factor, contrast_factor))
+                photometric.brightness(brightness_factor)
+                photometric.contrast(img_array, contrast_factor)
             
-            # Store transformation for coordinate updates
-            transformations['rotation'] = angle
-        
-        elif distortion == 'scale':
-            # Very subtle scaling
-            scale_factor = random.uniform(0.95, 1.05)
-            width, height = image.size
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-            image = image.resize((new_width, new_height), Image.LANCZOS)
+            elif distortion == 'color_shift':
+                offsets = [random.randint(-15, 15) for _ in range(img_array.shape[2])]
+                _record(record, 'color_shift', offsets)
+                photometric.shift(offsets)
             
-            # Resize back to original size if needed
-            if scale_factor != 1.0:
-                # Create a white background
-                bg = Image.new('RGB', (width, height), (255, 255, 255))
-                # Paste the scaled image centered
-                offset_x = (width - new_width) // 2
-                offset_y = (height - new_height) // 2
-                bg.paste(image, (offset_x, offset_y))
-                image = bg
+            elif distortion == 'saturation':
+                factor = random.uniform(0.9, 1.1)
+                _record(record, 'saturation', factor)
+                photometric.saturation(factor)
             
-            # Store transformation for coordinate updates
-            transformations['scale'] = scale_factor
-        
-        elif distortion == 'skew':
-            # Apply gentler skew transformation
-            img_array = np.array(image)
-            rows, cols = img_array.shape[:2]
+            elif distortion == 'sharpness':
+                # A normalized linear filter commutes with the pending color operations
+                factor = random.uniform(0.8, 1.2)
+                _record(record, 'sharpness', factor)
+                adjust_sharpness(img_array, factor, strip_rows)
             
-            # Random skew parameters (reduced range)
-            skew_type = random.choice(['horizontal', 'vertical', 'both'])
-            skew_x = 0
-            skew_y = 0
+            elif distortion in GEOMETRIC_DISTORTIONS:
+                geometric_matrix = sample_geometric_matrix(distortion, width, height) @ geometric_matrix
+                if index == last_geometric:
+                    img_array = warp_with_matrix(img_array, geometric_matrix, strip_rows)
+                    transformations['matrix'] = geometric_matrix
+                    _record(record, 'matrix', geometric_matrix)
             
-            if skew_type == 'horizontal' or skew_type == 'both':
-                # Horizontal skew (reduced)
-                skew_x = random.uniform(-0.1, 0.1)
-                M = np.float32([[1, skew_x, 0], [0, 1, 0]])
-                img_array = cv2.warpAffine(img_array, M, (cols, rows), 
-                                         borderMode=cv2.BORDER_CONSTANT, 
-                                         borderValue=(255, 255, 255))
+            elif distortion == 'noise':
+                img_array = apply_noise_distortion(img_array, strip_rows)
             
-            if skew_type == 'vertical' or skew_type == 'both':
-                # Vertical skew (reduced)
-                skew_y = random.uniform(-0.1, 0.1)
-                M = np.float32([[1, 0, 0], [skew_y, 1, 0]])
-                img_array = cv2.warpAffine(img_array, M, (cols, rows), 
-                                         borderMode=cv2.BORDER_CONSTANT, 
-                                         borderValue=(255, 255, 255))
+            elif distortion == 'blur':
+                blur_type = random.choice(['gaussian', 'box'])
+                if blur_type == 'gaussian':
+                    radius = random.uniform(0.3, 1.5)
+                    gaussian_blur(img_array, radius, strip_rows)
+                else:
+                    radius = random.randint(1, 2)
+                    box_blur(img_array, radius, strip_rows)
+                _record(record, 'blur', (blur_type, radius))
             
-            # Store transformation for coordinate updates
-            transformations['skew'] = {'x': skew_x, 'y': skew_y}
+            elif distortion == 'compression':
+                quality = random.randint(50, 85)
+                _record(record, 'compression', quality)
+                img_array = jpeg_roundtrip(img_array, quality, strip_rows)
             
-            image = Image.fromarray(img_array)
-        
-        elif distortion == 'sharpness':
-            # Adjust sharpness (conservative)
-            factor = random.uniform(0.8, 1.2)
-            enhancer = ImageEnhance.Sharpness(image)
-            image = enhancer.enhance(factor)
-        
-        elif distortion == 'saturation':
-            # Adjust color saturation (conservative)
-            factor = random.uniform(0.9, 1.1)
-            enhancer = ImageEnhance.Color(image)
-            image = enhancer.enhance(factor)
+            elif distortion == 'shadow':
+                points, shadow_intensity = sample_shadow_polygon(height, width)
+                _record(record, 'shadow', shadow_intensity)
+                darken_polygon(img_array, points, shadow_intensity, strip_rows)
     
-    # Apply transformations to all annotation coordinates
-    if transformations and updated_annotations:
-        for i, anno in enumerate(updated_annotations):
-            # Make sure we're accessing the correct structure based on your annotation format
-            if isinstance(anno, dict) and 'points' in anno:
-                points = anno['points']
-                transformed_points = transform_coordinates(points, transformations, img_shape)
-                updated_annotations[i]['points'] = transformed_points
+    if photometric.pending:
+        with measure('photometric', pixels):
+            photometric.apply(img_array, strip_rows)
+    
+    _update_annotation_points(updated_annotations, transformations, img_shape)
+    
+    return img_array, updated_annotations
+
+# Fixed order of the distortions in the batched chain, every kind runs once per batch
+BATCH_ORDER = ['lighting', 'color_shift', 'saturation', 'sharpness'] + GEOMETRIC_DISTORTIONS + [
+    'shadow', 'blur', 'noise', 'compression'
+]
+
+# Samples per batched call are capped at about this many pixels, so the float32
+# temporaries of a call stay cache sized instead of spanning the whole batch
+BATCH_CHUNK_PIXELS = 1 << 18
+
+def _sample_chunks(indices, pixels):
+    """Split a list of sample indices into slices of about BATCH_CHUNK_PIXELS."""
+    step = max(1, BATCH_CHUNK_PIXELS // pixels)
+    for start in range(0, len(indices), step):
+        yield slice(start, start + step)
+
+def _apply_to_subset(batch, indices, function, *args):
+    """Run a batch operation on the samples at indices, on a view if they are consecutive."""
+    if indices[-1] - indices[0] == len(indices) - 1:
+        function(batch[indices[0]:indices[-1] + 1], *args)
+    else:
+        subset = batch[indices]
+        function(subset, *args)
+        batch[indices] = subset
+
+def apply_distortions_batch(batch, annotations_list, distortion_prob=0.5, shadow_scale=1.0,
+                            channel_order='BGR', overlays=None):
+    """
+    Batched cv2 distortion chain for a stack of same-size images.
+    
+    Every sample draws its own parameters like _augment_decoded does: whether it is
+    distorted at all, its background effects and its 1-2 distortions. The
+    distortions are applied in BATCH_ORDER instead of their drawn order, so that
+    each kind runs once for all samples that drew it, see batch_ops.
+    
+    Args:
+        batch: Contiguous uint8 array (N, H, W, 3), distorted in place
+        annotations_list: Annotations of every sample
+        distortion_prob: Probability of distorting a sample
+        shadow_scale: Resolution factor for building shadow masks
+        channel_order: 'RGB' or 'BGR' channel order of the batch
+        overlays: OverlayBank for the background shapes and complex shadows
+    
+    Returns:
+        list: Updated annotations of every sample
+    """
+    n, height, width = batch.shape[:3]
+    pixels = height * width
+    results = list(annotations_list)
+    active = [i for i in range(n) if random.random() < distortion_prob]
+    if not active:
+        return results
+    
+    # Background variations first (these don't affect coordinates)
+    for i in active:
+        if random.random() < 0.7:  # 70% chance to add shapes
+            with measure('shapes', pixels):
+                if overlays is not None:
+                    overlays.apply_shapes(batch[i])
+                else:
+                    add_random_shapes_array(batch[i], random.randint(2, 6), opacity_range=(0.05, 0.2))
+    
+    noisy = [i for i in active if random.random() < 0.8]  # 80% chance to add noise
+    if noisy:
+        with measure('background_noise', pixels * len(noisy)):
+            intensities = [random.uniform(0.01, 0.05) for _ in noisy]
+            for part in _sample_chunks(noisy, pixels):
+                _apply_to_subset(batch, noisy[part], add_background_noise_batch, intensities[part], channel_order)
+    
+    shadowed = [i for i in active if random.random() < 0.6]  # 60% chance to add shadows
+    if shadowed:
+        with measure('complex_shadows', pixels * len(shadowed)):
+            if overlays is not None:
+                for i in shadowed:
+                    overlays.apply_shadows(batch[i], random.randint(1, 3))
+            else:
+                for part in _sample_chunks(shadowed, pixels):
+                    attenuations = np.ones((len(shadowed[part]), height, width), dtype=np.float32)
+                    for attenuation in attenuations:
+                        for _ in range(random.randint(1, 3)):
+                            params = sample_shadow_params(height, width)
+                            attenuation *= 1 - render_shadow_mask(params, height, width, scale=shadow_scale)
+                    _apply_to_subset(batch, shadowed[part], attenuate_batch, attenuations)
+    
+    drawn = {i: select_distortions() for i in active}
+    by_kind = {name: [i for i in active if name in drawn[i]] for name in BATCH_ORDER}
+    transformations = {}
     
+    # Lighting, color shift and saturation of every sample fold into one photometric pass
+    stages = [None] * n
+    for name in ('lighting', 'color_shift', 'saturation'):
+        for i in by_kind[name]:
+            stage = stages[i] = stages[i] or PhotometricStage(channel_order)
+            if name == 'lighting':
+                stage.brightness(random.uniform(0.85, 1.15))
+                stage.contrast(batch[i], random.uniform(0.85, 1.15))
+            elif name == 'color_shift':
+                stage.shift([random.randint(-15, 15) for _ in range(batch.shape[3])])
+            else:
+                stage.saturation(random.uniform(0.9, 1.1))
+    staged = sum(stage is not None for stage in stages)
+    if staged:
+        with measure('photometric', pixels * staged):
+            photometric_batch(batch, stages)
+    
+    for i in by_kind['sharpness']:
+        with measure('sharpness', pixels):
+            adjust_sharpness(batch[i], random.uniform(0.8, 1.2))
+    
+    # Geometric distortions of a sample are composed into one warp
+    for i in active:
+        geometric = [name for name in GEOMETRIC_DISTORTIONS if name in drawn[i]]
+        if geometric:
+            with measure(geometric[-1], pixels):
+                matrix = np.eye(3)
+                for name in geometric:
+                    matrix = sample_geometric_matrix(name, width, height) @ matrix
+                batch[i] = warp_with_matrix(batch[i], matrix)
+                transformations[i] = {'matrix': matrix}
+    
+    for i in by_kind['shadow']:
+        with measure('shadow', pixels):
+            points, shadow_intensity = sample_shadow_polygon(height, width)
+            darken_polygon(batch[i], points, shadow_intensity)
+    
+    for i in by_kind['blur']:
+        with measure('blur', pixels):
+            if random.choice(['gaussian', 'box']) == 'gaussian':
+                gaussian_blur(batch[i], random.uniform(0.3, 1.5))
+            else:
+                box_blur(batch[i], random.randint(1, 2))
+    
+    if by_kind['noise']:
+        with measure('noise', pixels * len(by_kind['noise'])):
+            noise_types = {'gaussian': [], 'salt_pepper': [], 'speckle': []}
+            for i in by_kind['noise']:
+                noise_types[random.choice(['gaussian', 'salt_pepper', 'speckle'])].append(i)
+            for noise_type, function, sigma_range in (('gaussian', gaussian_noise_batch, (3, 12)),
+                                                      ('speckle', speckle_noise_batch, (0.02, 0.1))):
+                indices = noise_types[noise_type]
+                sigmas = [random.uniform(*sigma_range) for _ in indices]
+                for part in _sample_chunks(indices, pixels):
+                    _apply_to_subset(batch, indices[part], function, sigmas[part])
+            for i in noise_types['salt_pepper']:
+                add_salt_pepper_noise(batch[i], random.uniform(0.005, 0.02))
+    
+    if by_kind['compression']:
+        with measure('compression', pixels * len(by_kind['compression'])):
+            qualities = [random.randint(50, 85) for _ in by_kind['compression']]
+            _apply_to_subset(batch, by_kind['compression'], jpeg_roundtrip_batch, qualities)
+    
+    for i, transformation in transformations.items():
+        results[i] = _copy_annotations(results[i])
+        _update_annotation_points(results[i], transformation, (height, width))
+    
+    return results
+
+def downscale_to_long_side(image, annotations, target_long_side):
+    """
+    Shrink an image so that its longer side is at most target_long_side.
+    
+    The image is resized once with an area filter and the annotation points are
+    scaled to match. Images that are already small enough are returned as is.
+    
+    Returns:
+        tuple: (numpy array, annotations)
+    """
+    height, width = image.shape[:2]
+    scale = target_long_side / max(height, width)
+    if scale >= 1:
+        return image, annotations
+    
+    new_width = max(1, int(round(width * scale)))
+    new_height = max(1, int(round(height * scale)))
+    image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
+    
+    updated_annotations = _copy_annotations(annotations)
+    matrix = np.diag([new_width / width, new_height / height, 1.0])
+    _update_annotation_points(updated_annotations, {'matrix': matrix}, (new_height, new_width))
     return image, updated_annotations
 
-def preprocess_image_with_annotations(image_path, output_path, annotation_data, distortion_prob=0.5):
-    """Process a single image and update its annotations."""
+def _augment_decoded(image, annotations, distortion_prob=0.5, shadow_scale=1.0, backend='cv2',
+                     use_overlay_bank=False, memory_budget_mb=None, record=None, plan=None):
+    """
+    Distort a decoded BGR image with probability distortion_prob.
+    
+    With the cv2 backend the array is distorted in place. The pil backend converts
+    to a PIL Image and back. With use_overlay_bank the background shapes and
+    complex shadows come from the process-wide overlay bank. With memory_budget_mb
+    the cv2 backend switches to strips for images whose temporaries would not fit.
+    A record dictionary receives the sampled parameters of the chain. A plan from
+    DistortionScheduler.plan fixes whether and how the image is distorted.
+    
+    Returns:
+        tuple: (BGR numpy array, updated annotations)
+    """
+    overlays = overlay_bank.default_bank() if use_overlay_bank else None
+    strip_rows = None
+    if memory_budget_mb:
+        strip_rows = strip_rows_for_budget(image.shape, memory_budget_mb * 1024 * 1024)
+    
+    if plan is None:
+        plan = {'distort': random.random() < distortion_prob, 'distortions': None,
+                'add_shapes': True, 'add_noise': True, 'add_shadows': True}
+    
+    if backend == 'cv2':
+        if plan['distort']:
+            return apply_distortions_with_tracking(
+                image, annotations, plan['distortions'],
+                add_shapes=plan['add_shapes'],
+                add_noise=plan['add_noise'],
+                add_shadows=plan['add_shadows'],
+                shadow_scale=shadow_scale,
+                backend='cv2',
+                channel_order='BGR',
+                overlays=overlays,
+                strip_rows=strip_rows,
+                record=record
+            )
+        return image, annotations
+    
+    # Convert to PIL image for processing
+    image_pil = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    updated_annotations = annotations
+    
+    # Apply distortions with probability
+    if plan['distort']:
+        # Apply distortions and track coordinate changes
+        image_pil, updated_annotations = apply_distortions_with_tracking(
+            image_pil, annotations, plan['distortions'],
+            add_shapes=plan['add_shapes'],
+            add_noise=plan['add_noise'],
+            add_shadows=plan['add_shadows'],
+            shadow_scale=shadow_scale,
+            overlays=overlays,
+            record=record
+        )
+    
+    # Convert back to OpenCV format
+    return cv2.cvtColor(np.array(image_pil), cv2.COLOR_RGB2BGR), updated_annotations
+
+def augment_from_seed(image_path, annotation_data, seed, distortion_prob=0.5, record=None,
+                      target_long_side=None, **options):
+    """
+    Decode and augment an image with all random generators seeded from seed.
+    
+    The same source, seed, options and noise bank always give the same image and
+    annotations, which is what recipe files rely on (see recipes). Only call it
+    from one thread per process, the seed is set on the global generators.
+    
+    Args:
+        image_path: Source image
+        annotation_data: Annotations of the source image
+        seed: Seed of the python and numpy random generators
+        distortion_prob: Probability of distorting the image
+        record: Dictionary that receives the sampled parameters
+        target_long_side, **options: See preprocess_image_variants
+    
+    Returns:
+        tuple: (BGR numpy array or None if unreadable, annotations)
+    """
+    image, annotation_data = _load_image(image_path, annotation_data, target_long_side)
+    if image is None:
+        return None, annotation_data
+    return _augment_seeded(image, annotation_data, seed, distortion_prob, record, **options)
+
+def _augment_seeded(image, annotations, seed, distortion_prob, record=None, **options):
+    """_augment_decoded with the python and numpy generators seeded from seed."""
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    return _augment_decoded(image, annotations, distortion_prob, record=record, **options)
+
+def _new_seed():
+    """A seed drawn from OS entropy, independent of the reseeded global generators."""
+    return int.from_bytes(os.urandom(8), 'little') >> 1
+
+def variant_recipes(image_path, output_paths, annotation_data, distortion_prob=0.5,
+                    target_long_side=None, plans=None, **options):
+    """
+    Recipe mode counterpart of preprocess_image_variants: augment every variant
+    from a fresh seed and return its recipe instead of writing the pixels.
+    
+    The image is still decoded once and augmented, which yields the transformed
+    annotations and the sampled parameters, but nothing is encoded or written.
+    
+    Returns:
+        List of (output_path, updated annotations, recipe), or None if the image
+        could not be processed
+    """
     try:
-        # Load the image
-        image = cv2.imread(image_path)
+        image, source_annotations = _load_image(image_path, annotation_data, target_long_side)
         if image is None:
-            print(f"Warning: Unable to read {image_path}. Skipping.")
-            return False, None
-        
-        # Convert to PIL image for processing
-        image_pil = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        
-        # Get annotations for this image
-        image_annotations = annotation_data
+            return None
         
-        updated_annotations = image_annotations
-        
-        # Apply distortions with probability
-        if random.random() < distortion_prob:
-            # Apply distortions and track coordinate changes
-            image_pil, updated_annotations = apply_distortions_with_tracking(
-                image_pil, image_annotations,
-                add_shapes=True,
-                add_noise=True,
-                add_shadows=True
+        results = []
+        for k, output_path in enumerate(output_paths):
+            seed = _new_seed()
+            params = {}
+            source = image.copy() if k < len(output_paths) - 1 else image
+            plan = plans[k] if plans else None
+            _, updated_annotations = _augment_seeded(
+                source, source_annotations, seed, distortion_prob, params, plan=plan, **options
             )
+            recipe = {
+                'output': os.path.basename(output_path),
+                'source': os.path.abspath(image_path),
+                'seed': seed,
+                'distortion_prob': distortion_prob,
+                'annotations': annotation_data,
+                'params': params,
+            }
+            if plan is not None:
+                recipe['plan'] = plan
+            results.append((output_path, updated_annotations, recipe))
+        return results
+    
+    except Exception as e:
+        print(f"Error processing {image_path}: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+def variant_filenames(filename, variants=1):
+    """Output file names of the augmented variants of an input image."""
+    if variants <= 1:
+        return [filename]
+    stem, ext = os.path.splitext(filename)
+    return [f"{stem}_v{k}{ext}" for k in range(1, variants + 1)]
+
+def _load_image(image_path, annotation_data, target_long_side=None):
+    """
+    Decode an image as BGR and downscale it if target_long_side is set.
+    
+    Returns:
+        tuple: (numpy array or None if unreadable, annotations)
+    """
+    with measure('decode'):
+        image = cv2.imread(image_path)
+    if image is None:
+        print(f"Warning: Unable to read {image_path}. Skipping.")
+        return None, annotation_data
+    
+    if target_long_side:
+        with measure('downscale', image.shape[0] * image.shape[1]):
+            image, annotation_data = downscale_to_long_side(image, annotation_data, target_long_side)
+    return image, annotation_data
+
+def _augment_variants(image, annotation_data, count, distortion_prob=0.5, shadow_scale=1.0,
+                      backend='cv2', use_overlay_bank=False, memory_budget_mb=None, plans=None):
+    """Augment a decoded image count times, returns a list of (BGR array, annotations)."""
+    variants = []
+    for k in range(count):
+        # The cv2 backend distorts in place, so all but the last variant get a copy
+        source = image.copy() if k < count - 1 else image
+        variants.append(_augment_decoded(
+            source, annotation_data, distortion_prob, shadow_scale, backend, use_overlay_bank,
+            memory_budget_mb, plan=plans[k] if plans else None
+        ))
+    return variants
+
+def preprocess_image_variants(image_path, output_paths, annotation_data, distortion_prob=0.5,
+                              shadow_scale=1.0, backend='cv2', use_overlay_bank=False,
+                              target_long_side=None, memory_budget_mb=None, plans=None):
+    """
+    Decode an image once and write an independently augmented variant to every output path.
+    
+    With target_long_side the image is first downscaled (see downscale_to_long_side),
+    so the distortions and the encoding run at the reduced size. memory_budget_mb
+    bounds the temporaries of the cv2 distortion chain (see _augment_decoded).
+    plans holds one DistortionScheduler plan per output path (None to draw them).
+    
+    Returns:
+        List of (output_path, updated annotations) for the written variants,
+        or None if the image could not be processed
+    """
+    try:
+        image, annotation_data = _load_image(image_path, annotation_data, target_long_side)
+        if image is None:
+            return None
+        
+        pixels = image.shape[0] * image.shape[1]
+        variants = _augment_variants(
+            image, annotation_data, len(output_paths), distortion_prob, shadow_scale, backend,
+            use_overlay_bank, memory_budget_mb, plans
+        )
         
-        # Convert back to OpenCV format and save
-        image_cv = cv2.cvtColor(np.array(image_pil), cv2.COLOR_RGB2BGR)
-        cv2.imwrite(output_path, image_cv)
+        results = []
+        for output_path, (variant, updated_annotations) in zip(output_paths, variants):
+            with measure('encode', pixels):
+                cv2.imwrite(output_path, variant)
+            results.append((output_path, updated_annotations))
         
-        return True, updated_annotations
+        return results
     
     except Exception as e:
         print(f"Error processing {image_path}: {e}")
         import traceback
         traceback.print_exc()
+        return None
+
+def preprocess_image_with_annotations(image_path, output_path, annotation_data, distortion_prob=0.5,
+                                      shadow_scale=1.0, backend='cv2', use_overlay_bank=False):
+    """Process a single image and update its annotations."""
+    results = preprocess_image_variants(
+        image_path, [output_path], annotation_data, distortion_prob, shadow_scale, backend,
+        use_overlay_bank
+    )
+    if results is None:
         return False, None
+    return True, results[0][1]
+
+_in_worker_process = False
+
+def _init_worker(profile=False, noise_options=None, overlay_options=None):
+    """Initialise a worker process of the process-pool executor."""
+    global _in_worker_process
+    _in_worker_process = True
+    # Forked workers inherit the parent's RNG state, so reseed each one from OS entropy
+    random.seed()
+    np.random.seed()
+    # Parallelism comes from the pool itself, keep OpenCV from oversubscribing the cores
+    cv2.setNumThreads(1)
+    # Same noise bank settings as the parent, forked workers keep its tiles
+    if noise_options is not None:
+        noise_bank.configure(**noise_options)
+    if overlay_options is not None:
+        overlay_bank.configure(**overlay_options)
+    # Timings are collected per worker and shipped back with every chunk
+    if profile:
+        profiling.enable()
+    else:
+        profiling.disable()
+
+def _process_task(task):
+    """Run preprocess_image_variants (variant_recipes in recipe mode) for a (label path, args, kwargs) task."""
+    image_path, args, kwargs = task
+    kwargs = dict(kwargs)
+    if kwargs.pop('recipe', False):
+        return image_path, variant_recipes(*args, **kwargs)
+    return image_path, preprocess_image_variants(*args, **kwargs)
+
+def _process_chunk(chunk):
+    """
+    Run a chunk of tasks in a single worker call.
+    
+    Returns:
+        tuple: (list of task results, profiling samples collected by a worker
+                process or None)
+    """
+    results = [_process_task(task) for task in chunk]
+    profiler = profiling.active()
+    samples = profiler.drain() if _in_worker_process and profiler is not None else None
+    return results, samples
+
+def _image_size(image_path):
+    """Width and height from the image header, or None if it cannot be read."""
+    try:
+        with Image.open(image_path) as image:
+            return image.size
+    except Exception:
+        return None
+
+def _plan_variants(scheduler, input_path, count, distortion_prob, target_long_side=None):
+    """Plan the augmentation of every output variant of an image with the scheduler."""
+    size = _image_size(input_path)
+    pixels = 0
+    if size is not None:
+        width, height = size
+        scale = min(1.0, target_long_side / max(width, height)) if target_long_side else 1.0
+        pixels = int(width * scale) * int(height * scale)
+    return [scheduler.plan(pixels, distortion_prob) for _ in range(count)]
+
+def _size_batches(tasks, batch_size):
+    """
+    Group tasks into batches of images with the same size.
+    
+    A batch is emitted as soon as it is full. At most 16 batches worth of tasks
+    wait for their group to fill, beyond that the largest group is emitted early.
+    """
+    groups = {}
+    waiting = 0
+    for task in tasks:
+        size = _image_size(task[1][0])
+        group = groups.setdefault(size, [])
+        group.append(task)
+        waiting += 1
+        if len(group) >= batch_size:
+            waiting -= len(group)
+            yield groups.pop(size)
+        elif waiting > batch_size * 16:
+            largest = max(groups, key=lambda key: len(groups[key]))
+            waiting -= len(groups[largest])
+            yield groups.pop(largest)
+    yield from groups.values()
+
+def _process_batch(chunk):
+    """
+    Run a chunk of same-size tasks through the batched distortion chain.
+    
+    The tasks of a chunk share their options. Images whose decoded size differs
+    from the rest (e.g. EXIF rotation) form their own batch.
+    
+    Returns:
+        tuple: (list of task results, profiling samples collected by a worker
+                process or None)
+    """
+    options = dict(chunk[0][2])
+    decoded = {}
+    results = []
+    for image_path, (input_path, output_paths, annotation_data, distortion_prob), _ in chunk:
+        try:
+            image, annotation_data = _load_image(input_path, annotation_data, options.get('target_long_side'))
+        except Exception as e:
+            print(f"Error processing {input_path}: {e}")
+            image = None
+        if image is None:
+            results.append((image_path, None))
+            continue
+        decoded.setdefault(image.shape, []).append(
+            [image_path, input_path, output_paths, annotation_data, distortion_prob, image]
+        )
+    
+    overlays = overlay_bank.default_bank() if options.get('use_overlay_bank') else None
+    for group in decoded.values():
+        try:
+            # One sample per output variant, every one is distorted independently
+            outputs = [(entry, output_path) for entry in group for output_path in entry[2]]
+            batch = np.stack([entry[5] for entry, _ in outputs])
+            for entry in group:
+                entry[5] = None
+            annotations = apply_distortions_batch(
+                batch, [entry[3] for entry, _ in outputs], group[0][4],
+                options.get('shadow_scale', 1.0), 'BGR', overlays
+            )
+            
+            records = {}
+            pixels = batch.shape[1] * batch.shape[2]
+            for (entry, output_path), sample, sample_annotations in zip(outputs, batch, annotations):
+                with measure('encode', pixels):
+                    cv2.imwrite(output_path, sample)
+                records.setdefault(entry[0], []).append((output_path, sample_annotations))
+            results.extend(records.items())
+        except Exception as e:
+            print(f"Error processing a batch of {len(group)} images: {e}")
+            import traceback
+            traceback.print_exc()
+            results.extend((entry[0], None) for entry in group)
+    
+    profiler = profiling.active()
+    samples = profiler.drain() if _in_worker_process and profiler is not None else None
+    return results, samples
+
+def _iter_results(pool, tasks, chunksize=1, max_in_flight=None, batch_size=None):
+    """
+    Submit tasks to a pool in chunks and yield their results in submission order.
+    
+    Tasks are pulled from the iterable lazily and at most max_in_flight chunks are
+    queued at any time (no bound if None). With batch_size the chunks are batches
+    of same-size images for the batched distortion chain.
+    """
+    tasks = iter(tasks)
+    if batch_size:
+        chunks, work = _size_batches(tasks, batch_size), _process_batch
+    else:
+        chunks, work = iter(lambda: list(itertools.islice(tasks, chunksize)), []), _process_chunk
+    pending = deque()
+    
+    while True:
+        while max_in_flight is None or len(pending) < max_in_flight:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            pending.append(pool.submit(work, chunk))
+        
+        if not pending:
+            return
+        results, samples = pending.popleft().result()
+        if samples:
+            profiling.active().merge(samples)
+        yield from results
+
+class _PipelineJob:
+    """State of one task while it moves through the stages of the staged pipeline."""
+    
+    def __init__(self, task):
+        self.image_path, args, options = task
+        self.input_path, self.output_paths, self.annotations, self.distortion_prob = args
+        self.options = dict(options)
+        self.image = None
+        self.outputs = None
+        self.records = None
+        self.failed = False
+
+def _pipeline_step(step):
+    """Wrap a pipeline step so that an error fails only its job, like preprocess_image_variants."""
+    def run(job):
+        if not job.failed:
+            try:
+                step(job)
+            except Exception as e:
+                print(f"Error processing {job.input_path}: {e}")
+                import traceback
+                traceback.print_exc()
+                job.failed = True
+                job.image = job.outputs = None
+        return job
+    return run
+
+@_pipeline_step
+def _read_step(job):
+    target_long_side = job.options.pop('target_long_side', None)
+    job.image, job.annotations = _load_image(job.input_path, job.annotations, target_long_side)
+    job.failed = job.image is None
+
+@_pipeline_step
+def _augment_step(job):
+    job.outputs = _augment_variants(
+        job.image, job.annotations, len(job.output_paths), job.distortion_prob, **job.options
+    )
+    job.image = None
+
+@_pipeline_step
+def _encode_step(job):
+    encoded = []
+    for output_path, (variant, annotations) in zip(job.output_paths, job.outputs):
+        with measure('encode', variant.shape[0] * variant.shape[1]):
+            ok, buffer = cv2.imencode(os.path.splitext(output_path)[1], variant)
+        if not ok:
+            raise ValueError(f"Unable to encode {output_path}")
+        encoded.append((output_path, buffer, annotations))
+    job.outputs = encoded
+
+@_pipeline_step
+def _write_step(job):
+    for output_path, buffer, _ in job.outputs:
+        with measure('write'):
+            buffer.tofile(output_path)
+    job.records = [(output_path, annotations) for output_path, _, annotations in job.outputs]
+    job.outputs = None
+
+def _iter_pipeline_results(staged, tasks):
+    """Run tasks through the staged pipeline and yield (label path, records) like _iter_results."""
+    for job in staged.run(_PipelineJob(task) for task in tasks):
+        yield job.image_path, None if job.failed else job.records
+
+def _unique_entries(annotations_path, files):
+    """
+    Lazily yield the label entry of every image that exists in the input directory.
+
+    Like the dictionary of the non-streaming mode, a later line for an image
+    replaces an earlier one. A first pass only reads the image names to find the
+    last line of every image, the annotations of that line are parsed when it is
+    reached in the second pass.
+    """
+    last_lines = {}
+    for index, (image_path, _) in enumerate(iter_label_lines(annotations_path)):
+        last_lines[os.path.basename(image_path)] = index
+    
+    for index, (image_path, annotations_json) in enumerate(iter_label_lines(annotations_path)):
+        filename = os.path.basename(image_path)
+        if filename in files and last_lines[filename] == index:
+            yield image_path, json.loads(annotations_json)
 
 def process_images_with_annotations(input_dir, output_dir, annotations_file='Label.txt', 
-                                    cache_file='Cache.cach', distortion_prob=0.5, max_workers=None):
-    """Process all images in a directory using thread pool."""
+                                    cache_file='Cache.cach', distortion_prob=0.5, max_workers=None,
+                                    shadow_scale=1.0, executor='thread', chunksize=None, backend='cv2',
+                                    stream=False, max_in_flight=None, flush_every=100, resume=False,
+                                    variants=1, profile=False, noise_tile_size=512, noise_tiles=8,
+                                    noise_bank_path=None, overlay_bank_size=None, overlay_size=256,
+                                    overlay_refresh=0, target_long_side=None, pipeline=False, readers=2,
+                                    encoders=2, queue_size=8, memory_budget_mb=None, batch_size=None,
+                                    recipe_only=False, target_ms=None, target_ips=None, cost_profile=None,
+                                    schedule_candidates=4):
+    """
+    Process all images in a directory using a thread or process pool.
+    
+    Args:
+        executor: 'thread' for a thread pool, 'process' for a process pool that
+            sidesteps the GIL for the pure-Python parts of the augmentation
+        chunksize: Number of tasks sent to a worker process at once
+            (process executor only, picked from the task count if None)
+        backend: 'cv2' for the array-based distortion chain, 'pil' for the PIL one
+        stream: Read the annotations file lazily, keep a bounded window of work in
+            flight and append every finished record to the output files right away
+        max_in_flight: Maximum number of queued chunks in streaming mode
+            (4 per worker if None)
+        flush_every: Flush the output files after this many records in streaming mode
+        resume: Journal every finished image in the output directory, skip images
+            already finished with the same input and settings, and rebuild the
+            label files from the journal at the end
+        variants: Number of independently augmented outputs per input image, each
+            image is decoded and its annotations parsed only once
+        profile: Time every distortion, background effect, decode and encode and
+            write augment_profile.json/.txt to the output directory
+        noise_tile_size: Side length of the precomputed noise tiles
+        noise_tiles: Number of precomputed noise tiles per process
+        noise_bank_path: .npy file the noise tiles are memory-mapped from by all
+            workers, created on the first run (generated per process if None)
+        overlay_bank_size: Number of pre-rendered shape layers and of shadow masks
+            the background shapes and complex shadows are taken from (None draws
+            them for every image)
+        overlay_size: Side length of the pre-rendered overlays
+        overlay_refresh: Re-render one overlay after this many uses (0 = never)
+        target_long_side: Downscale every image so its longer side is at most this
+            many pixels before augmenting it, annotations are scaled to match
+        pipeline: Run decoding, augmentation, encoding and writing as separate
+            thread stages connected by bounded queues, with max_workers augmenter
+            threads (replaces the executor, results arrive in completion order)
+        readers: Number of reader (decode) threads of the pipeline
+        encoders: Number of encoder threads of the pipeline
+        queue_size: Capacity of every queue between the pipeline stages
+        memory_budget_mb: Approximate memory per worker for the temporaries of the
+            cv2 distortion chain. Larger images are processed in strips, on top of
+            the budget each worker holds the uint8 image buffers themselves.
+        batch_size: Group same-size images into batches of up to this many and
+            run them through apply_distortions_batch (cv2 backend, not with the
+            pipeline or a memory budget)
+        recipe_only: Write no images, record the seed and sampled parameters of
+            every output in recipes.jsonl instead, see recipes.RecipeBook for
+            regenerating them. Label files are written as usual. Runs on the
+            process executor, so no other thread draws from a reseeded generator.
+        target_ms: Plan the distortions of every image so that the augmentation
+            takes about this many ms per image on average (see scheduler)
+        target_ips: Plan the distortions to reach about this many images per
+            second over all workers instead
+        cost_profile: augment_profile.json or saved CostRegistry with the measured
+            per-megapixel costs the scheduler plans with (built-in costs if None)
+        schedule_candidates: Distortion sets the scheduler draws per image
+    """
     # Create output directory if it doesn't exist
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -698,95 +1750,235 @@ def process_images_with_annotations(input_dir, output_dir, annotations_file='Lab
         print(f"Annotations file {annotations_path} not found")
         return
     
-    # Dictionary to store image_path -> annotations mapping
-    annotations_by_image = {}
-    image_paths = {}
+    if stream:
+        # Entries are parsed one line at a time as the pool asks for more work
+        entries = _unique_entries(annotations_path, set(files))
+        total = None
+    else:
+        # Dictionary to store image filename -> (original path, annotations) mapping
+        entries_by_image = {}
+        try:
+            for image_path, annotations_data in iter_label_entries(annotations_path):
+                entries_by_image[os.path.basename(image_path)] = (image_path, annotations_data)
+        except Exception as e:
+            print(f"Error loading annotations: {e}")
+            import traceback
+            traceback.print_exc()
+            return
+        entries = [entries_by_image[f] for f in files if f in entries_by_image]
+        total = len(entries)
     
-    try:
-        with open(annotations_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if '\t' in line:
-                    parts = line.split('\t', 1)
-                    if len(parts) == 2:
-                        image_path, annotations_json = parts
-                        image_filename = os.path.basename(image_path)
-                        image_paths[image_filename] = image_path  # Store original path
-                        annotations_data = json.loads(annotations_json)
-                        annotations_by_image[image_filename] = annotations_data
-    except Exception as e:
-        print(f"Error loading annotations: {e}")
-        import traceback
-        traceback.print_exc()
-        return
+    options = {'shadow_scale': shadow_scale, 'backend': backend}
+    if overlay_bank_size:
+        options['use_overlay_bank'] = True
+    if target_long_side:
+        options['target_long_side'] = target_long_side
+    if memory_budget_mb:
+        options['memory_budget_mb'] = memory_budget_mb
+    
+    if recipe_only:
+        # Replay needs the same noise tiles and a single thread per seeded generator
+        if noise_bank_path is None:
+            noise_bank_path = os.path.join(output_dir, 'noise_bank.npy')
+        if overlay_bank_size:
+            print("Note: pre-rendered overlays cannot be replayed, drawing shapes and shadows per image")
+            overlay_bank_size = None
+            options.pop('use_overlay_bank')
+        if pipeline or batch_size or resume:
+            print("Note: recipe mode runs without the pipeline, batches or resume")
+            pipeline, batch_size, resume = False, None, False
+        if executor == 'thread':
+            print("Note: recipe mode reseeds the global random generators per image, using the process executor")
+            executor = 'process'
+    
+    journal = None
+    if resume:
+        # Skip images whose input, annotations and settings match a journaled run
+        journal = RunJournal(output_dir)
+        params = dict(options, distortion_prob=distortion_prob, variants=variants)
+        run_keys = {}
+        skipped = [0]
+        
+        def unfinished(entries):
+            for image_path, annotations_data in entries:
+                filename = os.path.basename(image_path)
+                key = task_key(os.path.join(input_dir, filename), annotations_data, params)
+                output_names = variant_filenames(filename, variants)
+                run_keys.update((name, key) for name in output_names)
+                if all(journal.is_done(name, key, os.path.join(output_dir, name)) for name in output_names):
+                    skipped[0] += 1
+                    continue
+                yield image_path, annotations_data
+        
+        entries = unfinished(entries)
+        if not stream:
+            entries = list(entries)
+            total = len(entries)
+            print(f"Resuming: {skipped[0]} images already done, {total} to process")
+    
+    num_workers = max_workers or os.cpu_count() or 1
+    
+    scheduler = None
+    if target_ms or target_ips:
+        registry = CostRegistry.from_profile(cost_profile) if cost_profile else CostRegistry()
+        scheduler = DistortionScheduler(registry, target_ms, target_ips, num_workers, schedule_candidates)
+    
+    def task_options(input_path):
+        # Plans are made here in the parent, in task order, so one budget covers all workers
+        if scheduler is None:
+            return options
+        return dict(options, plans=_plan_variants(scheduler, input_path, variants, distortion_prob, target_long_side))
+    
+    tasks = (
+        (image_path, (
+            os.path.join(input_dir, os.path.basename(image_path)),
+            [os.path.join(output_dir, name) for name in variant_filenames(os.path.basename(image_path), variants)],
+            annotations_data,
+            distortion_prob
+        ), task_options(os.path.join(input_dir, os.path.basename(image_path))))
+        for image_path, annotations_data in entries
+    )
+    
+    # Build the noise tiles once up front, thread workers share them and forked
+    # process workers inherit them or map the same file
+    noise_bank.configure(noise_tile_size, noise_tiles, noise_bank_path)
+    noise_bank.default_bank()
+    if overlay_bank_size:
+        overlay_bank.configure(overlay_size, overlay_bank_size, overlay_bank_size, overlay_refresh)
+        overlay_bank.default_bank()
+    
+    if batch_size and (pipeline or backend != 'cv2' or memory_budget_mb or scheduler):
+        print("Note: batches need the cv2 backend without the pipeline, a memory budget or a "
+              "time budget, processing images one by one")
+        batch_size = None
+    
+    staged = None
+    if pipeline:
+        if executor == 'process':
+            print("Note: the staged pipeline runs on threads, ignoring the process executor")
+        # A single writer thread keeps the output disk busy without competing writes
+        staged = StagedPipeline([
+            ('read', _read_step, readers),
+            ('augment', _augment_step, num_workers),
+            ('encode', _encode_step, encoders),
+            ('write', _write_step, 1),
+        ], queue_size)
+        pool = contextlib.nullcontext()
+    elif executor == 'process':
+        if chunksize is None:
+            chunksize = max(1, min(32, total // (num_workers * 4))) if total is not None else 8
+        pool = ProcessPoolExecutor(
+            max_workers=num_workers, initializer=_init_worker, initargs=(profile, noise_bank.options(), overlay_bank.options())
+        )
+    else:
+        chunksize = 1
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+    
+    if stream and max_in_flight is None:
+        max_in_flight = num_workers * 4
+    
+    recipe_writer = None
+    if recipe_only:
+        recipe_writer = RecipeWriter(output_dir, {
+            'noise_bank': os.path.relpath(os.path.abspath(noise_bank_path), os.path.abspath(output_dir)),
+            'noise_tile_size': noise_tile_size,
+            'noise_tiles': noise_tiles,
+            'options': dict(options),
+        }, flush_every=flush_every)
+        options['recipe'] = True
+    
+    profiler = profiling.enable() if profile else None
     
     # Set up progress tracking
     processed = 0
     success = 0
     
-    # Store updated annotations
+    # Store updated annotations (streaming mode writes them out as they complete)
     updated_annotations = {}
+    writer = None
+    if stream and journal is None:
+        writer = LabelWriter(output_dir, annotations_file, cache_file, flush_every=flush_every)
     
-    # Process files with thread pool
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        future_to_file = {}
-        for filename in files:
-            if filename in annotations_by_image:
-                future = executor.submit(
-                    preprocess_image_with_annotations, 
-                    os.path.join(input_dir, filename),
-                    os.path.join(output_dir, filename),
-                    annotations_by_image[filename],
-                    distortion_prob
+    # Process files with the pool, results come back in submission order
+    start_time = time.perf_counter()
+    try:
+        with pool:
+            if staged is not None:
+                results = _iter_pipeline_results(staged, tasks)
+            else:
+                results = _iter_results(
+                    pool, tasks, chunksize, max_in_flight if stream else None, batch_size
                 )
-                future_to_file[future] = filename
-        
-        # Process as completed with progress bar
-        for future in tqdm(future_to_file, total=len(future_to_file), desc="Processing images"):
-            filename = future_to_file[future]
-            try:
-                result, new_annotations = future.result()
+            
+            progress = tqdm(results, total=total, desc="Processing images")
+            for image_path, records in progress:
                 processed += 1
-                if result:
-                    success += 1
-                    if new_annotations:
-                        # Preserve the original path format but update to output directory
-                        if filename in image_paths:
-                            original_path = image_paths[filename]
-                            new_path = original_path.replace(input_dir, output_dir)
-                            updated_annotations[new_path] = new_annotations
+                if staged is not None and processed % 10 == 0:
+                    # Live queue depths show which stage the others are waiting for
+                    progress.set_postfix(staged.depths(), refresh=False)
+                if records is None:
+                    continue
+                success += 1
+                
+                # Preserve the original path format but update to output directory
+                new_path = image_path.replace(input_dir, output_dir)
+                path_prefix = new_path[:len(new_path) - len(os.path.basename(image_path))]
+                
+                for output_file, new_annotations, *recipe in records:
+                    output_name = os.path.basename(output_file)
+                    if recipe_writer is not None:
+                        recipe_writer.write(recipe[0])
+                    label_path = path_prefix + output_name
+                    if journal is not None:
+                        journal.record(output_name, run_keys[output_name], label_path, new_annotations)
+                    elif new_annotations:
+                        if writer is not None:
+                            writer.write(label_path, new_annotations)
                         else:
-                            # Fallback if original path not found
-                            updated_annotations[os.path.join(output_dir, filename)] = new_annotations
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
-    
-    # Write updated annotations to new Label.txt file
-    output_annotations_path = os.path.join(output_dir, annotations_file)
-    with open(output_annotations_path, 'w') as f:
-        for image_path, annotations in updated_annotations.items():
-            annotations_json = json.dumps(annotations)
-            f.write(f"{image_path}\t{annotations_json}\n")
-    
-    # Also write the same content to Cache.cach file
-    output_cache_path = os.path.join(output_dir, cache_file)
-    with open(output_cache_path, 'w') as f:
-        for image_path, annotations in updated_annotations.items():
-            annotations_json = json.dumps(annotations)
-            f.write(f"{image_path}\t{annotations_json}\n")
-    
-    # Also generate a fileState.txt file
-    output_filestate_path = os.path.join(output_dir, "fileState.txt")
-    with open(output_filestate_path, 'w') as f:
-        for image_path in updated_annotations.keys():
-            f.write(f"{image_path}\t1\n")
+                            updated_annotations[label_path] = new_annotations
+    finally:
+        if writer is not None:
+            writer.close()
+        if recipe_writer is not None:
+            recipe_writer.close()
+        if journal is not None:
+            journal.close()
+    
+    if journal is not None:
+        # Rebuild the label files from everything the journal holds for this run
+        if stream:
+            print(f"Resumed: {skipped[0]} images were already done")
+        with LabelWriter(output_dir, annotations_file, cache_file) as writer:
+            for label_path, annotations_json in journal.completed(run_keys):
+                writer.write_json(label_path, annotations_json)
+    elif writer is None:
+        # Write updated annotations to Label.txt, Cache.cach and fileState.txt in one pass
+        with LabelWriter(output_dir, annotations_file, cache_file) as writer:
+            for image_path, annotations in updated_annotations.items():
+                writer.write(image_path, annotations)
             
     print(f"Processing complete: {success}/{processed} images successfully processed")
     print(f"Updated annotations saved to:")
-    print(f"  - {output_annotations_path}")
-    print(f"  - {output_cache_path}")
-    print(f"File state saved to {output_filestate_path}")
+    print(f"  - {writer.label_path}")
+    print(f"  - {writer.cache_path}")
+    print(f"File state saved to {writer.filestate_path}")
+    if recipe_writer is not None:
+        print(f"Recipes of {recipe_writer.count} images saved to {recipe_writer.path}")
+    
+    if staged is not None:
+        depths = ", ".join(
+            f"{name} {mean:.1f}/{peak}" for name, (mean, peak) in staged.depth_summary().items()
+        )
+        print(f"Pipeline queue depth (mean/max of {queue_size}): {depths}")
+    
+    if scheduler is not None:
+        json_path, text_path = scheduler.write_report(output_dir, time.perf_counter() - start_time)
+        print(f"Distortion schedule report saved to {json_path} and {text_path}")
+    
+    if profiler is not None:
+        profiling.disable()
+        json_path, text_path = profiler.write_report(output_dir)
+        print(f"Operation profile saved to {json_path} and {text_path}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process images and update annotations')
@@ -795,7 +1987,62 @@ if __name__ == "__main__":
     parser.add_argument('--annotations', default='Label.txt', help='Annotations file name')
     parser.add_argument('--cache', default='Cache.cach', help='Cache file name')
     parser.add_argument('--distortion-prob', type=float, default=0.5, help='Probability of applying distortions')
-    parser.add_argument('--workers', type=int, default=None, help='Number of worker threads')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker threads or processes')
+    parser.add_argument('--executor', choices=['thread', 'process'], default='thread',
+                        help='Run workers as threads or as separate processes')
+    parser.add_argument('--backend', choices=['cv2', 'pil'], default='cv2',
+                        help='Run the distortion chain on OpenCV arrays or on PIL Images')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='Tasks sent to a worker process at a time (process executor only)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read annotations lazily and write finished records as they complete')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='Maximum queued chunks of work in streaming mode (default: 4 per worker)')
+    parser.add_argument('--flush-every', type=int, default=100,
+                        help='Flush the output label files every N records in streaming mode')
+    parser.add_argument('--variants', type=int, default=1,
+                        help='Number of augmented outputs per input image (decoded once)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time every operation and write a profile report to the output directory')
+    parser.add_argument('--noise-tile-size', type=int, default=512,
+                        help='Side length of the precomputed noise tiles')
+    parser.add_argument('--noise-tiles', type=int, default=8,
+                        help='Number of precomputed noise tiles')
+    parser.add_argument('--noise-bank', default=None,
+                        help='.npy file to memory-map the noise tiles from (created if missing)')
+    parser.add_argument('--overlay-bank', type=int, default=None,
+                        help='Take background shapes and shadows from N pre-rendered overlays of each kind')
+    parser.add_argument('--overlay-size', type=int, default=256,
+                        help='Side length of the pre-rendered overlays')
+    parser.add_argument('--overlay-refresh', type=int, default=0,
+                        help='Re-render one overlay after this many uses (0 = never)')
+    parser.add_argument('--target-long-side', type=int, default=None,
+                        help='Downscale images to at most this many pixels on the long side before augmenting')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Run read, augment, encode and write as separate stages with bounded queues')
+    parser.add_argument('--readers', type=int, default=2, help='Reader threads of the pipeline')
+    parser.add_argument('--encoders', type=int, default=2, help='Encoder threads of the pipeline')
+    parser.add_argument('--queue-size', type=int, default=8,
+                        help='Capacity of every queue between the pipeline stages')
+    parser.add_argument('--memory-budget', type=int, default=None,
+                        help='Memory in MB per worker for temporaries, larger images are processed in strips')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Augment same-size images in batches of up to N with the batched chain '
+                             '(only helps small crops, no gain on page-sized images)')
+    parser.add_argument('--recipe-only', action='store_true',
+                        help='Write recipes.jsonl (seeds and parameters) instead of the augmented images')
+    parser.add_argument('--target-ms', type=float, default=None,
+                        help='Pick distortions so augmenting takes about this many ms per image')
+    parser.add_argument('--target-ips', type=float, default=None,
+                        help='Pick distortions to reach about this many images per second')
+    parser.add_argument('--cost-profile', default=None,
+                        help='augment_profile.json or calibrated costs (python scheduler.py) to plan with')
+    parser.add_argument('--schedule-candidates', type=int, default=4,
+                        help='Distortion sets drawn per image when planning to a time budget')
+    parser.add_argument('--resume', action='store_true',
+                        help='Journal finished images and skip them when the run is restarted')
+    parser.add_argument('--shadow-scale', type=float, default=1.0,
+                        help='Resolution factor for shadow masks, e.g. 0.25 builds them at quarter size')
     
     args = parser.parse_args()
     
@@ -805,5 +2052,33 @@ if __name__ == "__main__":
         annotations_file=args.annotations,
         cache_file=args.cache,
         distortion_prob=args.distortion_prob,
-        max_workers=args.workers
+        max_workers=args.workers,
+        shadow_scale=args.shadow_scale,
+        executor=args.executor,
+        chunksize=args.chunksize,
+        backend=args.backend,
+        stream=args.stream,
+        max_in_flight=args.max_in_flight,
+        flush_every=args.flush_every,
+        resume=args.resume,
+        variants=args.variants,
+        profile=args.profile,
+        noise_tile_size=args.noise_tile_size,
+        noise_tiles=args.noise_tiles,
+        noise_bank_path=args.noise_bank,
+        overlay_bank_size=args.overlay_bank,
+        overlay_size=args.overlay_size,
+        overlay_refresh=args.overlay_refresh,
+        target_long_side=args.target_long_side,
+        pipeline=args.pipeline,
+        readers=args.readers,
+        encoders=args.encoders,
+        queue_size=args.queue_size,
+        memory_budget_mb=args.memory_budget,
+        batch_size=args.batch_size,
+        recipe_only=args.recipe_only,
+        target_ms=args.target_ms,
+        target_ips=args.target_ips,
+        cost_profile=args.cost_profile,
+        schedule_candidates=args.schedule_candidates
     )
\ No newline at end of file
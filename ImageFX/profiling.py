@@ -0,0 +1,135 @@
+"""
+Low-overhead per-operation timing for the ImageFX distortion chain.
+
+Operations are wrapped in measure(op, pixels). While no profiler is enabled this
+returns a shared no-op context manager, so the instrumentation costs one global
+lookup per operation. An enabled OpProfiler collects wall time and pixel count
+of every call from all threads of the process. Worker processes drain their
+samples and the parent merges them.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+_active = None
+_NULL_CONTEXT = contextlib.nullcontext()
+
+class _Timer:
+    __slots__ = ('profiler', 'op', 'pixels', 'start')
+
+    def __init__(self, profiler, op, pixels):
+        self.profiler = profiler
+        self.op = op
+        self.pixels = pixels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.op, time.perf_counter() - self.start, self.pixels)
+        return False
+
+class OpProfiler:
+    """Thread-safe collector of (seconds, pixels) samples per operation name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(list)
+
+    def record(self, op, seconds, pixels=0):
+        with self._lock:
+            self._samples[op].append((seconds, pixels))
+
+    def drain(self):
+        """Return all samples collected so far and start over."""
+        with self._lock:
+            samples = dict(self._samples)
+            self._samples = defaultdict(list)
+        return samples
+
+    def merge(self, samples):
+        """Add samples returned by drain() in another process."""
+        with self._lock:
+            for op, values in samples.items():
+                self._samples[op].extend(values)
+
+    def summary(self):
+        """
+        Per-operation statistics, sorted by total time.
+
+        Returns:
+            dict mapping op name to calls, total seconds, share of the total time,
+            mean/p50/p90/p99/max milliseconds per call, megapixels processed and
+            milliseconds per megapixel
+        """
+        with self._lock:
+            samples = {op: list(values) for op, values in self._samples.items()}
+
+        grand_total = sum(s for values in samples.values() for s, _ in values) or 1.0
+        stats = {}
+        for op, values in samples.items():
+            seconds = np.array([s for s, _ in values], dtype=np.float64)
+            megapixels = sum(p for _, p in values) / 1e6
+            total = float(seconds.sum())
+            p50, p90, p99 = np.percentile(seconds * 1000, [50, 90, 99])
+            stats[op] = {
+                'calls': len(values),
+                'total_s': total,
+                'share': total / grand_total,
+                'mean_ms': total * 1000 / len(values),
+                'p50_ms': float(p50),
+                'p90_ms': float(p90),
+                'p99_ms': float(p99),
+                'max_ms': float(seconds.max() * 1000),
+                'megapixels': megapixels,
+                'ms_per_mp': total * 1000 / megapixels if megapixels else None,
+            }
+
+        return dict(sorted(stats.items(), key=lambda item: item[1]['total_s'], reverse=True))
+
+    def write_report(self, output_dir, name='augment_profile'):
+        """Write the summary as <name>.json and a plain-text table <name>.txt."""
+        stats = self.summary()
+
+        json_path = os.path.join(output_dir, f"{name}.json")
+        with open(json_path, 'w') as f:
+            json.dump(stats, f, indent=2)
+
+        text_path = os.path.join(output_dir, f"{name}.txt")
+        with open(text_path, 'w') as f:
+            f.write(f"{'operation':<20}{'calls':>8}{'total s':>10}{'share':>8}{'mean ms':>10}"
+                    f"{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'ms/MP':>10}\n")
+            for op, s in stats.items():
+                ms_per_mp = f"{s['ms_per_mp']:.2f}" if s['ms_per_mp'] is not None else '-'
+                f.write(f"{op:<20}{s['calls']:>8}{s['total_s']:>10.2f}{s['share']:>8.1%}{s['mean_ms']:>10.2f}"
+                        f"{s['p50_ms']:>10.2f}{s['p90_ms']:>10.2f}{s['p99_ms']:>10.2f}{ms_per_mp:>10}\n")
+
+        return json_path, text_path
+
+def enable():
+    """Install a fresh profiler for this process and return it."""
+    global _active
+    _active = OpProfiler()
+    return _active
+
+def disable():
+    global _active
+    _active = None
+
+def active():
+    """The profiler of this process, or None when profiling is off."""
+    return _active
+
+def measure(op, pixels=0):
+    """Context manager timing one call of op on an image of the given pixel count."""
+    profiler = _active
+    if profiler is None:
+        return _NULL_CONTEXT
+    return _Timer(profiler, op, pixels)
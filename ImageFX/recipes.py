@@ -0,0 +1,163 @@
+"""
+Recipe files: augmented datasets stored as the parameters that produce them.
+
+In recipe mode preprocess.py writes no output pixels. For every output image a
+line of recipes.jsonl records its source image, the source annotations, the
+seed the distortion chain was run with, the augmentation options and the
+sampled parameters (distortion list, warp matrix, JPEG quality, ...) for
+auditing. The first line is a header with the format version and the noise
+bank file every recipe was rendered with. Reseeding the random generators with
+the recorded seed and running the same chain on the same source reproduces
+the image and its annotations exactly.
+
+Example:
+    book = RecipeBook('train_recipes/recipes.jsonl')
+    image, annotations = book.replay('img_001_v2.jpg')
+"""
+
+import argparse
+import json
+import os
+
+import cv2
+
+from label_io import LabelWriter, annotations_to_json
+
+RECIPE_FILE = 'recipes.jsonl'
+RECIPE_VERSION = 1
+
+class RecipeWriter:
+    """
+    Appends one recipe per output image to a recipes.jsonl file.
+
+    Args:
+        output_dir: Directory of the recipe file
+        header: Settings shared by all recipes (noise bank path, options)
+        filename: Name of the recipe file
+        flush_every: Flush the file after this many recipes
+    """
+
+    def __init__(self, output_dir, header, filename=RECIPE_FILE, flush_every=100):
+        self.path = os.path.join(output_dir, filename)
+        self.flush_every = max(1, flush_every)
+        self.count = 0
+        self._file = open(self.path, 'w')
+        self._file.write(json.dumps(dict(header, version=RECIPE_VERSION)) + '\n')
+
+    def write(self, recipe):
+        """Append one recipe."""
+        self._file.write(annotations_to_json(recipe) + '\n')
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class RecipeBook:
+    """
+    Recipes of one recipes.jsonl file, replayable by output name.
+
+    Args:
+        path: Recipe file written by preprocess.py in recipe mode
+        source_dir: Directory to take the source images from instead of the
+            recorded paths (e.g. after moving the dataset)
+
+    A truncated last line left by an interrupted run is ignored.
+    """
+
+    def __init__(self, path, source_dir=None):
+        self.path = path
+        self.source_dir = source_dir
+        self.recipes = {}
+
+        with open(path, 'r') as f:
+            self.header = json.loads(f.readline())
+            if self.header.get('version') != RECIPE_VERSION:
+                raise ValueError(f"Unsupported recipe version {self.header.get('version')} in {path}")
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                recipe = json.loads(line)
+                self.recipes[recipe['output']] = recipe
+
+    def __len__(self):
+        return len(self.recipes)
+
+    def names(self):
+        """Output names of all recipes, in the order they were written."""
+        return list(self.recipes)
+
+    def _noise_bank_path(self):
+        """The recorded noise bank, relative paths are resolved against the recipe file."""
+        path = self.header['noise_bank']
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(self.path)), path)
+        return path
+
+    def source_path(self, recipe):
+        if self.source_dir is not None:
+            return os.path.join(self.source_dir, os.path.basename(recipe['source']))
+        return recipe['source']
+
+    def replay(self, name):
+        """
+        Regenerate one output image from its source and recipe.
+
+        Returns:
+            tuple: (BGR numpy array, annotations), or (None, annotations) if the
+            source image could not be read
+        """
+        # Imported here, preprocess imports this module at load time
+        import noise_bank
+        from preprocess import augment_from_seed
+
+        recipe = self.recipes[name]
+        noise_bank.configure(self.header['noise_tile_size'], self.header['noise_tiles'],
+                             self._noise_bank_path())
+        return augment_from_seed(
+            self.source_path(recipe), recipe['annotations'], recipe['seed'],
+            recipe['distortion_prob'], plan=recipe.get('plan'), **self.header['options']
+        )
+
+    def materialise(self, output_dir, names=None, annotations_file='Label.txt', cache_file='Cache.cach'):
+        """
+        Write the images of the given recipes (all if None) and their label files.
+
+        Returns:
+            int: Number of images written
+        """
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        written = 0
+        with LabelWriter(output_dir, annotations_file, cache_file) as writer:
+            for name in names or self.names():
+                image, annotations = self.replay(name)
+                if image is None:
+                    continue
+                cv2.imwrite(os.path.join(output_dir, name), image)
+                written += 1
+                if annotations:
+                    writer.write(os.path.join(os.path.basename(output_dir), name), annotations)
+        return written
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Regenerate augmented images from a recipe file')
+    parser.add_argument('recipes', help='recipes.jsonl written by preprocess.py --recipe-only')
+    parser.add_argument('--output', required=True, help='Directory to write the images and labels to')
+    parser.add_argument('--source-dir', default=None,
+                        help='Take the source images from this directory instead of the recorded paths')
+    parser.add_argument('--names', nargs='*', default=None, help='Output names to regenerate (default: all)')
+
+    args = parser.parse_args()
+
+    book = RecipeBook(args.recipes, args.source_dir)
+    written = book.materialise(args.output, args.names)
+    print(f"Regenerated {written}/{len(args.names or book.names())} images in {args.output}")
@@ -0,0 +1,291 @@
+"""
+Compute-budgeted selection of the ImageFX distortions.
+
+The cost of the distortions differs by two orders of magnitude: a color shift
+takes a fraction of a millisecond per megapixel, a warp or complex shadows over
+twenty. With uniformly random selection the time per image, and with it the
+throughput of a run, varies widely. A CostRegistry holds the
+measured cost of every operation in ms per megapixel. A DistortionScheduler
+plans the distortions of every image up front: it draws candidate sets the
+usual way and keeps the first one whenever the running budget allows, so the
+mix only shifts toward cheaper sets as far as the target requires.
+
+Costs come from a --profile report (augment_profile.json), from calibrate()
+or from the defaults below.
+"""
+
+import argparse
+import json
+import os
+import random
+
+import numpy as np
+
+# ms per megapixel of every operation when it is applied, measured with
+# `python scheduler.py` on a 1 MP page (cv2 backend); decode/encode of a 1 MP JPEG
+DEFAULT_COSTS = {
+    'shapes': 4.3,
+    'background_noise': 15.4,
+    'complex_shadows': 25.6,
+    'photometric': 2.1,
+    'lighting': 0.4,
+    'color_shift': 0.1,
+    'saturation': 0.1,
+    'sharpness': 3.2,
+    'blur': 2.5,
+    'noise': 3.7,
+    'shadow': 3.3,
+    'compression': 5.4,
+    'rotation': 23.3,
+    'perspective': 22.2,
+    'skew': 22.2,
+    'scale': 21.9,
+    'decode': 9.4,
+    'encode': 4.8,
+}
+
+# Chance that the chain applies a background effect when its flag is set
+BACKGROUND_PROBS = {'shapes': 0.7, 'background_noise': 0.8, 'complex_shadows': 0.6}
+BACKGROUND_FLAGS = {'shapes': 'add_shapes', 'background_noise': 'add_noise', 'complex_shadows': 'add_shadows'}
+
+PHOTOMETRIC_DISTORTIONS = ('lighting', 'color_shift', 'saturation')
+GEOMETRIC = ('rotation', 'perspective', 'skew', 'scale')
+
+# Operations that run once per image whatever is planned
+FIXED_OPS = ('decode', 'encode', 'write')
+
+class CostRegistry:
+    """
+    Cost in ms per megapixel of every distortion, background effect and I/O step.
+
+    Args:
+        costs: Dictionary of operation name -> ms per megapixel
+    """
+
+    def __init__(self, costs=None):
+        self.costs = dict(DEFAULT_COSTS)
+        if costs:
+            self.costs.update(costs)
+
+    @classmethod
+    def from_profile(cls, path):
+        """Load the ms/MP of every operation from an augment_profile.json or a saved registry."""
+        with open(path, 'r') as f:
+            stats = json.load(f)
+        return cls({
+            op: s['ms_per_mp'] for op, s in stats.items() if s.get('ms_per_mp') is not None
+        })
+
+    @classmethod
+    def calibrate(cls, size=(1000, 1000), runs=200, backend='cv2'):
+        """
+        Measure the costs on this machine by profiling runs of the full chain
+        on a synthetic page of the given (width, height).
+        """
+        # Imported here, preprocess imports this module at load time
+        import profiling
+        from preprocess import _augment_decoded
+
+        width, height = size
+        page = np.full((height, width, 3), 235, dtype=np.uint8)
+        page[height // 4:height // 2, width // 8:width * 7 // 8] = 40
+        profiler = profiling.enable()
+        try:
+            for _ in range(runs):
+                _augment_decoded(page.copy(), [], 1.0, backend=backend)
+        finally:
+            profiling.disable()
+        return cls({op: s['ms_per_mp'] for op, s in profiler.summary().items() if s['ms_per_mp']})
+
+    def save(self, path):
+        """Write the costs in the format of augment_profile.json, readable by from_profile."""
+        with open(path, 'w') as f:
+            json.dump({op: {'ms_per_mp': cost} for op, cost in sorted(self.costs.items())}, f, indent=2)
+
+    def estimate(self, plan, megapixels):
+        """
+        Expected ms of the augmentation planned for an image of the given size.
+
+        Background effects count with the chance that the chain applies them, all
+        geometric distortions of a set share a single warp, and the photometric
+        distortions share one look-up pass.
+        """
+        if not plan['distort']:
+            return 0.0
+        ms_per_mp = sum(
+            self.costs.get(op, 0.0) * BACKGROUND_PROBS[op]
+            for op, flag in BACKGROUND_FLAGS.items() if plan[flag]
+        )
+        distortions = plan['distortions']
+        ms_per_mp += sum(self.costs.get(name, 0.0) for name in distortions if name not in GEOMETRIC)
+        ms_per_mp += max((self.costs.get(name, 0.0) for name in distortions if name in GEOMETRIC), default=0.0)
+        if any(name in PHOTOMETRIC_DISTORTIONS for name in distortions):
+            ms_per_mp += self.costs.get('photometric', 0.0)
+        return ms_per_mp * megapixels
+
+    def fixed(self, megapixels):
+        """ms of the per-image decode, encode and write steps."""
+        return sum(self.costs.get(op, 0.0) for op in FIXED_OPS) * megapixels
+
+class DistortionScheduler:
+    """
+    Plans the distortions of every image to hit an average time budget.
+
+    Args:
+        registry: CostRegistry with the operation costs
+        target_ms: Average augmentation ms per image to aim for
+        target_ips: Images per second of the whole run to aim for instead; the
+            decode/encode costs are subtracted from the per-image budget
+        workers: Number of parallel workers, for target_ips
+        candidates: Distortion sets drawn per image. The first is kept when it
+            fits the budget, otherwise the cheapest is used; more candidates
+            allow a larger shift of the mix toward cheap distortions.
+        burst: Unused budget carried over is capped at this many images' worth
+
+    plan() returns a dictionary with 'distort', 'distortions' and the add_shapes,
+    add_noise and add_shadows flags of apply_distortions_with_tracking.
+    """
+
+    def __init__(self, registry=None, target_ms=None, target_ips=None, workers=1, candidates=4, burst=4):
+        if target_ms is None and target_ips is None:
+            raise ValueError("DistortionScheduler needs target_ms or target_ips")
+        self.registry = registry or CostRegistry()
+        self.target_ms = target_ms
+        self.target_ips = target_ips
+        self.workers = workers
+        self.candidates = max(1, candidates)
+        self.burst = burst
+        self.credit = 0.0
+
+        self.images = 0
+        self.budget_ms = 0.0
+        self.planned_ms = 0.0
+        self.natural_ms = 0.0
+        self.replaced = 0
+        self.chosen = {}
+        self.natural = {}
+
+    def _budget(self, megapixels):
+        """Augmentation ms available for one image of the given size."""
+        if self.target_ms is not None:
+            return self.target_ms
+        return max(0.0, self.workers * 1000.0 / self.target_ips - self.registry.fixed(megapixels))
+
+    def _draw(self, distort):
+        # Imported here, preprocess imports this module at load time
+        from preprocess import select_distortions
+
+        plan = {'distort': distort, 'distortions': select_distortions()}
+        plan.update((flag, True) for flag in BACKGROUND_FLAGS.values())
+        return plan
+
+    def plan(self, pixels, distortion_prob=0.5):
+        """Plan the augmentation of one image with the given number of pixels."""
+        megapixels = pixels / 1e6
+        budget = self._budget(megapixels)
+        self.credit = min(self.credit + budget, budget * self.burst)
+
+        # Whether the image is distorted at all stays with distortion_prob, only the set is planned
+        distort = random.random() < distortion_prob
+        drawn = [self._draw(distort) for _ in range(self.candidates)]
+        costs = [self.registry.estimate(plan, megapixels) for plan in drawn]
+        choice = 0
+        if costs[0] > self.credit:
+            choice = min(range(len(drawn)), key=costs.__getitem__)
+            self.replaced += 1
+        plan, cost = dict(drawn[choice]), costs[choice]
+
+        # Still over budget: leave out the most expensive background effects
+        for op in sorted(BACKGROUND_FLAGS, key=lambda op: self.registry.costs.get(op, 0.0), reverse=True):
+            if cost <= self.credit or not plan['distort']:
+                break
+            plan[BACKGROUND_FLAGS[op]] = False
+            cost = self.registry.estimate(plan, megapixels)
+
+        self.credit -= cost
+        self.images += 1
+        self.budget_ms += budget
+        self.planned_ms += cost
+        self.natural_ms += costs[0]
+        self._count(self.chosen, plan)
+        self._count(self.natural, drawn[0])
+        return plan
+
+    def _count(self, counts, plan):
+        if not plan['distort']:
+            counts['(none)'] = counts.get('(none)', 0) + 1
+            return
+        for op, flag in BACKGROUND_FLAGS.items():
+            if plan[flag]:
+                counts[op] = counts.get(op, 0) + 1
+        for name in plan['distortions']:
+            counts[name] = counts.get(name, 0) + 1
+
+    def summary(self, elapsed_s=None):
+        """
+        The achieved mix against the unconstrained one, and estimated and actual timings.
+
+        Args:
+            elapsed_s: Wall time of the run, to report the achieved images per second
+        """
+        images = max(self.images, 1)
+        mix = {
+            op: {
+                'planned': self.chosen.get(op, 0) / images,
+                'unconstrained': self.natural.get(op, 0) / images,
+            }
+            for op in sorted(set(self.chosen) | set(self.natural), key=lambda op: -self.natural.get(op, 0))
+        }
+        stats = {
+            'images': self.images,
+            'target_ms': self.target_ms,
+            'target_ips': self.target_ips,
+            'budget_ms_per_image': self.budget_ms / images,
+            'planned_ms_per_image': self.planned_ms / images,
+            'unconstrained_ms_per_image': self.natural_ms / images,
+            'replaced_share': self.replaced / images,
+            'mix': mix,
+        }
+        if elapsed_s:
+            stats['elapsed_s'] = elapsed_s
+            stats['achieved_ips'] = self.images / elapsed_s
+        return stats
+
+    def write_report(self, output_dir, elapsed_s=None, name='schedule_report'):
+        """Write the summary as <name>.json and a plain-text table <name>.txt."""
+        stats = self.summary(elapsed_s)
+        json_path = os.path.join(output_dir, f"{name}.json")
+        with open(json_path, 'w') as f:
+            json.dump(stats, f, indent=2)
+
+        text_path = os.path.join(output_dir, f"{name}.txt")
+        with open(text_path, 'w') as f:
+            f.write(f"images: {stats['images']}\n")
+            f.write(f"budget ms/image: {stats['budget_ms_per_image']:.2f}\n")
+            f.write(f"planned ms/image (estimated): {stats['planned_ms_per_image']:.2f}\n")
+            f.write(f"unconstrained ms/image (estimated): {stats['unconstrained_ms_per_image']:.2f}\n")
+            f.write(f"images with a cheaper set: {stats['replaced_share']:.1%}\n")
+            if 'achieved_ips' in stats:
+                f.write(f"achieved images/s: {stats['achieved_ips']:.2f}\n")
+            f.write("\nShare of images per operation, background effects count where enabled\n"
+                    "(the chain then applies them with their usual chance)\n")
+            f.write(f"{'operation':<20}{'planned':>10}{'unconstrained':>15}\n")
+            for op, share in stats['mix'].items():
+                f.write(f"{op:<20}{share['planned']:>10.1%}{share['unconstrained']:>15.1%}\n")
+        return json_path, text_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the per-megapixel cost of the ImageFX operations')
+    parser.add_argument('--output', default='distortion_costs.json', help='File to write the costs to')
+    parser.add_argument('--width', type=int, default=1000, help='Width of the synthetic calibration page')
+    parser.add_argument('--height', type=int, default=1000, help='Height of the synthetic calibration page')
+    parser.add_argument('--runs', type=int, default=200, help='Number of profiled chain runs')
+    parser.add_argument('--backend', choices=['cv2', 'pil'], default='cv2', help='Backend to calibrate')
+
+    args = parser.parse_args()
+
+    registry = CostRegistry.calibrate((args.width, args.height), args.runs, args.backend)
+    registry.save(args.output)
+    for op, cost in sorted(registry.costs.items(), key=lambda item: -item[1]):
+        print(f"{op:<20}{cost:>10.2f} ms/MP")
+    print(f"Costs saved to {args.output}")
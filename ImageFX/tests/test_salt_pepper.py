@@ -0,0 +1,90 @@
+import math
+import os
+import random
+import time
+
+import numpy as np
+import pytest
+
+from preprocess import add_salt_pepper_noise
+
+def per_pixel_salt_pepper(img_array, prob):
+    """The per-pixel loop add_salt_pepper_noise replaced."""
+    thres = 1 - prob
+    for i in range(img_array.shape[0]):
+        for j in range(img_array.shape[1]):
+            rdn = random.random()
+            if rdn < prob:
+                img_array[i][j] = 0
+            elif rdn > thres:
+                img_array[i][j] = 255
+    return img_array
+
+def sequential_salt_pepper(img_array, prob, per_channel, rng):
+    """
+    The sparse sampler written out one hit at a time: each uniform draw picks salt
+    or pepper with its top bit and gives the gap to the next hit with the rest.
+    """
+    values = img_array.reshape(-1) if per_channel else img_array.reshape(-1, img_array.shape[-1])
+    hit_prob = min(2 * prob, 1.0)
+    position = -1
+    hits = 0
+    while True:
+        draw = rng.random()
+        salt = draw >= 0.5
+        position += int(math.log1p(-(2 * draw - salt)) * (1 / math.log1p(-hit_prob))) + 1
+        if position >= values.shape[0]:
+            return img_array, hits
+        values[position] = 255 if salt else 0
+        hits += 1
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+@pytest.mark.parametrize("per_channel", [False, True])
+def test_matches_sequential_reference(per_channel):
+    image = np.full((64, 48, 3), 128, dtype=np.uint8)
+    expected, hits = sequential_salt_pepper(image.copy(), 0.05, per_channel, np.random.default_rng(7))
+    noisy = add_salt_pepper_noise(image.copy(), 0.05, per_channel=per_channel, rng=np.random.default_rng(7))
+
+    changed = noisy != 128 if per_channel else (noisy != 128).any(axis=-1)
+    assert hits > 0
+    assert np.count_nonzero(changed) == hits
+    assert (noisy == expected).all()
+
+@pytest.mark.skipif(not os.environ.get('IMAGEFX_BENCHMARKS'),
+                    reason="wall-clock benchmark, set IMAGEFX_BENCHMARKS=1 to run it")
+def test_speedup_on_10_megapixels():
+    image = np.full((2500, 4000, 3), 128, dtype=np.uint8)
+    prob = 0.01
+
+    # Both run in place on the same array, the flipped pixels don't change the cost
+    old = best_time(lambda: per_pixel_salt_pepper(image, prob), repeat=1)
+    new = best_time(lambda: add_salt_pepper_noise(image, prob), repeat=20)
+
+    assert old / new >= 100, f"only {old / new:.0f}x faster ({old * 1000:.0f} ms vs {new * 1000:.1f} ms)"
+
+@pytest.mark.parametrize("per_channel", [False, True])
+@pytest.mark.parametrize("prob", [0.005, 0.02])
+def test_flip_probabilities(per_channel, prob):
+    image = np.full((1000, 1000, 3), 128, dtype=np.uint8)
+    noisy = add_salt_pepper_noise(image, prob, per_channel=per_channel, rng=np.random.default_rng(0))
+
+    if per_channel:
+        values = noisy.reshape(-1)
+        black, white = values == 0, values == 255
+    else:
+        pixels = noisy.reshape(-1, 3)
+        black, white = (pixels == 0).all(axis=1), (pixels == 255).all(axis=1)
+        # Whole pixels flip, no pixel is left partly changed
+        assert ((pixels != 128).any(axis=1) == (black | white)).all()
+
+    # Within 5 standard deviations of the expected fraction
+    tolerance = 5 * np.sqrt(prob * (1 - prob) / black.size)
+    assert abs(black.mean() - prob) < tolerance
+    assert abs(white.mean() - prob) < tolerance
@@ -0,0 +1,22 @@
+import random
+
+import numpy as np
+import pytest
+
+from preprocess import _apply_distortions_array
+
+def run_chain(image, distortions, seed, strip_rows):
+    random.seed(seed)
+    np.random.seed(seed)
+    img_array, _ = _apply_distortions_array(image.copy(), [], distortions, False, False, False, 1.0, 'BGR',
+                                            strip_rows=strip_rows)
+    return img_array
+
+@pytest.mark.parametrize("strip_rows", [16, 48, 100])
+def test_shadow_strips_match_full_frame(strip_rows):
+    image = np.random.default_rng(0).integers(0, 256, (600, 800, 3), dtype=np.uint8)
+    for seed in range(20):
+        full = run_chain(image, ['shadow'], seed, None)
+        tiled = run_chain(image, ['shadow'], seed, strip_rows)
+        assert not (full == image).all()
+        assert (full == tiled).all(), f"seed {seed}: {np.count_nonzero(full != tiled)} values differ"
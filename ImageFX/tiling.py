@@ -0,0 +1,108 @@
+"""
+Strip-wise execution of the ImageFX array operations for very large scans.
+
+A 100+ megapixel page makes every full-frame float32 noise field, shadow mask or
+OpenCV temporary several hundred megabytes large. In tiled mode the operations
+work on horizontal strips of the image instead: point-wise operations run on
+each strip view, neighbourhood filters read a halo of original rows around the
+strip, upsampled masks are resampled per strip with cv2.remap, and the warp
+computes its source coordinates strip by strip. Only the uint8 image buffers
+stay full size; the temporaries are bounded by the strip height.
+"""
+
+import cv2
+import numpy as np
+
+# Rough peak of temporary bytes per channel value of a strip (float32 noise field,
+# float32 mask and gain, remap coordinates and OpenCV's own scratch buffers)
+VALUE_BYTES = 24
+
+# Strip heights are a multiple of the JPEG MCU height, so tiled JPEG round trips
+# put their block boundaries where a full-frame encode would
+STRIP_ALIGN = 16
+
+def strip_rows_for_budget(shape, budget_bytes):
+    """
+    Number of rows per strip that keeps the temporaries of an image within budget_bytes.
+
+    Returns:
+        int, or None if the whole image fits and no tiling is needed
+    """
+    height, width = shape[:2]
+    channels = shape[2] if len(shape) == 3 else 1
+    rows = int(budget_bytes // (width * channels * VALUE_BYTES))
+    rows = max(STRIP_ALIGN, rows // STRIP_ALIGN * STRIP_ALIGN)
+    return None if rows >= height else rows
+
+def iter_strips(height, rows):
+    """Yield the (y0, y1) row ranges of consecutive strips (a single range if rows is None)."""
+    rows = rows or height
+    for y0 in range(0, height, rows):
+        yield y0, min(height, y0 + rows)
+
+def strips(img, rows):
+    """Yield the strips of an array as writable views."""
+    for y0, y1 in iter_strips(img.shape[0], rows):
+        yield img[y0:y1]
+
+def filter_strips(img, function, halo, rows):
+    """
+    Run a neighbourhood filter over an array in place, one strip at a time.
+
+    function receives a copy of the strip extended by up to halo rows above and
+    below and returns the filtered block. The rows above a strip were already
+    overwritten by the previous strip, so their original values are carried over.
+    With halo at least the filter radius the result equals filtering the whole image.
+    """
+    height = img.shape[0]
+    carried = None
+    for y0, y1 in iter_strips(height, rows):
+        top, bottom = max(0, y0 - halo), min(height, y1 + halo)
+        block = img[top:bottom].copy()
+        if carried is not None:
+            block[:y0 - top] = carried
+        carried = block[y1 - top - min(halo, y1 - top):y1 - top].copy()
+
+        filtered = function(block)
+        img[y0:y1] = filtered[y0 - top:y1 - top]
+    return img
+
+def resize_rows(src, size, y0, y1, interpolation=cv2.INTER_LINEAR):
+    """
+    Rows y0:y1 of cv2.resize(src, size), computed without the full-size result.
+
+    Uses cv2.resize's pixel-center mapping with replicated borders, so the strips
+    of an upsampled mask line up with the full-frame resize.
+    """
+    width, height = size
+    src_h, src_w = src.shape[:2]
+    xs = (np.arange(width, dtype=np.float32) + 0.5) * (src_w / width) - 0.5
+    ys = (np.arange(y0, y1, dtype=np.float32) + 0.5) * (src_h / height) - 0.5
+    map_x = np.repeat(xs[np.newaxis, :], y1 - y0, axis=0)
+    map_y = np.repeat(ys[:, np.newaxis], width, axis=1)
+    return cv2.remap(src, map_x, map_y, interpolation, borderMode=cv2.BORDER_REPLICATE)
+
+def warp_perspective_strips(img, matrix, rows, flags=cv2.INTER_CUBIC, border_value=(255, 255, 255)):
+    """
+    cv2.warpPerspective onto a canvas of the same size, one output strip at a time.
+
+    Source coordinates of every output strip come from the inverse homography and
+    the strip is filled with cv2.remap, so only the coordinate maps of one strip
+    are ever held in memory.
+    """
+    height, width = img.shape[:2]
+    inverse = np.linalg.inv(np.asarray(matrix, dtype=np.float64))
+    out = np.empty_like(img)
+    xs = np.arange(width, dtype=np.float64)
+
+    for y0, y1 in iter_strips(height, rows):
+        ys = np.arange(y0, y1, dtype=np.float64)[:, np.newaxis]
+        denominator = inverse[2, 0] * xs + inverse[2, 1] * ys + inverse[2, 2]
+        # Points mapped to infinity land outside the source and get the border color
+        np.copyto(denominator, np.inf, where=denominator == 0)
+        map_x = ((inverse[0, 0] * xs + inverse[0, 1] * ys + inverse[0, 2]) / denominator).astype(np.float32)
+        map_y = ((inverse[1, 0] * xs + inverse[1, 1] * ys + inverse[1, 2]) / denominator).astype(np.float32)
+        cv2.remap(img, map_x, map_y, flags, dst=out[y0:y1],
+                  borderMode=cv2.BORDER_CONSTANT, borderValue=border_value)
+
+    return out
@@ -0,0 +1,148 @@
+"""
+Backgrounds decoded once and served as uint8 views.
+
+Every synthetic image used to start by opening and fully decoding a random
+background file. A BackgroundBank decodes each background once into an RGB
+uint8 array. All arrays are packed into one raw file that is memory-mapped, so
+worker threads share the page cache instead of holding decoded copies, and the
+process never holds more than one decoded background of its own. With a bank
+directory later runs (and other processes on the same machine) reuse the bank,
+it is rebuilt when the backgrounds directory changes. Without one the bank is
+built in a temporary directory that is removed by close(). sample() hands out
+a read-only view of a random background or of a random crop of it, optionally
+downscaled.
+"""
+
+import json
+import os
+import random
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+INDEX_FILE = 'index.json'
+DATA_FILE = 'backgrounds.u8'
+
+def _decode(path):
+    with Image.open(path) as image:
+        return np.asarray(image.convert("RGB"))
+
+class BackgroundBank:
+    """
+    Decoded RGB backgrounds of one directory.
+
+    Args:
+        backgrounds_dir: Directory with the background images
+        names: Background file names in backgrounds_dir
+        bank_dir: Directory of the memory-mapped bank, built there on first use
+            (None builds it in a temporary directory for this run only)
+    """
+
+    def __init__(self, backgrounds_dir, names, bank_dir=None):
+        self.backgrounds_dir = backgrounds_dir
+        self.names = list(names)
+
+        self._tmp_dir = None
+        if bank_dir is None:
+            self._tmp_dir = tempfile.TemporaryDirectory(prefix='background_bank_')
+            bank_dir = self._tmp_dir.name
+        self.bank_dir = bank_dir
+        self._images = self._open(bank_dir)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _key(self):
+        """Names, sizes and modification times of the backgrounds the bank was built from."""
+        key = []
+        for name in sorted(self.names):
+            stat = os.stat(os.path.join(self.backgrounds_dir, name))
+            key.append([name, stat.st_size, stat.st_mtime_ns])
+        return key
+
+    def _decode_all(self):
+        """Yield (name, RGB array) of every readable background."""
+        for name in self.names:
+            try:
+                yield name, _decode(os.path.join(self.backgrounds_dir, name))
+            except Exception as e:
+                print(f"Error loading background {name}: {e}")
+
+    def _build(self, bank_dir, key):
+        """Decode every background once and append it to the raw data file."""
+        os.makedirs(bank_dir, exist_ok=True)
+        index = {'key': key, 'images': {}}
+        tmp_data = os.path.join(bank_dir, f"{DATA_FILE}.{os.getpid()}.tmp")
+        offset = 0
+        with open(tmp_data, 'wb') as f:
+            for name, pixels in self._decode_all():
+                f.write(pixels.tobytes())
+                index['images'][name] = {'offset': offset, 'shape': list(pixels.shape)}
+                offset += pixels.nbytes
+
+        # Data first, index last, so a bank with a current index is always complete
+        tmp_index = os.path.join(bank_dir, f"{INDEX_FILE}.{os.getpid()}.tmp")
+        with open(tmp_index, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_data, os.path.join(bank_dir, DATA_FILE))
+        os.replace(tmp_index, os.path.join(bank_dir, INDEX_FILE))
+        print(f"Built background bank of {len(index['images'])} images ({offset / 1e6:.1f} MB) in {bank_dir}")
+        return index
+
+    def _open(self, bank_dir):
+        """Map the bank in bank_dir, building it if it is missing or out of date."""
+        key = self._key()
+        index_path = os.path.join(bank_dir, INDEX_FILE)
+        index = None
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        if index is None or index['key'] != key:
+            index = self._build(bank_dir, key)
+
+        self.names = [name for name in self.names if name in index['images']]
+        if not self.names:
+            return {}
+        data = np.memmap(os.path.join(bank_dir, DATA_FILE), dtype=np.uint8, mode='r')
+        images = {}
+        for name, entry in index['images'].items():
+            shape = tuple(entry['shape'])
+            size = int(np.prod(shape))
+            images[name] = data[entry['offset']:entry['offset'] + size].reshape(shape)
+        return images
+
+    def close(self):
+        """Remove the temporary bank, if this run built one. Views handed out stay valid."""
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+            self._tmp_dir = None
+
+    def image(self, name):
+        """Read-only (height, width, 3) view of a background."""
+        return self._images[name]
+
+    def sample(self, crop_range=None, long_side=None):
+        """
+        A random background as (name, read-only uint8 array).
+
+        Args:
+            crop_range: (min, max) fraction of the width and height to crop out
+                at a random position, or None for the whole background
+            long_side: Downscale backgrounds whose longer side exceeds this many
+                pixels (the only case where the pixels are copied)
+        """
+        name = random.choice(self.names)
+        view = self._images[name]
+        if crop_range is not None:
+            height, width = view.shape[:2]
+            fraction = random.uniform(*crop_range)
+            crop_width, crop_height = max(1, int(width * fraction)), max(1, int(height * fraction))
+            x = random.randint(0, width - crop_width)
+            y = random.randint(0, height - crop_height)
+            view = view[y:y + crop_height, x:x + crop_width]
+        if long_side is not None and max(view.shape[:2]) > long_side:
+            scale = long_side / max(view.shape[:2])
+            size = (max(1, int(view.shape[1] * scale)), max(1, int(view.shape[0] * scale)))
+            view = np.asarray(Image.fromarray(np.ascontiguousarray(view)).resize(size, Image.LANCZOS))
+        return name, view
@@ -0,0 +1,114 @@
+"""
+Memory-bounded cache of decoded, background-removed text crops.
+
+Every synthetic image pastes 20-25 text crops drawn from a few thousand files,
+so over a large run the same crops are decoded and matted by remove_background
+millions of times. CropCache keeps the matted RGBA crops in an LRU dictionary
+shared by all worker threads, bounded by a byte budget. With a disk directory
+the matted pixels are also saved as .npy files, so later runs load them
+without decoding or matting anything.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+class CropCache:
+    """
+    LRU cache of matted RGBA text crops.
+
+    Args:
+        text_dir: Directory of the text crop images
+        matte: Function turning a PIL RGBA crop into the matted PIL RGBA crop
+        max_bytes: Memory budget of the cached pixels
+        disk_dir: Directory for persisted matted crops (None to keep them in memory only)
+
+    get() returns a shared PIL Image, callers must not modify it in place
+    (resize, rotate and friends return new images).
+    """
+
+    def __init__(self, text_dir, matte, max_bytes=512 * 1024 * 1024, disk_dir=None):
+        self.text_dir = text_dir
+        self.matte = matte
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self._crops = OrderedDict()
+        self._lock = threading.Lock()
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, text_file, text_path):
+        """Persisted file of a crop, keyed by its name, size and modification time."""
+        stat = os.stat(text_path)
+        key = f"{text_file}:{stat.st_size}:{stat.st_mtime_ns}"
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def _load(self, text_file):
+        """Matte a crop, or read it from the disk cache."""
+        text_path = os.path.join(self.text_dir, text_file)
+        disk_path = None
+        if self.disk_dir is not None:
+            disk_path = self._disk_path(text_file, text_path)
+            if os.path.exists(disk_path):
+                with self._lock:
+                    self.disk_hits += 1
+                return Image.fromarray(np.load(disk_path))
+
+        crop = self.matte(Image.open(text_path).convert("RGBA"))
+
+        if disk_path is not None:
+            # Written atomically, so concurrent runs never read a partial file
+            tmp_path = f"{disk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.asarray(crop))
+            os.replace(tmp_path, disk_path)
+        return crop
+
+    def get(self, text_file):
+        """The matted RGBA crop of a file in text_dir."""
+        with self._lock:
+            crop = self._crops.get(text_file)
+            if crop is not None:
+                self._crops.move_to_end(text_file)
+                self.hits += 1
+                return crop
+            self.misses += 1
+
+        # Decoding and matting run outside the lock, other threads keep going
+        crop = self._load(text_file)
+        size = crop.width * crop.height * 4
+
+        with self._lock:
+            if text_file not in self._crops and size <= self.max_bytes:
+                self._crops[text_file] = crop
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    _, evicted = self._crops.popitem(last=False)
+                    self.bytes -= evicted.width * evicted.height * 4
+                    self.evictions += 1
+        return crop
+
+    def size(self, text_file):
+        """(width, height) of a crop, from the cached crop or else from the file header."""
+        with self._lock:
+            crop = self._crops.get(text_file)
+        if crop is not None:
+            return crop.size
+        with Image.open(os.path.join(self.text_dir, text_file)) as image:
+            return image.size
+
+    def stats(self):
+        """One-line summary of the cache use."""
+        lookups = max(self.hits + self.misses, 1)
+        return (f"crop cache: {self.hits / lookups:.1%} hits, {self.disk_hits} loaded from disk, "
+                f"{len(self._crops)} crops / {self.bytes / 1e6:.1f} MB held, {self.evictions} evicted")
@@ -2,6 +2,7 @@ import os
 import random
 import json
 import uuid
+import threading
 import cv2
 import numpy as np
 from PIL import Image, ImageFile
@@ -9,8 +10,13 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from datetime import datetime
+from collections import Counter
 import math
 from concurrent.futures import ThreadPoolExecutor
+from crop_cache import CropCache
+from item_catalog import ItemCatalog
+from background_bank import BackgroundBank
+from placement import PlacementEngine
 
 def remove_background(text_img):
     # Convert PIL image to OpenCV format
@@ -33,7 +39,85 @@ def remove_background(text_img):
     # Convert back to PIL format
     return Image.fromarray(result)
 
-def add_background_items(background, items_dir, num_items=3, opacity_range=(0.6, 0.9)):
+def load_text_crop(text_dir, text_file, crop_cache=None):
+    """Decode a text crop and remove its background, through crop_cache if given."""
+    if crop_cache is not None:
+        return crop_cache.get(text_file)
+    text_img = Image.open(os.path.join(text_dir, text_file)).convert("RGBA")
+    return remove_background(text_img)
+
+def text_crop_size(text_dir, text_file, crop_cache=None):
+    """(width, height) of a text crop, read from its header without decoding or matting it."""
+    if crop_cache is not None:
+        return crop_cache.size(text_file)
+    with Image.open(os.path.join(text_dir, text_file)) as text_img:
+        return text_img.size
+
+def rotated_size(width, height, angle):
+    """
+    Size of a width x height image after Image.rotate(angle, expand=True).
+
+    Follows the corner maths of PIL, so the size is exact without touching any pixels.
+    """
+    angle = angle % 360.0
+    if angle in (0, 180):
+        return width, height
+    if angle in (90, 270):
+        return height, width
+
+    radians = -math.radians(angle)
+    cos, sin = round(math.cos(radians), 15), round(math.sin(radians), 15)
+    # The rotation is about the center, only the extent of the corners matters
+    cx, cy = width / 2, height / 2
+    xs, ys = [], []
+    for x, y in ((0, 0), (width, 0), (width, height), (0, height)):
+        xs.append(cos * (x - cx) + sin * (y - cy) + cx)
+        ys.append(-sin * (x - cx) + cos * (y - cy) + cy)
+    return (math.ceil(max(xs)) - math.floor(min(xs)),
+            math.ceil(max(ys)) - math.floor(min(ys)))
+
+def plan_text_crop(text_images, text_dir, scale_range, rotation_range, opacity_range, crop_cache=None):
+    """
+    Sample a text crop and its transform, and compute the final size from the header.
+
+    Returns:
+        dict: text_file, size (after scaling), rotation, opacity and final
+        (width, height), or None if the scaled crop is too small
+    """
+    text_file = random.choice(text_images)
+    width, height = text_crop_size(text_dir, text_file, crop_cache)
+
+    scale = random.uniform(*scale_range)
+    new_width = int(width * scale)
+    new_height = int(height * scale)
+    if new_width < 20 or new_height < 20:
+        return None
+
+    rotation = random.uniform(*rotation_range)
+    opacity = random.uniform(*opacity_range)
+    final_size = (new_width, new_height)
+    if rotation != 0:
+        final_size = rotated_size(new_width, new_height, rotation)
+    return {'text_file': text_file, 'size': (new_width, new_height), 'rotation': rotation,
+            'opacity': opacity, 'final_size': final_size}
+
+def render_text_crop(text_dir, plan, crop_cache=None):
+    """Decode a planned text crop and apply its scale, rotation and opacity."""
+    text_img = load_text_crop(text_dir, plan['text_file'], crop_cache)
+    text_img = text_img.resize(plan['size'], Image.LANCZOS)
+
+    if plan['rotation'] != 0:
+        text_img = text_img.rotate(plan['rotation'], expand=True, resample=Image.BICUBIC)
+
+    if plan['opacity'] < 1.0:
+        data = np.array(text_img)
+        alpha = data[..., 3] * plan['opacity']
+        data[..., 3] = alpha
+        text_img = Image.fromarray(data)
+    return text_img
+
+def add_background_items(background, items_dir, num_items=3, opacity_range=(0.6, 0.9), catalog=None,
+                         inplace=False):
     """
     Add random background items from items_dir behind the main content.
     
@@ -42,12 +126,18 @@ def add_background_items(background, items_dir, num_items=3, opacity_range=(0.6,
         items_dir: Directory containing item images
         num_items: Number of items to add
         opacity_range: Range of opacity values for items
+        catalog: ItemCatalog of items_dir to take the decoded items from
+            (the directory is listed and the items decoded per call if None)
+        inplace: Paste the items onto background itself instead of a copy
     
     Returns:
         PIL Image with items added
     """
     # Get list of item images
-    item_files = [f for f in os.listdir(items_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    if catalog is not None:
+        item_files = catalog.names
+    else:
+        item_files = [f for f in os.listdir(items_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
     if not item_files:
         return background  # No items found
     
@@ -55,7 +145,7 @@ def add_background_items(background, items_dir, num_items=3, opacity_range=(0.6,
     bg_width, bg_height = background.size
     
     # Create a new canvas to place items (will be underneath the text)
-    canvas = background.copy()
+    canvas = background if inplace else background.copy()
     
     # Add random items
     num_items = min(num_items, len(item_files))
@@ -66,14 +156,21 @@ def add_background_items(background, items_dir, num_items=3, opacity_range=(0.6,
         
         try:
             # Load item image
-            item_img = Image.open(item_path).convert("RGBA")
+            if catalog is not None:
+                item_width, item_height = catalog.size(item_file)
+            else:
+                item_img = Image.open(item_path).convert("RGBA")
+                item_width, item_height = item_img.size
             
             # Scale item (random size but not too big)
-            max_scale = min(bg_width / item_img.width, bg_height / item_img.height) * 0.8
+            max_scale = min(bg_width / item_width, bg_height / item_height) * 0.8
             scale = random.uniform(0.2, max_scale)
-            new_width = int(item_img.width * scale)
-            new_height = int(item_img.height * scale)
-            item_img = item_img.resize((new_width, new_height), Image.LANCZOS)
+            new_width = int(item_width * scale)
+            new_height = int(item_height * scale)
+            if catalog is not None:
+                item_img = catalog.resized(item_file, (new_width, new_height))
+            else:
+                item_img = item_img.resize((new_width, new_height), Image.LANCZOS)
             
             # Random rotation
             rotation = random.uniform(0, 360)
@@ -138,11 +235,20 @@ def create_sequential_text_section(
     opacity_range,
     min_edge_distance,
     num_texts_in_section,
-    existing_boxes
+    existing_boxes,
+    crop_cache=None,
+    placement=None
 ):
-    """Create a section of sequentially stacked text in y direction"""
+    """
+    Create a section of sequentially stacked text in y direction.
+
+    The layout is planned from the crop headers first, crops are only decoded and
+    transformed once the section has been placed. With a PlacementEngine the
+    section position is drawn from the free space of the engine instead of by
+    rejection against existing_boxes.
+    """
     # Determine section properties
-    text_items = []
+    text_plans = []
     placed_boxes = []
     annotations = []
     
@@ -151,50 +257,34 @@ def create_sequential_text_section(
     section_height = 0
     max_attempts = 100
     
-    # First, prepare all text images and calculate total height
+    # First, plan all text crops and calculate total height without any pixel work
     for j in range(num_texts_in_section):
-        # Select a random text image
-        text_file = random.choice(text_images)
-        text_path = os.path.join(text_dir, text_file)
-        
-        # Load and process text image
-        text_img = Image.open(text_path).convert("RGBA")
-        text_img = remove_background(text_img)
-        
-        # Apply scale
-        scale = random.uniform(*scale_range)
-        new_width = int(text_img.width * scale)
-        new_height = int(text_img.height * scale)
-        
-        if new_width < 20 or new_height < 20:
+        # Smaller rotation range for sequential text
+        plan = plan_text_crop(text_images, text_dir, scale_range,
+                              (rotation_range[0]/2, rotation_range[1]/2), opacity_range, crop_cache)
+        if plan is None:
             continue
-            
-        text_img = text_img.resize((new_width, new_height), Image.LANCZOS)
-        
-        # Apply rotation (smaller range for sequential text)
-        rotation = random.uniform(rotation_range[0]/2, rotation_range[1]/2)
-        if rotation != 0:
-            text_img = text_img.rotate(rotation, expand=True, resample=Image.BICUBIC)
-        
-        # Apply opacity
-        opacity = random.uniform(*opacity_range)
-        if opacity < 1.0:
-            data = np.array(text_img)
-            alpha = data[..., 3] * opacity
-            data[..., 3] = alpha
-            text_img = Image.fromarray(data)
         
         # Track the max width and accumulate height
-        section_width = max(section_width, text_img.width)
-        section_height += text_img.height + random.randint(5, 15)  # Add some spacing
+        plan['spacing'] = random.randint(5, 15)  # Add some spacing
+        section_width = max(section_width, plan['final_size'][0])
+        section_height += plan['final_size'][1] + plan['spacing']
         
-        text_items.append(text_img)
+        text_plans.append(plan)
     
     # Attempt to place the entire section
     placed = False
     section_x = 0
     section_y = 0
     
+    if placement is not None:
+        position = placement.sample(section_width, section_height, min_edge_distance, max_attempts)
+        if position is not None:
+            section_x, section_y = position
+            section_box = [section_x, section_y, section_x + section_width, section_y + section_height]
+            placed = True
+        max_attempts = 0
+    
     for _ in range(max_attempts):
         # Calculate valid placement area
         valid_x_min = min_edge_distance
@@ -219,12 +309,13 @@ def create_sequential_text_section(
     if not placed:
         return [], [], []  # Failed to place section
     
-    # Now place each text item in sequence
+    # Now render and place each text item in sequence
     current_y = section_y
-    for text_img in text_items:
+    for plan in text_plans:
+        text_img = render_text_crop(text_dir, plan, crop_cache)
         x = section_x
         y = current_y
-        current_y += text_img.height + random.randint(5, 15)  # Add spacing
+        current_y += text_img.height + plan['spacing']
         
         # Record the bounding box
         box = [x, y, x + text_img.width, y + text_img.height]
@@ -259,7 +350,14 @@ def generate_synthetic_data(
     max_sequential_sections=3,  # Maximum number of sequential sections per image
     max_texts_per_section=6,  # Maximum texts in a sequential section
     items_prob=0.8,  # Probability of adding background items
-    max_items=5  # Maximum number of background items
+    max_items=5,  # Maximum number of background items
+    crop_cache_mb=512,  # Memory budget of the matted text crop cache (0 disables it)
+    crop_cache_dir=None,  # Directory to persist matted crops across runs
+    item_cache_mb=256,  # Memory cap of the decoded background items
+    lazy_items=False,  # Decode background items on first use instead of up front
+    background_bank_dir=None,  # Directory of the memory-mapped background bank (None builds a temporary one)
+    background_crop_range=None,  # (min, max) fraction of a background to crop out, None for whole ones
+    background_long_side=None  # Downscale backgrounds to at most this many pixels on the long side
 ):
     os.makedirs(output_dir, exist_ok=True)
     text_images = [f for f in os.listdir(text_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
@@ -273,32 +371,50 @@ def generate_synthetic_data(
         return
         
     print(f"Found {len(text_images)} text images and {len(backgrounds)} backgrounds")
+    item_catalog = None
     if has_items:
-        items = [f for f in os.listdir(items_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-        print(f"Found {len(items)} background item images")
+        # Listed and decoded once, all worker threads share the catalog
+        item_catalog = ItemCatalog(items_dir, item_cache_mb * 1024 * 1024, lazy_items)
+        print(f"Found {len(item_catalog)} background item images")
     else:
         print("No items directory or no items found")
     
+    # Every background is decoded once, images start from a view of it
+    background_bank = BackgroundBank(backgrounds_dir, backgrounds, background_bank_dir)
+    if not len(background_bank):
+        print("No readable background images")
+        background_bank.close()
+        return
+    
+    # Matted text crops are shared by all worker threads
+    crop_cache = None
+    if crop_cache_mb:
+        crop_cache = CropCache(text_dir, remove_background, crop_cache_mb * 1024 * 1024, crop_cache_dir)
+    
     annotations = {}
+    placement_stats = Counter()
+    placement_lock = threading.Lock()
 
     def worker(i):
         if i % 10 == 0:
             print(f"Generating image {i+1}/{num_images}...")
         
-        # Select background
-        bg_file = random.choice(backgrounds)
-        bg_path = os.path.join(backgrounds_dir, bg_file)
-        background = Image.open(bg_path).convert("RGBA")
+        # Select background, the only copy of its pixels is the canvas itself.
+        # Pasting RGBA items and texts onto an opaque RGB canvas gives the same
+        # pixels as an RGBA canvas converted to RGB at the end.
+        bg_file, bg_pixels = background_bank.sample(background_crop_range, background_long_side)
+        background = Image.fromarray(np.array(bg_pixels))
         bg_width, bg_height = background.size
         
         # Add background items first (if available and with probability)
         if has_items and random.random() < items_prob:
             num_items = random.randint(1, max_items)
-            background = add_background_items(background, items_dir, num_items)
+            background = add_background_items(background, items_dir, num_items, catalog=item_catalog, inplace=True)
         
         # Create canvas
-        composite = background.copy()
-        placed_boxes = []
+        composite = background
+        # Placed boxes with an overlap index and free-space sampling
+        engine = PlacementEngine(bg_width, bg_height)
         image_annotations = []
         remaining_texts = random.randint(min_texts_per_image, max_texts_per_image)
         
@@ -328,13 +444,15 @@ def generate_synthetic_data(
                     opacity_range,
                     min_edge_distance,
                     texts_in_section,
-                    placed_boxes
+                    engine.boxes,
+                    crop_cache,
+                    engine
                 )
                 
                 # If section was successfully placed
                 if section_annotations:
                     # Add section box to avoid overlaps
-                    placed_boxes.append(section_box)
+                    engine.add(section_box)
                     
                     # Add individual boxes and paste text images
                     for text_img, position, annotation in section_annotations:
@@ -344,57 +462,20 @@ def generate_synthetic_data(
         
         # Add remaining texts with random placement
         for j in range(remaining_texts):
-            text_file = random.choice(text_images)
-            text_path = os.path.join(text_dir, text_file)
-            text_img = Image.open(text_path).convert("RGBA")
-            text_img = remove_background(text_img)
-            
-            # Apply transformations
-            scale = random.uniform(*scale_range)
-            new_width = int(text_img.width * scale)
-            new_height = int(text_img.height * scale)
-            
-            if new_width < 20 or new_height < 20:
+            plan = plan_text_crop(text_images, text_dir, scale_range, rotation_range, opacity_range, crop_cache)
+            if plan is None:
                 continue
-                
-            text_img = text_img.resize((new_width, new_height), Image.LANCZOS)
-            
-            rotation = random.uniform(*rotation_range)
-            if rotation != 0:
-                text_img = text_img.rotate(rotation, expand=True, resample=Image.BICUBIC)
             
-            opacity = random.uniform(*opacity_range)
-            if opacity < 1.0:
-                data = np.array(text_img)
-                alpha = data[..., 3] * opacity
-                data[..., 3] = alpha
-                text_img = Image.fromarray(data)
-            
-            # Find non-overlapping position
-            max_attempts = 100
-            placed = False
-            
-            for _ in range(max_attempts):
-                valid_x_min = min_edge_distance
-                valid_x_max = bg_width - text_img.width - min_edge_distance
-                valid_y_min = min_edge_distance
-                valid_y_max = bg_height - text_img.height - min_edge_distance
-                
-                if valid_x_max <= valid_x_min or valid_y_max <= valid_y_min:
-                    break
-                
-                x = random.randint(valid_x_min, valid_x_max)
-                y = random.randint(valid_y_min, valid_y_max)
-                
-                new_box = [x, y, x + text_img.width, y + text_img.height]
-                
-                if not check_overlap(placed_boxes, new_box):
-                    placed_boxes.append(new_box)
-                    placed = True
-                    break
-            
-            if not placed:
+            # Find non-overlapping position before decoding anything
+            width, height = plan['final_size']
+            position = engine.sample(width, height, min_edge_distance)
+            if position is None:
                 continue  # Skip if can't place without overlap
+            x, y = position
+            
+            text_img = render_text_crop(text_dir, plan, crop_cache)
+            new_box = [x, y, x + text_img.width, y + text_img.height]
+            engine.add(new_box)
             
             # Paste the text onto the background
             composite.paste(text_img, (x, y), text_img)
@@ -413,7 +494,8 @@ def generate_synthetic_data(
             image_annotations.append(annotation)
         
         # Convert back to RGB for saving as JPG
-        composite = composite.convert("RGB")
+        if composite.mode != "RGB":
+            composite = composite.convert("RGB")
         
         # Save the image
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -422,6 +504,9 @@ def generate_synthetic_data(
         save_path = os.path.join(output_dir, image_filename)
         composite.save(save_path, quality=95)
         
+        with placement_lock:
+            placement_stats.update(engine.stats())
+        
         return image_filename, image_annotations
 
     # Process images in parallel
@@ -433,6 +518,7 @@ def generate_synthetic_data(
                 image_filename, image_annotations = result
                 if image_annotations:
                     annotations[image_filename] = image_annotations
+    background_bank.close()
 
     # Write annotation files
     with open(os.path.join(output_dir, "Label.txt"), 'w', encoding='utf-8') as label_file, \
@@ -464,6 +550,12 @@ def generate_synthetic_data(
             state_file.write(f"{full_path}\t1\n")
     
     print(f"Generated {num_images} synthetic images")
+    if crop_cache is not None:
+        print(crop_cache.stats())
+    if item_catalog is not None:
+        print(item_catalog.stats())
+    print(f"placement: {placement_stats['placed']} boxes placed in {placement_stats['attempts']} attempts, "
+          f"{placement_stats['fallbacks']} exact fallbacks, {placement_stats['failures']} boxes skipped")
     print(f"Annotations saved to {output_dir}/Label.txt and {output_dir}/Cache.cach")
     print(f"File state saved to {output_dir}/fileState.txt")
 
@@ -489,5 +581,8 @@ if __name__ == "__main__":
         max_sequential_sections=3,  # Up to 3 sequential sections per image
         max_texts_per_section=8,  # Up to 8 texts in a sequential section
         items_prob=0.8,  # 80% chance of adding background items
-        max_items=10  # Maximum 5 items per background
+        max_items=10,  # Maximum 5 items per background
+        crop_cache_mb=1024,  # Keep up to 1 GB of matted text crops in memory
+        crop_cache_dir="crop_cache",  # Reuse the matted crops in later runs
+        background_bank_dir="background_bank"  # Decode the backgrounds once, map them in later runs
     )
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""
+Background items decoded once per process, with a downscaled pyramid per item.
+
+add_background_items used to list the items directory and decode every picked
+item for every generated image. On network storage the listing alone costs more
+than the compositing. An ItemCatalog lists the directory once and keeps every
+item as decoded RGBA levels of a 2x pyramid, bounded by a memory cap. Items are
+scaled down from the smallest level that is still large enough, so the LANCZOS
+resize reads a fraction of the full-size pixels. Very large libraries can be
+loaded lazily: items are then decoded on first use and the least recently used
+ones are dropped once the cap is reached.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+# Levels stop before either side drops below this many pixels
+MIN_LEVEL_SIZE = 16
+
+def _pyramid(image):
+    """The image followed by 2x box-filtered reductions of it."""
+    levels = [image]
+    while min(levels[-1].size) >= 2 * MIN_LEVEL_SIZE:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+def _pyramid_bytes(levels):
+    return sum(level.width * level.height * 4 for level in levels)
+
+def _pyramid_bytes_for_size(width, height):
+    """Bytes of the pyramid _pyramid builds for an image of this size, without decoding it."""
+    size = width * height * 4
+    while min(width, height) >= 2 * MIN_LEVEL_SIZE:
+        # reduce(2) rounds odd sides up
+        width, height = (width + 1) // 2, (height + 1) // 2
+        size += width * height * 4
+    return size
+
+class ItemCatalog:
+    """
+    Decoded background items of one directory.
+
+    Args:
+        items_dir: Directory with the item images
+        max_bytes: Memory cap of the decoded pyramids
+        lazy: Decode items on first use instead of all at once up front
+
+    The images returned by resized() are new images, the cached levels are never
+    handed out for modification.
+    """
+
+    def __init__(self, items_dir, max_bytes=256 * 1024 * 1024, lazy=False):
+        self.items_dir = items_dir
+        self.max_bytes = max_bytes
+        self.lazy = lazy
+        self.bytes = 0
+        self.loads = 0
+        self.evictions = 0
+        self._levels = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.names = [f for f in os.listdir(items_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+
+        if not lazy:
+            for name in self.names:
+                # Sized from the header, so no item is decoded only to be evicted again
+                with Image.open(os.path.join(items_dir, name)) as image:
+                    size = _pyramid_bytes_for_size(*image.size)
+                if self.bytes + size > self.max_bytes:
+                    print(f"Item catalog full after {len(self._levels)} items, loading the rest on use")
+                    break
+                self._get(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _get(self, name):
+        """The pyramid of an item, decoded if it isn't held."""
+        with self._lock:
+            levels = self._levels.get(name)
+            if levels is not None:
+                self._levels.move_to_end(name)
+                return levels
+
+        # Decoding runs outside the lock, other threads keep compositing
+        with Image.open(os.path.join(self.items_dir, name)) as image:
+            levels = _pyramid(image.convert("RGBA"))
+        size = _pyramid_bytes(levels)
+
+        with self._lock:
+            self.loads += 1
+            if name not in self._levels:
+                self._levels[name] = levels
+                self.bytes += size
+                # Keep at least the item just loaded, it is about to be used
+                while self.bytes > self.max_bytes and len(self._levels) > 1:
+                    _, evicted = self._levels.popitem(last=False)
+                    self.bytes -= _pyramid_bytes(evicted)
+                    self.evictions += 1
+        return levels
+
+    def size(self, name):
+        """Full-size (width, height) of an item."""
+        return self._get(name)[0].size
+
+    def resized(self, name, size):
+        """An item resized to (width, height) with LANCZOS, from the closest larger pyramid level."""
+        levels = self._get(name)
+        width, height = size
+        source = levels[0]
+        for level in levels[1:]:
+            if level.width < width or level.height < height:
+                break
+            source = level
+        return source.resize(size, Image.LANCZOS)
+
+    def stats(self):
+        """One-line summary of the catalog use."""
+        return (f"item catalog: {len(self.names)} items, {self.loads} decodes, "
+                f"{self.bytes / 1e6:.1f} MB held, {self.evictions} evicted")
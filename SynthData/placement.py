@@ -0,0 +1,182 @@
+"""
+Placement of text boxes on a synthetic image without overlaps.
+
+Placing a box used to mean drawing up to 100 random positions and scanning every
+placed box for each of them, so dense images spent most of their time on
+rejected attempts. A PlacementEngine keeps two indexes of the placed boxes:
+
+- a uniform grid of buckets, so an exact overlap query only looks at the boxes
+  near the new one
+- an occupancy bitmap of coarse cells covered by the placed boxes and their
+  margins, with a summed-area table to find every cell where a box of a given
+  size still fits
+
+A few uniform random attempts are tried first, they are enough on a sparse image.
+After that positions are drawn only from cells that can fit the box, so a
+placement takes about the same time however full the image is. When the coarse
+bitmap finds no room, the engine falls back to random attempts with the exact
+test, which can still find gaps narrower than a cell.
+"""
+
+import random
+
+import cv2
+import numpy as np
+
+def boxes_overlap(box, other, min_distance=10):
+    """Whether two [x1, y1, x2, y2] boxes are closer than min_distance, like check_overlap."""
+    x1, y1, x2, y2 = box
+    bx1, by1, bx2, by2 = other
+    return (x1 - min_distance <= bx2 and
+            x2 + min_distance >= bx1 and
+            y1 - min_distance <= by2 and
+            y2 + min_distance >= by1)
+
+class PlacementEngine:
+    """
+    Placed boxes of one image with overlap queries and a free-space sampler.
+
+    Args:
+        width, height: Size of the image
+        min_distance: Minimum gap between boxes, as in check_overlap
+        cell: Side length in pixels of the occupancy cells
+        bucket: Side length in pixels of the grid buckets of the overlap index
+
+    boxes lists the placed boxes. The counters attempts, rejections, placed,
+    fallbacks and failures accumulate over the lifetime of the engine.
+    """
+
+    def __init__(self, width, height, min_distance=10, cell=8, bucket=64):
+        self.width = width
+        self.height = height
+        self.min_distance = min_distance
+        self.cell = cell
+        self.bucket = bucket
+        self.boxes = []
+        self._buckets = {}
+        # Padded so every box inside the image can be summed with plain slices
+        self._occupancy = np.zeros((height // cell + 3, width // cell + 3), dtype=np.uint8)
+        self._table = None
+
+        self.attempts = 0
+        self.rejections = 0
+        self.placed = 0
+        self.fallbacks = 0
+        self.failures = 0
+
+    def _bucket_range(self, x1, y1, x2, y2):
+        b = self.bucket
+        for by in range(int(y1) // b, int(y2) // b + 1):
+            for bx in range(int(x1) // b, int(x2) // b + 1):
+                yield bx, by
+
+    def overlaps(self, box):
+        """Exact check_overlap of a box against the placed boxes near it."""
+        x1, y1, x2, y2 = box
+        d = self.min_distance
+        seen = set()
+        for key in self._bucket_range(x1 - d, y1 - d, x2 + d, y2 + d):
+            for index in self._buckets.get(key, ()):
+                if index not in seen:
+                    seen.add(index)
+                    if boxes_overlap(box, self.boxes[index], d):
+                        return True
+        return False
+
+    def add(self, box):
+        """Register a placed box."""
+        index = len(self.boxes)
+        self.boxes.append(box)
+        x1, y1, x2, y2 = box
+        for key in self._bucket_range(x1, y1, x2, y2):
+            self._buckets.setdefault(key, []).append(index)
+
+        # Cells touched by the box grown by the margin can't hold any part of another box
+        d, c = self.min_distance, self.cell
+        cx1, cy1 = max(0, int(x1 - d) // c), max(0, int(y1 - d) // c)
+        cx2, cy2 = int(x2 + d) // c, int(y2 + d) // c
+        self._occupancy[cy1:cy2 + 1, cx1:cx2 + 1] = 1
+        self._table = None
+        self.placed += 1
+
+    def _free_cells(self, width, height, x_range, y_range):
+        """
+        (cy, cx) of every cell a box of the given size can start in without
+        touching an occupied cell, whatever its offset inside the cell.
+        """
+        if self._table is None:
+            self._table = cv2.integral(self._occupancy)
+        table = self._table
+        c = self.cell
+
+        # A box starting anywhere in a cell reaches at most this many cells further
+        span_x = (c - 1 + width) // c + 1
+        span_y = (c - 1 + height) // c + 1
+        x0, x1 = x_range[0] // c, x_range[1] // c + 1
+        y0, y1 = y_range[0] // c, y_range[1] // c + 1
+
+        sums = (table[y0 + span_y:y1 + span_y, x0 + span_x:x1 + span_x]
+                - table[y0:y1, x0 + span_x:x1 + span_x]
+                - table[y0 + span_y:y1 + span_y, x0:x1]
+                + table[y0:y1, x0:x1])
+        free_y, free_x = np.nonzero(sums == 0)
+        return free_y + y0, free_x + x0
+
+    def _random_attempts(self, width, height, x_range, y_range, attempts):
+        """Uniform random positions with the exact test, the first free one or None."""
+        for _ in range(attempts):
+            self.attempts += 1
+            x = random.randint(*x_range)
+            y = random.randint(*y_range)
+            if not self.overlaps([x, y, x + width, y + height]):
+                return x, y
+            self.rejections += 1
+        return None
+
+    def sample(self, width, height, min_edge_distance=0, max_attempts=100, quick_attempts=8,
+               fallback_attempts=20):
+        """
+        A top-left position (x, y) where a box of the given size fits, or None.
+
+        The position keeps min_edge_distance from the image borders and is not
+        registered, call add() once the box is actually placed. quick_attempts
+        random positions are tried before the free cells are searched, and
+        fallback_attempts more when no cell has room.
+        """
+        x_range = (min_edge_distance, self.width - width - min_edge_distance)
+        y_range = (min_edge_distance, self.height - height - min_edge_distance)
+        if x_range[1] <= x_range[0] or y_range[1] <= y_range[0]:
+            self.failures += 1
+            return None
+
+        position = self._random_attempts(width, height, x_range, y_range, quick_attempts)
+        if position is not None:
+            return position
+
+        cys, cxs = self._free_cells(width, height, x_range, y_range)
+        c = self.cell
+        for _ in range(max_attempts if len(cxs) else 0):
+            self.attempts += 1
+            pick = random.randrange(len(cxs))
+            x = random.randint(max(x_range[0], cxs[pick] * c), min(x_range[1], cxs[pick] * c + c - 1))
+            y = random.randint(max(y_range[0], cys[pick] * c), min(y_range[1], cys[pick] * c + c - 1))
+            if not self.overlaps([x, y, x + width, y + height]):
+                return x, y
+            self.rejections += 1
+
+        # Gaps narrower than a cell only show up in the exact test
+        self.fallbacks += 1
+        position = self._random_attempts(width, height, x_range, y_range, fallback_attempts)
+        if position is None:
+            self.failures += 1
+        return position
+
+    def stats(self):
+        """Counters of this engine as a dictionary."""
+        return {
+            'attempts': self.attempts,
+            'rejections': self.rejections,
+            'placed': self.placed,
+            'fallbacks': self.fallbacks,
+            'failures': self.failures,
+        }
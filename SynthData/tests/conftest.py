@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The SynthData modules import each other as siblings, as when run as scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,33 @@
+from PIL import Image
+
+from item_catalog import ItemCatalog, _pyramid, _pyramid_bytes
+
+def make_items(items_dir, count, size=(120, 80)):
+    for i in range(count):
+        Image.new("RGBA", size, (i * 20, 100, 200, 255)).save(items_dir / f"item_{i}.png")
+    return _pyramid_bytes(_pyramid(Image.new("RGBA", size)))
+
+def test_eager_load_stops_at_the_cap(tmp_path):
+    pyramid_bytes = make_items(tmp_path, 8)
+    catalog = ItemCatalog(str(tmp_path), max_bytes=int(2.5 * pyramid_bytes))
+
+    assert catalog.loads == 2
+    assert catalog.evictions == 0
+    assert catalog.bytes <= catalog.max_bytes
+    assert len(catalog) == 8
+
+def test_items_past_the_cap_load_on_use(tmp_path):
+    pyramid_bytes = make_items(tmp_path, 8)
+    catalog = ItemCatalog(str(tmp_path), max_bytes=int(2.5 * pyramid_bytes))
+
+    for name in catalog.names:
+        assert catalog.resized(name, (30, 20)).size == (30, 20)
+    assert catalog.loads == 8
+    assert catalog.bytes <= catalog.max_bytes
+
+def test_eager_load_fits_everything_under_a_large_cap(tmp_path):
+    make_items(tmp_path, 8)
+    catalog = ItemCatalog(str(tmp_path))
+
+    assert catalog.loads == 8
+    assert catalog.evictions == 0